@@ -0,0 +1,168 @@
+#! python3
+# GPL v3.0+
+# reserveword
+
+'''Check the daemon mode of bilidown.py end to end.
+
+Builds a library of two show folders in a temporary directory: one
+downloading from a local HTTP stand-in for the Bilibili API (its
+.bilidown-remote names a season the stand-in serves), one with local danmaku
+files.  Runs LibraryDaemon in a thread and checks, for each way of watching
+the folders, that
+
+    the first pass converts every episode,
+    its own output does not make it convert anything again,
+    a new video only converts the new episode,
+    a changed danmaku file only converts its episode,
+    a restarted daemon converts nothing,
+
+and prints how long the daemon took to react:
+
+    python benchmarks/bench_daemon.py --watch inotify poll
+'''
+
+import argparse
+import http.server
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bilidown  # noqa: E402
+import payloads  # noqa: E402
+
+SEASON = 'ss1'
+EPISODES = 3
+
+
+class StandIn(http.server.BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.startswith('/season'):
+            episodes = [{'cid': 100 + i, 'index': str(i + 1), 'duration': 1440000} for i in range(EPISODES)]
+            body = json.dumps({'result': {'episodes': episodes, 'seasons': []}}).encode('utf-8')
+        else:
+            cid = int(re.search(r'oid=(\d+)', self.path).group(1))
+            body = payloads.bilibili(300, cid).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def namespace(jobs: int) -> argparse.Namespace:
+    # the arguments of bilidown.py that sync_folder reads, with their defaults
+    return argparse.Namespace(
+        join=None, sort_sub=None, mapping=lambda x: x, pattern='tokens', overwrite=False,
+        download_jobs=2, timeout=5, retries=0, danmaku_format='xml', cookie=None,
+        history=None, history_cache='.bilidown-history', jobs=jobs, stats=None,
+    )
+
+
+def wait_for(condition, timeout: float) -> float:
+    start = time.monotonic()
+    while not condition():
+        if time.monotonic() - start > timeout:
+            raise TimeoutError
+        time.sleep(0.02)
+    return time.monotonic() - start
+
+
+def outputs(folder: str):
+    return sorted(i for i in os.listdir(folder) if i.endswith('.danmaku.ass'))
+
+
+def start(library: str, args, watch: str, interval: float, settle: float):
+    daemon = bilidown.LibraryDaemon(
+        [library], namespace(args.jobs), {'sort': 'default'}, '.danmaku', 1280, 720,
+        watch=watch, interval=interval, settle=settle,
+    )
+    thread = threading.Thread(target=daemon.run, daemon=True)
+    thread.start()
+    return daemon, thread
+
+
+def check(watch: str, args) -> bool:
+    ok = True
+
+    def expect(name: str, got, want, seconds=None):
+        nonlocal ok
+        ok &= got == want
+        took = f'{seconds * 1000:8.0f}ms' if seconds is not None else ' ' * 10
+        print(f'{watch:>8} {name:<28} {took} {"ok" if got == want else f"FAILED: {got!r} != {want!r}"}', file=sys.__stdout__)
+
+    with tempfile.TemporaryDirectory() as library:
+        remote, local = os.path.join(library, 'remote'), os.path.join(library, 'local')
+        os.mkdir(remote)
+        os.mkdir(local)
+        with open(os.path.join(remote, bilidown.remote_name), 'w') as f:
+            f.write(SEASON + '\n')
+        for i in (1, 2):
+            open(os.path.join(remote, f'Remote - {i:02}.mp4'), 'wb').close()
+            open(os.path.join(local, f'Local - {i:02}.mp4'), 'wb').close()
+            with open(os.path.join(local, f'{i:02}.xml'), 'w', encoding='utf-8') as f:
+                f.write(payloads.bilibili(300, i))
+
+        daemon, thread = start(library, args, watch, args.interval, args.settle)
+        # the output files are written before the daemon records the episode, wait for both
+        seconds = wait_for(lambda: len(daemon.converted) >= 4, args.timeout)
+        expect('first pass', [outputs(remote), outputs(local)], [
+            ['Remote - 01.danmaku.ass', 'Remote - 02.danmaku.ass'],
+            ['Local - 01.danmaku.ass', 'Local - 02.danmaku.ass'],
+        ], seconds)
+        time.sleep(args.settle + args.interval + 0.5)
+        expect('own output ignored', len(daemon.converted), 4)
+
+        open(os.path.join(remote, 'Remote - 03.mp4'), 'wb').close()
+        seconds = wait_for(lambda: len(daemon.converted) >= 5, args.timeout)
+        expect('new video', [os.path.basename(i) for i in daemon.converted[4:]], ['Remote - 03.danmaku.ass'], seconds)
+
+        with open(os.path.join(local, '02.xml'), 'w', encoding='utf-8') as f:
+            f.write(payloads.bilibili(500, 2))
+        seconds = wait_for(lambda: len(daemon.converted) >= 6, args.timeout)
+        time.sleep(args.settle + 0.5)
+        expect('changed danmaku', [os.path.basename(i) for i in daemon.converted[5:]], ['Local - 02.danmaku.ass'], seconds)
+
+        daemon.stop.set()
+        thread.join()
+        daemon, thread = start(library, args, watch, args.interval, args.settle)
+        time.sleep(args.settle + 1)
+        daemon.stop.set()
+        thread.join()
+        expect('restart', daemon.converted, [])
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the daemon mode of bilidown.py')
+    parser.add_argument('--watch', nargs='+', choices=['inotify', 'poll'], default=['inotify', 'poll'])
+    parser.add_argument('--interval', type=float, default=1, help='Seconds between polls [default: 1]')
+    parser.add_argument('--settle', type=float, default=0.5, help='Seconds a folder must stay unchanged [default: 0.5]')
+    parser.add_argument('--jobs', type=int, default=2, help='Conversion processes [default: 2]')
+    parser.add_argument('--timeout', type=float, default=60, help='Seconds to wait for each step [default: 60]')
+    args = parser.parse_args()
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f'http://127.0.0.1:{server.server_port}'
+    bilidown.url_cid = base + '/season?season_id={ss}'
+    bilidown.url_xml = base + '/list.so?oid={oid}'
+
+    # the daemon prints what it does, the report goes to sys.__stdout__
+    ok = True
+    with open(os.devnull, 'w') as devnull:
+        sys.stdout = devnull
+        for watch in args.watch:
+            ok &= check(watch, args)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+#! python3
+# GPL v3.0+
+# reserveword
+
+'''Benchmark comment filtering of danmaku2ass.py with a long blocklist.
+
+Writes a filter file (5000 lines by default, mostly plain words with some
+regular expressions, as blocklists usually are), then filters synthetic
+comments (see payloads.py) with the old one-regex-per-line loop and with
+CommentFilter, checks that both drop exactly the same comments and prints the
+timings and a whole Danmaku2ASS conversion with the filter file:
+
+    python benchmarks/bench_filter.py --lines 5000 --count 100k
+'''
+
+import argparse
+import io
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import danmaku2ass  # noqa: E402
+import payloads  # noqa: E402
+from bench_pipeline import parse_count  # noqa: E402
+
+ALPHABET = 'abcdefghijklmnopqrstuvwxyz0123456789的一是了我不人在他有这个上们来到时大地为子中你说生国年着就那和要她出也得里后自以会家可下而过天去能对小多然于心学么之都好看起发当没成只如事把还用第样道想作种开美总从无情己面最女但现前些所同日手又行意动方期它头经长儿回位分爱老因很给名法间斯知世什两次使身者被高已亲其进此话常与活正感'
+REGEXES = [
+    r'\d{3}$',
+    r'^来了',
+    r'哈{6}',
+    r'(?i)THIS IS',
+    r'(\d)\1\1',
+    r'名场面\s+名场面',
+    r'[ａ-ｚ]{5}',
+    r'^(?:草|awsl)\d+',
+]
+
+
+def filter_lines(count: int, seed: int):
+    rand = random.Random(seed)
+    lines = list(REGEXES)
+    lines += ['泪目', 'yyds7', '第一次看']
+    while len(lines) < count:
+        if rand.random() < 0.05:
+            word = ''.join(rand.choice(ALPHABET) for _ in range(rand.randint(2, 5)))
+            lines.append(rand.choice([r'%s\d+', r'^%s', r'%s.?%s', r'[%s]{3,}']).replace('%s', word))
+        else:
+            lines.append(''.join(rand.choice(ALPHABET) for _ in range(rand.randint(3, 8))))
+    rand.shuffle(lines)
+    return lines[:count]
+
+
+def old_filter(lines):
+    regexes = [re.compile(i) for i in lines if i]
+    return lambda c: isinstance(c[4], int) and any(regex.search(c[3]) for regex in regexes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark danmaku2ass comment filtering')
+    parser.add_argument('--lines', type=int, default=5000, help='Lines in the filter file [default: 5000]')
+    parser.add_argument('--count', type=parse_count, default=100000, help='Comments to filter [default: 100k]')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    lines = filter_lines(args.lines, args.seed)
+    comments = danmaku2ass.ReadComments([io.StringIO(payloads.bilibili(args.count, args.seed))], 'Bilibili')
+
+    start = time.perf_counter()
+    old = old_filter(lines)
+    old_dropped = [old(c) for c in comments]
+    old_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    new = danmaku2ass.CommentFilter(lines)
+    new_dropped = [new(c) for c in comments]
+    new_seconds = time.perf_counter() - start
+
+    print(f'{len(lines)} filter lines, {len(comments)} comments, {sum(new_dropped)} filtered')
+    print(f'regex loop     {old_seconds:9.3f}s')
+    print(f'CommentFilter  {new_seconds:9.3f}s  x{old_seconds / new_seconds:.1f}')
+    mismatches = sum(a != b for a, b in zip(old_dropped, new_dropped))
+    print(f'mismatches     {mismatches}')
+
+    with tempfile.TemporaryDirectory(prefix='d2a-bench-') as tmp:
+        filter_file = os.path.join(tmp, 'filters.txt')
+        with open(filter_file, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines))
+        input_file = os.path.join(tmp, 'input.xml')
+        with open(input_file, 'w', encoding='utf-8') as f:
+            f.write(payloads.bilibili(args.count, args.seed))
+        random.seed(0)
+        start = time.perf_counter()
+        danmaku2ass.Danmaku2ASS(input_file, 'autodetect', os.path.join(tmp, 'out.ass'), 1920, 1080,
+                                comment_filters_file=filter_file)
+        print(f'Danmaku2ASS    {time.perf_counter() - start:9.3f}s')
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == '__main__':
+    main()
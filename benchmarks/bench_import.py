@@ -0,0 +1,94 @@
+#! python3
+# GPL v3.0+
+# reserveword
+
+'''Check the start-up cost of bilidown.py.
+
+Runs the CLI entry point (bilidown.py --help by default) and a bare
+`import bilidown` under `python -X importtime`, leaves out what the
+interpreter imports anyway, and prints the slowest top-level imports.  Fails
+when the imports of the entry point take longer than the budget or when any
+of the heavy dependencies that only downloading, joining subtitles or
+converting need were loaded:
+
+    python benchmarks/bench_import.py --budget 60 --runs 5
+'''
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY = ['requests', 'urllib3', 'lxml', 'ass', 'cv2', 'numpy', 'danmaku2ass', 'multiprocessing']
+
+
+def importtime(argv, env):
+    # {top-level module: cumulative microseconds}, every imported module
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', *argv], cwd=ROOT, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True,
+    )
+    top, modules = {}, set()
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if not cumulative.strip().isdigit():
+            continue  # header
+        modules.add(name.strip())
+        if not name[1:].startswith(' '):
+            top[name.strip()] = int(cumulative)
+    return top, modules
+
+
+def wallclock(argv, env, runs: int) -> float:
+    seconds = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, *argv], cwd=ROOT, env=env,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        seconds.append(time.perf_counter() - start)
+    return statistics.median(seconds)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the start-up cost of bilidown.py')
+    parser.add_argument('--budget', type=float, default=60,
+                        help='Milliseconds allowed for the imports of the entry point [default: 60]')
+    parser.add_argument('--runs', type=int, default=5, help='Runs per measurement, the median is kept [default: 5]')
+    parser.add_argument('--top', type=int, default=8, help='Slowest imports to list [default: 8]')
+    parser.add_argument('argv', nargs='*', default=['bilidown.py', '--help'],
+                        help='Entry point to check [default: bilidown.py --help]')
+    args = parser.parse_args()
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)  # measure with warm .pyc files, as users run it
+    wallclock(['-c', 'import bilidown'], env, 1)
+
+    _, startup = importtime(['-c', 'pass'], env)
+    failures = 0
+    for name, argv in (('entry point', args.argv), ('import bilidown', ['-c', 'import bilidown'])):
+        runs = [importtime(argv, env) for _ in range(args.runs)]
+        totals = [sum(v for k, v in top.items() if k not in startup) for top, _ in runs]
+        total = statistics.median(totals) / 1000
+        top, modules = runs[totals.index(sorted(totals)[len(totals) // 2])]
+        heavy = sorted(i for i in HEAVY if i in modules)
+        print(f'{name:>16} {" ".join(argv)}')
+        print(f'{"imports":>16} {total:9.1f}ms  wall {wallclock(argv, env, args.runs) * 1000:.1f}ms'
+              f'  (bare interpreter {wallclock(["-c", "pass"], env, args.runs) * 1000:.1f}ms)')
+        slowest = sorted((i for i in top.items() if i[0] not in startup), key=lambda i: -i[1])
+        for module, cumulative in slowest[:args.top]:
+            print(f'{module:>16} {cumulative / 1000:9.1f}ms')
+        if heavy:
+            failures += 1
+            print(f'{"heavy":>16} {", ".join(heavy)}')
+        if name == 'entry point' and total > args.budget:
+            failures += 1
+            print(f'{"over budget":>16} {total:.1f}ms > {args.budget:.1f}ms')
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
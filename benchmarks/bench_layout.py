@@ -0,0 +1,105 @@
+#! python3
+# GPL v3.0+
+# reserveword
+
+'''Check and time the layout engines of danmaku2ass.py.
+
+Every engine in LayoutEngineMap must place comments exactly like the per-pixel
+'pixel' engine.  The parity pass lays out randomized comment lists (odd sizes,
+zero-width stages, reserved blanks, reduced mode) with each engine, compares
+the ASS output byte for byte and round-trips the rows through
+ExportRows/ImportRows; the timing pass then runs ProcessComments on a larger
+synthetic payload:
+
+    python benchmarks/bench_layout.py --rounds 300 --count 20k
+'''
+
+import argparse
+import io
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import danmaku2ass  # noqa: E402
+import payloads  # noqa: E402
+from bench_pipeline import parse_count, parse_stage  # noqa: E402
+
+
+def random_case(seed: int):
+    rng = random.Random(seed)
+    comments = []
+    for i in range(rng.randint(1, 400)):
+        size = rng.choice([0, 12.5, 25, 25, 36, 17.3, 80])
+        text = rng.choice(['a', 'abc', '', 'x\ny', 'long' * rng.randint(1, 8)])
+        comments.append((
+            rng.random() * rng.choice([5, 30, 100]), 0, i, text, rng.choice([0, 1, 2, 3]), 0xffffff, size,
+            (text.count('\n') + 1) * size, danmaku2ass.CalculateLength(text) * size,
+        ))
+    comments.sort()
+    stage = (rng.choice([0, 50, 320, 1920]), rng.choice([10, 60, 240, 1080]), rng.choice([0, 0, 5, 70]))
+    return comments, stage, rng.choice([3.0, 5.0]), rng.choice([2.0, 4.0]), seed % 2 == 0
+
+
+def layout(engine: str, comments, stage, duration_marquee, duration_still, reduced):
+    random.seed(0)
+    out = io.StringIO()
+    _, rows = danmaku2ass.ProcessComments(
+        comments, out, *stage, 'sans-serif', 25.0, 1.0, duration_marquee, duration_still, [], reduced, None, engine
+    )
+    spans = danmaku2ass.LayoutEngineMap[engine].ExportRows(rows, stage[1], stage[2])
+    return out.getvalue(), spans
+
+
+def parity(rounds: int, engines) -> int:
+    failures = 0
+    for seed in range(rounds):
+        comments, stage, duration_marquee, duration_still, reduced = random_case(seed)
+        expected = layout('pixel', comments, stage, duration_marquee, duration_still, reduced)
+        for engine in engines:
+            got = layout(engine, comments, stage, duration_marquee, duration_still, reduced)
+            functions = danmaku2ass.LayoutEngineMap[engine]
+            restored = functions.ExportRows(functions.ImportRows(got[1], stage[1], stage[2]), stage[1], stage[2])
+            if got != expected or restored != got[1]:
+                failures += 1
+                print(f'parity: {engine} differs from pixel for seed {seed}', file=sys.stderr)
+    return failures
+
+
+def timing(engines, count: int, stages, seed: int) -> None:
+    comments = danmaku2ass.ReadComments([io.StringIO(payloads.bilibili(count, seed))], 'Bilibili')
+    for stage in stages:
+        for engine in engines:
+            random.seed(0)
+            start = time.perf_counter()
+            danmaku2ass.ProcessComments(
+                comments, io.StringIO(), *stage, 0, 'sans-serif', 25.0, 1.0, 5.0, 5.0, [], False, None, engine
+            )
+            print(f'{count:>8} {stage[0]:>5}x{stage[1]:<5} {engine:>8} {time.perf_counter() - start:9.3f}s')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check and time the danmaku2ass layout engines')
+    parser.add_argument('--engines', type=lambda x: x.split(','), default=list(danmaku2ass.LayoutEngineMap),
+                        help='Comma separated engines [default: all]')
+    parser.add_argument('--rounds', type=int, default=300, help='Randomized parity cases [default: 300]')
+    parser.add_argument('--count', type=parse_count, default=20000, help='Comments in the timing payload [default: 20k]')
+    parser.add_argument('--stages', type=lambda x: [parse_stage(i) for i in x.split(',')],
+                        default=[(672, 438), (1920, 1080), (3840, 2160)],
+                        help='Comma separated stage sizes for timing [default: 672x438,1920x1080,3840x2160]')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    for engine in args.engines:
+        if engine not in danmaku2ass.LayoutEngineMap:
+            parser.error(f'unknown engine: {engine}')
+    failures = parity(args.rounds, [i for i in args.engines if i != 'pixel'])
+    print(f'parity: {args.rounds} cases, {failures} failures')
+    if args.count:
+        timing(args.engines, args.count, args.stages, args.seed)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+#! python3
+# GPL v3.0+
+# reserveword
+
+'''Check the library mode of bilidown.py.
+
+Builds a library of show folders with local danmaku files in a temporary
+directory (one folder level per group of shows, like a NAS sorted by year),
+then times scan_library over it without an index, once per thread count, and
+runs sync_library over it three times, checking that
+
+    the first run syncs every show,
+    a second run over the unchanged library syncs nothing and lists no folder,
+    after adding a danmaku file to one show, a third run only syncs that show
+    and reuses its stored episode order instead of inferring it again,
+    when a changed group folder cannot be listed, its shows keep their rows,
+    and once it can be listed again nothing is synced or inferred again:
+
+    python benchmarks/bench_library.py --shows 300 --threads 1 8
+'''
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bilidown  # noqa: E402
+import payloads  # noqa: E402
+
+EPISODES = 3
+
+
+def namespace() -> argparse.Namespace:
+    # the arguments of bilidown.py that sync_library and sync_folder read, with their defaults
+    return argparse.Namespace(
+        join=None, sort_sub=None, mapping=lambda x: x, pattern='tokens', overwrite=False,
+        download_jobs=4, timeout=1, retries=3, danmaku_format='xml', cookie=None,
+        history=None, history_cache='.bilidown-history', jobs=1, stats=None,
+    )
+
+
+def build(library: str, shows: int, per_group: int):
+    for show in range(shows):
+        folder = os.path.join(library, f'{show // per_group:04}', f'Show {show:04}')
+        os.makedirs(folder)
+        for i in range(1, EPISODES + 1):
+            open(os.path.join(folder, f'Show {show:04} - {i:02} [1080p].mkv'), 'wb').close()
+            with open(os.path.join(folder, f'{i:03}.xml'), 'w', encoding='utf-8') as f:
+                f.write(payloads.bilibili(20, show * EPISODES + i))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the library mode of bilidown.py')
+    parser.add_argument('--shows', type=int, default=300, help='Show folders in the library [default: 300]')
+    parser.add_argument('--per-group', type=int, default=50, help='Show folders per group folder [default: 50]')
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 8], help='Scan threads to time [default: 1 8]')
+    args = parser.parse_args()
+
+    inferred = []
+    analysis_pattern = bilidown.analysis_pattern
+
+    def counting_analysis_pattern(names, *a, **kw):
+        inferred.append(os.getcwd())
+        return analysis_pattern(names, *a, **kw)
+
+    bilidown.analysis_pattern = counting_analysis_pattern
+    cfg = {'sort': 'default'}
+    ok = True
+
+    def expect(name: str, got, want, seconds=None):
+        nonlocal ok
+        ok &= got == want
+        took = f'{seconds * 1000:8.0f}ms' if seconds is not None else ' ' * 10
+        print(f'{name:<28} {took} {"ok" if got == want else f"FAILED: {got!r} != {want!r}"}', file=sys.__stdout__)
+
+    def run(library: str):
+        start = time.perf_counter()
+        synced = bilidown.sync_library(library, namespace(), cfg, '.danmaku', 1920, 1080, threads=max(args.threads))
+        return synced, time.perf_counter() - start
+
+    # sync_library prints what it does, the report goes to sys.__stdout__
+    with tempfile.TemporaryDirectory() as library, open(os.devnull, 'w') as devnull:
+        build(library, args.shows, args.per_group)
+        folders = 1 + -(-args.shows // args.per_group) + args.shows
+        for threads in args.threads:
+            start = time.perf_counter()
+            scanned = bilidown.scan_library(library, {}, threads)
+            expect(f'scan, {threads} threads', len(scanned), folders, time.perf_counter() - start)
+
+        sys.stdout = devnull
+        synced, seconds = run(library)
+        expect('first run', len(synced), args.shows, seconds)
+        inferred.clear()
+        synced, seconds = run(library)
+        index = bilidown.LibraryIndex(os.path.join(library, bilidown.library_index_name))
+        listed = [path for path, row in index.load().items()
+                  if row['mtime_ns'] != os.stat(os.path.join(library, path)).st_mtime_ns]
+        index.close()
+        expect('unchanged library', [synced, listed, inferred], [[], [], []], seconds)
+
+        changed = os.path.join('0000', 'Show 0000')
+        with open(os.path.join(library, changed, f'{EPISODES + 1:03}.xml'), 'w', encoding='utf-8') as f:
+            f.write(payloads.bilibili(20, 0))
+        synced, seconds = run(library)
+        expect('new danmaku in one show', [synced, inferred], [[changed], []], seconds)
+
+        # a group folder that changed and then fails to list, like a NAS timing out
+        group = os.path.join(library, '0000')
+        open(os.path.join(group, 'notes.txt'), 'w').close()
+        list_folder = bilidown.list_folder
+
+        def failing_list_folder(folder):
+            if folder == os.path.join(library, '0000'):
+                raise OSError('simulated failure')
+            return list_folder(folder)
+
+        bilidown.list_folder = failing_list_folder
+        try:
+            synced, seconds = run(library)
+        finally:
+            bilidown.list_folder = list_folder
+        index = bilidown.LibraryIndex(os.path.join(library, bilidown.library_index_name))
+        kept = sum(1 for path, row in index.load().items() if path.startswith('0000' + os.sep) and row['episodes'])
+        index.close()
+        expect('group fails to list', [synced, kept], [[], min(args.shows, args.per_group)], seconds)
+        inferred.clear()
+        synced, seconds = run(library)
+        expect('group lists again', [synced, inferred], [[], []], seconds)
+        sys.stdout = sys.__stdout__
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+#! python3
+# GPL v3.0+
+# reserveword
+
+'''Benchmark the episode-field detectors of bilidown.py.
+
+Generates folders of video names in common release-group naming schemes,
+shuffles them, and times analysis_pattern_tokens against analysis_pattern_lcs,
+both exhaustive (every pair) and sampled (1000 random pairs, used by bilidown
+once a folder has more than that many pairs).  Each result records whether the
+detected order matches the real episode order, and sampled results whether
+they agree with the exhaustive ones.  Exits non-zero when any detector gets
+the order wrong or a sampled result differs from the exhaustive one:
+
+    python benchmarks/bench_pattern.py --counts 12,50,200,1000 --lcs-max 50
+'''
+
+import argparse
+import contextlib
+import functools
+import io
+import json
+import os
+import platform
+import random
+import sys
+import time
+from typing import Callable, Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bilidown  # noqa: E402
+
+COUNTS = [12, 26, 50, 200, 1000]
+
+
+def crc(rng: random.Random) -> str:
+    return '%08X' % rng.getrandbits(32)
+
+
+# 每个方案按真实集数顺序生成count个文件名（不含扩展名）
+schemes: Dict[str, Callable[[int, random.Random], List[str]]] = {
+    'subsplease': lambda count, rng: [
+        f'[SubsPlease] Sousou no Frieren - {i:02d} (1080p) [{crc(rng)}]' for i in range(1, count + 1)
+    ],
+    'bracketed': lambda count, rng: [
+        f'[Nekomoe kissaten][Bocchi the Rock!][{i:02d}][1080p][CHS]' for i in range(1, count + 1)
+    ],
+    'vcb': lambda count, rng: [
+        f'[VCB-Studio] Kimetsu no Yaiba [{i:02d}][Ma10p_1080p][x265_flac_aac]' for i in range(1, count + 1)
+    ],
+    'scene': lambda count, rng: [
+        f'Show.Name.2023.S02E{i:02d}.1080p.WEB-DL.H264.AAC-GRP' for i in range(1, count + 1)
+    ],
+    'second-season': lambda count, rng: [
+        f'[LoliHouse] Spy x Family S2 - {i + 12:02d} [WebRip 1080p HEVC-10bit AAC]' for i in range(1, count + 1)
+    ],
+    'chinese': lambda count, rng: [f'名侦探柯南 第{i:04d}话 [1080P]' for i in range(1, count + 1)],
+    'titled': lambda count, rng: [
+        f'Show Name - {i:03d} - Chapter {rng.randrange(1, 40)} of {rng.randrange(2, 9)} Parts'
+        for i in range(1, count + 1)
+    ],
+    'unpadded': lambda count, rng: [f'One Piece {i} 1080p' for i in range(1, count + 1)],
+}
+
+
+def measure(func, names: List[str], sortmode: str):
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        try:
+            result = func(names, sortmode=sortmode)
+        except Exception as e:
+            return time.perf_counter() - start, None, f'{type(e).__name__}: {e}'
+        return time.perf_counter() - start, result, None
+
+
+def run(args) -> dict:
+    results = []
+    for scheme in args.schemes:
+        for count in args.counts:
+            rng = random.Random(args.seed)
+            expected = schemes[scheme](count, rng)
+            names = list(expected)
+            rng.shuffle(names)
+            detectors = [('tokens', bilidown.analysis_pattern_tokens)]
+            if count <= args.lcs_max:
+                detectors.append(('lcs', functools.partial(bilidown.analysis_pattern_lcs, count_max=None)))
+                if count * (count - 1) > args.sample:
+                    detectors.append(
+                        ('sampled', functools.partial(bilidown.analysis_pattern_lcs, count_max=args.sample))
+                    )
+            outputs = {}
+            for method, func in detectors:
+                random.seed(args.seed)
+                seconds, result, error = measure(func, names, args.sort)
+                outputs[method] = result
+                item = {
+                    'scheme': scheme,
+                    'count': count,
+                    'method': method,
+                    'seconds': round(seconds, 6),
+                    'correct': result == expected,
+                    'error': error,
+                }
+                results.append(item)
+                print(
+                    f'{scheme:>14} {count:>6} {method:>7} {seconds:10.4f}s '
+                    f'{"ok" if item["correct"] else error or "wrong order"}',
+                    file=sys.stderr,
+                )
+                if method != 'tokens' and result is not None:
+                    item['same_as_tokens'] = result == outputs['tokens']
+                if method == 'sampled' and result is not None:
+                    item['same_as_exhaustive'] = result == outputs['lcs']
+                    if not item['same_as_exhaustive']:
+                        print(f'{scheme:>14} {count:>6} {method:>7} differs from exhaustive', file=sys.stderr)
+    return {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'seed': args.seed,
+        'results': results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the bilidown episode-field detectors')
+    parser.add_argument('--schemes', type=lambda x: x.split(','), default=list(schemes),
+                        help='Comma separated naming schemes [default: all]')
+    parser.add_argument('--counts', type=lambda x: [int(i) for i in x.split(',')], default=COUNTS,
+                        help='Comma separated folder sizes [default: 12,26,50,200,1000]')
+    parser.add_argument('--lcs-max', type=int, default=50,
+                        help='Only run the LCS detectors on folders up to this size [default: 50]')
+    parser.add_argument('--sample', type=int, default=1000,
+                        help='Pairs drawn by the sampled LCS detector [default: 1000]')
+    parser.add_argument('--sort', choices=list(bilidown.sorters), default='default')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-o', '--output', help='Write the JSON report here instead of stdout')
+    args = parser.parse_args()
+    for scheme in args.schemes:
+        if scheme not in schemes:
+            parser.error(f'unknown scheme: {scheme}')
+    report = run(args)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    failures = [i for i in report['results'] if not i['correct'] or i.get('same_as_exhaustive') is False]
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
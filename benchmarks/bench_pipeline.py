@@ -0,0 +1,206 @@
+#! python3
+# GPL v3.0+
+# reserveword
+
+'''Benchmark parse -> layout -> write of danmaku2ass.py.
+
+Times ReadComments, ProcessComments and the whole Danmaku2ASS call separately
+on synthetic payloads (see payloads.py), records the peak traced memory of
+each stage, and writes a JSON report.  Two reports can be compared with
+--compare to spot regressions between commits:
+
+    python benchmarks/bench_pipeline.py -o before.json
+    git checkout <other commit>
+    python benchmarks/bench_pipeline.py -o after.json
+    python benchmarks/bench_pipeline.py --compare before.json after.json
+'''
+
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import danmaku2ass  # noqa: E402
+import payloads  # noqa: E402
+
+COUNTS = [1000, 10000, 100000, 1000000]
+STAGES = [(672, 438), (1280, 720), (1920, 1080), (2560, 1440), (3840, 2160)]
+
+
+def parse_count(x: str) -> int:
+    x = x.strip().lower()
+    for suffix, scale in (('k', 1000), ('m', 1000000)):
+        if x.endswith(suffix):
+            return int(float(x[: -len(suffix)]) * scale)
+    return int(x)
+
+
+def parse_stage(x: str) -> Tuple[int, int]:
+    width, height = x.lower().split('x', 1)
+    return int(width), int(height)
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            check=True,
+        ).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def measure(func: Callable[[], Any], memory: bool) -> Tuple[float, int, Any]:
+    '''耗时取不开tracemalloc的一次，峰值内存另外跑一次'''
+    random.seed(0)
+    start = time.perf_counter()
+    result = func()
+    seconds = time.perf_counter() - start
+    peak = 0
+    if memory:
+        del result
+        random.seed(0)
+        tracemalloc.start()
+        try:
+            result = func()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return seconds, peak, result
+
+
+def process(comments, width: int, height: int, **kwargs) -> None:
+    danmaku2ass.ProcessComments(
+        comments, io.StringIO(), width, height, 0, 'sans-serif', 25.0, 1.0, 5.0, 5.0, [], False, None, **kwargs
+    )
+
+
+def run(args) -> Dict[str, Any]:
+    results: List[Dict[str, Any]] = []
+    layout_kwargs = {'layout': args.layout} if args.layout else {}
+
+    def record(fmt, count, stage, step, seconds, peak, **extra):
+        item = {
+            'format': fmt,
+            'count': count,
+            'stage': f'{stage[0]}x{stage[1]}' if stage else None,
+            'step': step,
+            'seconds': round(seconds, 6),
+            'peak_bytes': peak,
+        }
+        item.update(extra)
+        results.append(item)
+        print(
+            f'{fmt:>9} {count:>8} {item["stage"] or "-":>9} {step:>8} '
+            f'{seconds:9.3f}s {peak / 1048576:9.1f}MiB',
+            file=sys.stderr,
+        )
+
+    with tempfile.TemporaryDirectory(prefix='d2a-bench-') as tmp:
+        for fmt in args.formats:
+            for count in args.counts:
+                filename = os.path.join(tmp, f'{fmt}-{count}.dat')
+                data = payloads.generators[fmt](count, args.seed)
+                with open(filename, 'wb') as f:
+                    f.write(data if isinstance(data, bytes) else data.encode('utf-8'))
+                del data
+                seconds, peak, comments = measure(
+                    lambda: danmaku2ass.ReadComments(filename, 'autodetect'), args.memory
+                )
+                record(fmt, count, None, 'read', seconds, peak, comments=len(comments), bytes=os.path.getsize(filename))
+                for stage in args.stages:
+                    seconds, peak, _ = measure(lambda: process(comments, *stage, **layout_kwargs), args.memory)
+                    record(fmt, count, stage, 'process', seconds, peak)
+                    output = os.path.join(tmp, 'out.ass')
+                    seconds, peak, _ = measure(
+                        lambda: danmaku2ass.Danmaku2ASS(filename, 'autodetect', output, *stage, **layout_kwargs),
+                        args.memory,
+                    )
+                    record(fmt, count, stage, 'convert', seconds, peak, output_bytes=os.path.getsize(output))
+                del comments
+                os.remove(filename)
+    return {
+        'revision': git_revision(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'numpy': danmaku2ass.numpy is not None,
+        'seed': args.seed,
+        'results': results,
+    }
+
+
+def compare(before: str, after: str) -> None:
+    with open(before, 'r', encoding='utf-8') as f:
+        old = json.load(f)
+    with open(after, 'r', encoding='utf-8') as f:
+        new = json.load(f)
+    key = lambda x: (x['format'], x['count'], x['stage'], x['step'])
+    old_results = {key(i): i for i in old['results']}
+    print(f'{old.get("revision") or before} -> {new.get("revision") or after}')
+    for item in new['results']:
+        base = old_results.get(key(item))
+        if base is None:
+            continue
+        ratio = item['seconds'] / base['seconds'] if base['seconds'] else float('inf')
+        line = (
+            f'{item["format"]:>9} {item["count"]:>8} {item["stage"] or "-":>9} {item["step"]:>8} '
+            f'{base["seconds"]:9.3f}s -> {item["seconds"]:9.3f}s  x{ratio:5.2f} time'
+        )
+        if base['peak_bytes'] and item['peak_bytes']:
+            line += f'  x{item["peak_bytes"] / base["peak_bytes"]:5.2f} memory'
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the danmaku2ass pipeline')
+    parser.add_argument('--formats', type=lambda x: x.split(','), default=list(payloads.generators),
+                        help='Comma separated formats [default: all]')
+    parser.add_argument('--counts', type=lambda x: [parse_count(i) for i in x.split(',')], default=COUNTS[:3],
+                        help='Comma separated comment counts, e.g. 1k,10k,100k,1M [default: 1k,10k,100k]')
+    parser.add_argument('--stages', type=lambda x: [parse_stage(i) for i in x.split(',')],
+                        default=[STAGES[0], STAGES[2], STAGES[4]],
+                        help='Comma separated stage sizes [default: 672x438,1920x1080,3840x2160]')
+    parser.add_argument('--full', action='store_true',
+                        help='Run every count (up to 1M) on every stage size')
+    parser.add_argument('--layout', help='Layout engine passed to ProcessComments')
+    parser.add_argument('--no-memory', dest='memory', action='store_false',
+                        help='Skip the tracemalloc pass used for peak memory')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-o', '--output', help='Write the JSON report here instead of stdout')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'),
+                        help='Compare two JSON reports instead of running')
+    args = parser.parse_args()
+    if args.compare:
+        compare(*args.compare)
+        return
+    if args.full:
+        args.counts = COUNTS
+        args.stages = STAGES
+    for fmt in args.formats:
+        if fmt not in payloads.generators:
+            parser.error(f'unknown format: {fmt}')
+    report = run(args)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
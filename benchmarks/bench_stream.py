@@ -0,0 +1,113 @@
+#! python3
+# GPL v3.0+
+# reserveword
+
+'''Check the streaming mode of danmaku2ass.py (--stream).
+
+On a Bilibili file in playback order, compares streaming with each window
+against converting the whole file at once: the output must be the same, and
+the report shows the time and peak traced memory of both.  On the same
+comments shuffled, streams with a small window so that many comments arrive
+too late for it, and checks for plain, merged (--merge) and reduced
+(--reduce) runs that every call of ProcessComments, including the one for
+the late comments, gets its comments in playback order:
+
+    python benchmarks/bench_stream.py --count 200k --window 360 0
+'''
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import danmaku2ass  # noqa: E402
+import payloads  # noqa: E402
+from bench_pipeline import parse_count  # noqa: E402
+
+SETTINGS = [
+    ('plain', {}),
+    ('merge', {'merge_duplicates': 5.0}),
+    ('reduce', {'is_reduce_comments': True, 'reduce_priority': 'earliest'}),
+]
+
+
+def convert(filename: str, output: str, **kwargs):
+    random.seed(0)
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        danmaku2ass.Danmaku2ASS([filename], 'Bilibili', output, 1920, 1080, **kwargs)
+        seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    with open(output, 'r', encoding='utf-8-sig') as f:
+        return f.read(), seconds, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the danmaku2ass streaming mode')
+    parser.add_argument('--count', type=parse_count, default=20000, help='Comments in the file [default: 20k]')
+    parser.add_argument('--window', type=float, nargs='+', default=[360.0, 0.0],
+                        help='Stream windows to compare with converting at once [default: 360 0]')
+    parser.add_argument('--late-window', type=float, default=10.0,
+                        help='Window for the shuffled file [default: 10]')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    ok = True
+
+    def expect(name: str, got, want, detail=''):
+        nonlocal ok
+        ok &= got == want
+        print(f'{name:<32} {detail:<40} {"ok" if got == want else f"FAILED: {got!r} != {want!r}"}')
+
+    with tempfile.TemporaryDirectory(prefix='d2a-stream-') as tmp:
+        lines = payloads.bilibili(args.count, args.seed).split('\n')
+        comments = lines[1:-1]
+        in_order = os.path.join(tmp, 'in-order.xml')
+        with open(in_order, 'w', encoding='utf-8') as f:
+            f.write('\n'.join([lines[0]] + sorted(comments, key=lambda x: float(x[6:].split(',', 1)[0])) + [lines[-1]]))
+        shuffled = os.path.join(tmp, 'shuffled.xml')
+        with open(shuffled, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines))
+        output = os.path.join(tmp, 'out.ass')
+
+        batch, seconds, peak = convert(in_order, output)
+        print(f'{"at once":<32} {seconds:8.2f}s {peak / 1048576:8.1f}MiB')
+        for window in args.window:
+            streamed, seconds, peak = convert(in_order, output, stream_window=window)
+            expect(f'in order, window {window:g}', streamed == batch, True, f'{seconds:8.2f}s {peak / 1048576:8.1f}MiB')
+
+        process_comments = danmaku2ass.ProcessComments
+        calls = []
+
+        def recording_process_comments(comments, *a, **kw):
+            comments = list(comments)
+            calls.append([c[0] for c in comments])
+            return process_comments(comments, *a, **kw)
+
+        danmaku2ass.ProcessComments = recording_process_comments
+        try:
+            for name, kwargs in SETTINGS:
+                calls.clear()
+                stats = danmaku2ass.ConversionStats()
+                convert(shuffled, output, stream_window=args.late_window, stats=stats, **kwargs)
+                late = stats.counters['late']
+                expect(
+                    f'shuffled, {name}',
+                    [timelines == sorted(timelines) for timelines in calls],
+                    [True, True],
+                    f'{late} late, {sum(map(len, calls))} laid out',
+                )
+        finally:
+            danmaku2ass.ProcessComments = process_comments
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
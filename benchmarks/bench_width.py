@@ -0,0 +1,63 @@
+#! python3
+# GPL v3.0+
+# reserveword
+
+'''Compare the comment width models of danmaku2ass.py.
+
+Reads synthetic comments (see payloads.py) once per width model: counting
+characters (the default), East Asian width, and the glyph advances of a font
+file when --font is given.  Prints how long reading took, how far each
+model's widths are from the most precise one, and how many comments a
+reduced layout (-r) keeps on the stage:
+
+    python benchmarks/bench_width.py --count 20k --font /path/to/font.ttf
+'''
+
+import argparse
+import io
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import danmaku2ass  # noqa: E402
+import payloads  # noqa: E402
+from bench_pipeline import parse_count, parse_stage  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the danmaku2ass comment width models')
+    parser.add_argument('--count', type=parse_count, default=20000, help='Comments to read [default: 20k]')
+    parser.add_argument('--stage', type=parse_stage, default=(1920, 1080), help='Stage size [default: 1920x1080]')
+    parser.add_argument('--font', help='TrueType/OpenType file to measure with')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    data = payloads.bilibili(args.count, args.seed)
+    models = [('count', None), ('eastasian', 'eastasian')]
+    if args.font:
+        models.append(('font', args.font))
+
+    results = []
+    for name, option in models:
+        start = time.perf_counter()
+        metrics = danmaku2ass.GetFontMetrics(option, 'sans-serif') if option else None
+        build = time.perf_counter() - start
+        start = time.perf_counter()
+        comments = danmaku2ass.ReadComments([io.StringIO(data)], 'Bilibili', font_metrics=metrics)
+        read = time.perf_counter() - start
+        random.seed(0)
+        out = io.StringIO()
+        danmaku2ass.ProcessComments(comments, out, *args.stage, 0, 'sans-serif', 25.0, 1.0, 5.0, 5.0, [], True, None)
+        results.append((name, build, read, comments, out.getvalue().count('\nDialogue:')))
+
+    reference = results[-1][3]
+    print(f'{"model":>10} {"table":>9} {"read":>9} {"width error":>12} {"kept":>8}')
+    for name, build, read, comments, kept in results:
+        errors = [abs(c[8] - r[8]) / r[8] for c, r in zip(comments, reference) if r[8]]
+        print(f'{name:>10} {build * 1000:8.1f}ms {read:8.3f}s {sum(errors) / len(errors):11.1%} {kept:>8}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+#! python3
+# GPL v3.0+
+# reserveword
+
+'''Synthetic danmaku payloads in every format danmaku2ass can read.
+
+Each generator returns the whole file content as str (bytes for binary
+formats), deterministic for a given (count, seed).  About a third of the comments are packed into the
+first 90 seconds to imitate dense opening sections.
+'''
+
+import json
+import random
+from typing import Callable, Dict, List, Tuple, Union
+from xml.sax.saxutils import escape, quoteattr
+
+# the benchmarks put the repository root on sys.path before importing this module
+from bilidown import encode_varint as varint
+
+WORDS = [
+    '233333',
+    '前方高能',
+    '哈哈哈哈哈哈',
+    'awsl',
+    '草',
+    'yyds',
+    '泪目',
+    '弹幕护体',
+    'this is fine',
+    '名场面 名场面 名场面',
+    '第一次看，有点紧张',
+    'ｗｗｗｗｗ',
+    '来了来了',
+    '这集作画好评',
+]
+COLORS = [0xFFFFFF] * 6 + [0x000000, 0xFF0000, 0x00FF00, 0xFFFF00, 0x66CCFF]
+SIZES = [25] * 8 + [18, 36]
+
+# 片长，秒
+DURATION = 1440
+
+
+def comments(count: int, seed: int = 0) -> List[Tuple[float, int, str, int, int, int]]:
+    '''(time, mode, text, size, color, timestamp) with bilibili style modes'''
+    rand = random.Random(seed)
+    result = []
+    for i in range(count):
+        if rand.random() < 0.3:
+            time = rand.random() * 90
+        else:
+            time = rand.random() * DURATION
+        mode = rand.choice((1, 1, 1, 1, 1, 1, 4, 5, 6))
+        text = rand.choice(WORDS)
+        if rand.random() < 0.3:
+            text += str(rand.randint(0, 999))
+        elif rand.random() < 0.05:
+            text = '\n'.join(rand.sample(WORDS, 2))
+        result.append((time, mode, text, rand.choice(SIZES), rand.choice(COLORS), 1600000000 + i))
+    return result
+
+
+def bilibili(count: int, seed: int = 0) -> str:
+    lines = ['<?xml version="1.0" encoding="UTF-8"?><i><chatserver>chat.bilibili.com</chatserver>']
+    for i, (time, mode, text, size, color, timestamp) in enumerate(comments(count, seed)):
+        p = f'{time:.5f},{mode},{size},{color},{timestamp},0,{i:08x},{i}'
+        lines.append(f'<d p={quoteattr(p)}>{escape(text.replace(chr(10), "/n"))}</d>')
+    lines.append('</i>')
+    return '\n'.join(lines)
+
+
+def bilibili2(count: int, seed: int = 0) -> str:
+    lines = ['<?xml version="2.0" encoding="UTF-8"?><i>']
+    for i, (time, mode, text, size, color, timestamp) in enumerate(comments(count, seed)):
+        p = f'{i},0,{round(time * 1000)},{mode},{size},{color},{timestamp}'
+        lines.append(f'<d p={quoteattr(p)}>{escape(text.replace(chr(10), "/n"))}</d>')
+    lines.append('</i>')
+    return '\n'.join(lines)
+
+
+def field(number: int, value: Union[int, bytes]) -> bytes:
+    if isinstance(value, int):
+        return varint(number << 3) + varint(value)
+    return varint(number << 3 | 2) + varint(len(value)) + value
+
+
+def bilibili_protobuf(count: int, seed: int = 0) -> bytes:
+    '''DmSegMobileReply，每6分钟一段，各段首尾相接，和bilidown下载的文件一样'''
+    segments = [bytearray() for _ in range(DURATION // 360 + 1)]
+    for i, (time, mode, text, size, color, timestamp) in enumerate(comments(count, seed)):
+        progress = round(time * 1000)
+        elem = b''.join([
+            field(1, 10**15 + i),
+            field(2, progress),
+            field(3, mode),
+            field(4, size),
+            field(5, color),
+            field(6, b'%08x' % i),
+            field(7, text.replace('\n', '/n').encode('utf-8')),
+            field(8, timestamp),
+            field(11, 0),
+            field(12, str(10**15 + i).encode('ascii')),
+        ])
+        segments[progress // 360000] += field(1, elem)
+    return b''.join(segments)
+
+
+def acfun(count: int, seed: int = 0) -> str:
+    acfun_mode = {1: 1, 4: 4, 5: 5, 6: 2}
+    items = [
+        {'c': f'{time:.3f},{color},{acfun_mode[mode]},{size},user,{timestamp}', 'm': text}
+        for time, mode, text, size, color, timestamp in comments(count, seed)
+    ]
+    return json.dumps([[], [], items], ensure_ascii=False)
+
+
+def niconico(count: int, seed: int = 0) -> str:
+    nico_mail = {1: '', 4: 'shita', 5: 'ue', 6: ''}
+    nico_size = {18: ' small', 25: '', 36: ' big'}
+    nico_color = {0xFF0000: ' red', 0x00FF00: ' green', 0xFFFF00: ' yellow', 0x000000: ' black'}
+    lines = ['<?xml version="1.0" encoding="UTF-8"?><packet>']
+    for i, (time, mode, text, size, color, timestamp) in enumerate(comments(count, seed)):
+        mail = (nico_mail[mode] + nico_size[size] + nico_color.get(color, '')).strip()
+        lines.append(
+            f'<chat thread="1" no="{i + 1}" vpos="{round(time * 100)}" date="{timestamp}" mail={quoteattr(mail)}>{escape(text)}</chat>'
+        )
+    lines.append('</packet>')
+    return '\n'.join(lines)
+
+
+def tudou(count: int, seed: int = 0) -> str:
+    tudou_pos = {1: 3, 4: 6, 5: 4, 6: 3}
+    tudou_size = {18: 0, 25: 1, 36: 2}
+    items = [
+        {
+            'pos': tudou_pos[mode],
+            'data': text,
+            'size': tudou_size[size],
+            'replay_time': round(time * 1000),
+            'commit_time': timestamp,
+            'color': color,
+        }
+        for time, mode, text, size, color, timestamp in comments(count, seed)
+    ]
+    return json.dumps({'status_code': 0, 'comment_list': items}, ensure_ascii=False, separators=(',', ':'))
+
+
+generators: Dict[str, Callable[[int, int], Union[str, bytes]]] = {
+    'Bilibili': bilibili,
+    'Bilibili2': bilibili2,
+    'Bilibili_protobuf': bilibili_protobuf,
+    'Acfun': acfun,
+    'Niconico': niconico,
+    'Tudou': tudou,
+}
@@ -4,13 +4,21 @@
 
 import argparse
 from collections import Counter, defaultdict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
 import datetime
 import functools
+import hashlib
+import importlib
 from io import BytesIO, FileIO, StringIO, TextIOWrapper
+import json
 import pickle
 import shutil
+import struct
 from subprocess import PIPE, Popen
 import sys
+import threading
+import time
+import traceback
 from typing import (
     Any,
     BinaryIO,
@@ -20,23 +28,42 @@ from typing import (
     Iterable,
     List,
     MutableSequence,
+    NamedTuple,
+    Optional,
     ParamSpecArgs,
     ParamSpecKwargs,
     Sequence,
+    Set,
     TextIO,
     Tuple,
     TypeVar,
 )
-import requests
-import lxml.html as html
 import re
 import os
 from glob import glob
 import random
-import cv2
-import ass
 
-from danmaku2ass import Danmaku2ASS
+
+class lazy_module:
+    # 第一次访问属性时才导入的模块。--help、--set-config什么都用不到，本地转换用不到网络和网页解析，不必在启动时加载
+    def __init__(self, name: str):
+        self.name = name
+        self.module = None
+
+    def __getattr__(self, attr: str):
+        if self.module is None:
+            self.module = importlib.import_module(self.name)
+        return getattr(self.module, attr)
+
+    def __reduce__(self):
+        return lazy_module, (self.name,)
+
+
+requests = lazy_module('requests')
+html = lazy_module('lxml.html')
+ass = lazy_module('ass')
+# 同名函数danmaku2ass见下
+danmaku2ass_module = lazy_module('danmaku2ass')
 
 url_av = 'https://www.bilibili.com/video/{av}'
 url_bv = 'https://www.bilibili.com/video/{bv}'
@@ -45,6 +72,14 @@ url_ep = 'https://www.bilibili.com/bangumi/play/{ep}'
 url_md = 'https://api.bilibili.com/pgc/review/user?media_id={md}'
 url_cid = 'https://bangumi.bilibili.com/view/web_api/season?season_id={ss}'
 url_xml = 'https://api.bilibili.com/x/v1/dm/list.so?oid={oid}'
+url_seg = 'https://api.bilibili.com/x/v2/dm/web/seg.so?type=1&oid={oid}&segment_index={index}'
+url_history_index = 'https://api.bilibili.com/x/v2/dm/history/index?type=1&oid={oid}&month={month}'
+url_history_seg = 'https://api.bilibili.com/x/v2/dm/web/history/seg.so?type=1&oid={oid}&date={date}'
+
+# 分段弹幕每段的时长，毫秒
+segment_duration = 360000
+# 查询不到历史弹幕日期时最多逐日下载的天数（每天一个请求）
+history_fallback_days = 31
 
 video_ext = {
     '.mp4',
@@ -122,23 +157,29 @@ class formattable:
 
 
 class combinations(Sequence):
+    '''l中两两不同位置元素组成的有序对，按下标即时算出，不展开成列表
+
+    random.sample(combinations(l), k)只会取k个下标，大文件夹也能直接抽样
+    '''
+
     def __init__(self, l: MutableSequence, r: int = 2):
+        if r != 2:
+            raise ValueError('only pairs are supported')
         self.list = l
         self.length = len(l)
 
     def __getitem__(self, __i: int):
-        if i < 0:
-            i += len(self)
-        if __i > len(self) or i < 0:
-            raise IndexError()
-        x = __i // self.length
-        y = __i % self.length
-        if x >= y:
-            x += 1
+        if __i < 0:
+            __i += len(self)
+        if not 0 <= __i < len(self):
+            raise IndexError('combinations index out of range')
+        x, y = divmod(__i, self.length - 1)
+        if y >= x:
+            y += 1
         return (self.list[x], self.list[y])
 
     def __len__(self):
-        return self.length * (self.length - 1)
+        return self.length * (self.length - 1) if self.length > 1 else 0
 
 
 class Pairing:
@@ -339,7 +380,7 @@ def danmaku2ass(*args, joined_ass=None, shift=0, **kwargs):
     kwargs.setdefault('stage_height', kwargs.pop('height', None))
     if joined_ass == None:
         kwargs.pop('join_encoding', 'utf-8')
-        return Danmaku2ASS(*args, **kwargs)
+        return danmaku2ass_module.Danmaku2ASS(*args, **kwargs)
     if type(joined_ass) == bytes:
         joined_ass = joined_ass.decode()
     if type(joined_ass) == str:
@@ -394,7 +435,7 @@ def danmaku2ass(*args, joined_ass=None, shift=0, **kwargs):
             args[4] = joined_ass.play_res_y
         else:
             kwargs['stage_height'] = joined_ass.play_res_y
-        Danmaku2ASS(*args, **kwargs)
+        danmaku2ass_module.Danmaku2ASS(*args, **kwargs)
         danmaku_ass.seek(0)
         danmaku_ass = ass.parse_file(danmaku_ass)
         if shift != 0:
@@ -423,9 +464,210 @@ def fileclassify(ls, *clas, callback=None, **kwclas):
     return rs
 
 
-def video_get_resolution(file):
+def iter_mp4_boxes(file: BinaryIO, start: int, end: int) -> Generator[Tuple[bytes, int, int], None, None]:
+    pos = start
+    while pos + 8 <= end:
+        file.seek(pos)
+        size, kind = struct.unpack('>I4s', file.read(8))
+        head = 8
+        if size == 1:
+            size = struct.unpack('>Q', file.read(8))[0]
+            head = 16
+        elif size == 0:
+            size = end - pos
+        if size < head:
+            return
+        yield kind, pos + head, pos + size
+        pos += size
+
+
+def mp4_resolution(file: BinaryIO) -> Optional[Tuple[int, int]]:
+    # moov/trak/tkhd的最后8字节是16.16定点数的宽高，mdia/hdlr标明是不是视频轨
+    end = file.seek(0, os.SEEK_END)
+    for kind, body, body_end in iter_mp4_boxes(file, 0, end):
+        if kind != b'moov':
+            continue
+        for kind, trak, trak_end in iter_mp4_boxes(file, body, body_end):
+            if kind != b'trak':
+                continue
+            size = None
+            is_video = False
+            for kind, box, box_end in iter_mp4_boxes(file, trak, trak_end):
+                if kind == b'tkhd' and box_end - box >= 84:
+                    file.seek(box_end - 8)
+                    width, height = struct.unpack('>II', file.read(8))
+                    size = (width >> 16, height >> 16)
+                elif kind == b'mdia':
+                    for kind, hdlr, _ in iter_mp4_boxes(file, box, box_end):
+                        if kind == b'hdlr':
+                            file.seek(hdlr + 8)
+                            is_video = file.read(4) == b'vide'
+            if is_video and size and all(size):
+                return size
+        return None
+    return None
+
+
+def read_ebml_vint(file: BinaryIO, keep_marker: bool) -> Tuple[int, int, bool]:
+    first = file.read(1)
+    if not first:
+        raise EOFError()
+    value = first[0]
+    length = 1
+    mask = 0x80
+    while not value & mask:
+        mask >>= 1
+        length += 1
+        if length > 8:
+            raise ValueError('invalid EBML variable length integer')
+    if not keep_marker:
+        value &= mask - 1
+    rest = file.read(length - 1)
+    if len(rest) < length - 1:
+        raise EOFError()
+    unknown = not keep_marker and value == mask - 1 and rest == b'\xff' * (length - 1)
+    for byte in rest:
+        value = value << 8 | byte
+    return value, length, unknown
+
+
+def iter_ebml(file: BinaryIO, start: int, end: int) -> Generator[Tuple[int, int, int], None, None]:
+    pos = start
+    while pos < end:
+        file.seek(pos)
+        element, id_length, _ = read_ebml_vint(file, True)
+        size, size_length, unknown = read_ebml_vint(file, False)
+        body = pos + id_length + size_length
+        if unknown:
+            # 未知长度的元素（边录边写的mkv）只能一直延伸到父元素结尾
+            yield element, body, end
+            return
+        yield element, body, body + size
+        pos = body + size
+
+
+def mkv_resolution(file: BinaryIO) -> Optional[Tuple[int, int]]:
+    # Segment/Tracks/TrackEntry里TrackType为1的轨道，取Video下的PixelWidth和PixelHeight
+    end = file.seek(0, os.SEEK_END)
+    for element, segment, segment_end in iter_ebml(file, 0, end):
+        if element != 0x18538067:  # Segment
+            continue
+        for element, tracks, tracks_end in iter_ebml(file, segment, segment_end):
+            if element == 0x1F43B675:  # Cluster，轨道信息不会在这之后了
+                return None
+            if element != 0x1654AE6B:  # Tracks
+                continue
+            for element, entry, entry_end in iter_ebml(file, tracks, tracks_end):
+                if element != 0xAE:  # TrackEntry
+                    continue
+                track_type = None
+                width = height = 0
+                for element, body, body_end in iter_ebml(file, entry, entry_end):
+                    if element == 0x83:  # TrackType
+                        file.seek(body)
+                        track_type = int.from_bytes(file.read(body_end - body), 'big')
+                    elif element == 0xE0:  # Video
+                        for element, pixel, pixel_end in iter_ebml(file, body, body_end):
+                            if element in (0xB0, 0xBA):  # PixelWidth, PixelHeight
+                                file.seek(pixel)
+                                value = int.from_bytes(file.read(pixel_end - pixel), 'big')
+                                if element == 0xB0:
+                                    width = value
+                                else:
+                                    height = value
+                if track_type == 1 and width and height:
+                    return width, height
+            return None
+    return None
+
+
+header_probes = {
+    '.mp4': mp4_resolution,
+    '.m4v': mp4_resolution,
+    '.mov': mp4_resolution,
+    '.qt': mp4_resolution,
+    '.mkv': mkv_resolution,
+}
+
+
+def cv2_resolution(file: str) -> Optional[Tuple[int, int]]:
+    try:
+        import cv2
+    except ImportError:
+        return None
     cap = cv2.VideoCapture(file)
-    return (cap.get(cv2.CAP_PROP_FRAME_WIDTH), cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    try:
+        size = (int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+    finally:
+        cap.release()
+    return size if all(size) else None
+
+
+def video_get_resolution(file: str, fallback: bool = True) -> Optional[Tuple[int, int]]:
+    probe = header_probes.get(os.path.splitext(file)[1].lower())
+    if probe is not None:
+        try:
+            with open(file, 'rb') as f:
+                size = probe(f)
+            if size:
+                return size
+        except (OSError, EOFError, ValueError, struct.error):
+            pass
+    return cv2_resolution(file) if fallback else None
+
+
+resolution_cache_name = '.bilidown-resolution.json'
+
+
+def videos_get_resolution(
+    files: Sequence[str], cache_file: str = resolution_cache_name, sample: int = 3
+) -> Optional[Tuple[int, int]]:
+    '''
+    文件夹里最常见的视频分辨率。
+    结果按 路径+mtime+大小 缓存在cache_file里；能读文件头的格式(mp4/mov/mkv)全部读取，
+    都读不出来时才用cv2打开最多sample个文件。
+    '''
+    try:
+        with open(cache_file, 'r', encoding='utf-8') as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+    changed = False
+    sizes = []
+    unknown = []
+    for file in files:
+        try:
+            st = os.stat(file)
+        except OSError:
+            continue
+        cached = cache.get(file)
+        if cached and cached[:2] == [st.st_mtime_ns, st.st_size]:
+            sizes.append(tuple(cached[2:]))
+            continue
+        size = video_get_resolution(file, fallback=False)
+        if size:
+            cache[file] = [st.st_mtime_ns, st.st_size, *size]
+            changed = True
+            sizes.append(size)
+        else:
+            unknown.append((file, st))
+    if not sizes:
+        step = max(len(unknown) // sample, 1)
+        for file, st in unknown[::step][:sample]:
+            size = cv2_resolution(file)
+            if size:
+                cache[file] = [st.st_mtime_ns, st.st_size, *size]
+                changed = True
+                sizes.append(size)
+    if changed:
+        try:
+            with open(cache_file, 'w', encoding='utf-8') as f:
+                json.dump(cache, f)
+        except OSError:
+            pass
+    if not sizes:
+        return None
+    return Counter(sizes).most_common(1)[0][0]
 
 
 def prefix(prefix, on=True):
@@ -447,6 +689,59 @@ def prefix(prefix, on=True):
     return decorator
 
 
+def non_negative_int(value: str) -> int:
+    try:
+        n = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'应为整数：{value}')
+    if n < 0:
+        raise argparse.ArgumentTypeError(f'不能为负数：{value}')
+    return n
+
+
+def positive_int(value: str) -> int:
+    n = non_negative_int(value)
+    if n < 1:
+        raise argparse.ArgumentTypeError(f'至少为1：{value}')
+    return n
+
+
+def parse_history(value: str) -> Tuple[datetime.date, datetime.date]:
+    start, _, end = value.partition(':')
+    try:
+        start = datetime.date.fromisoformat(start)
+        end = datetime.date.fromisoformat(end) if end else datetime.date.today()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'日期格式应为YYYY-MM-DD[:YYYY-MM-DD]：{value}')
+    if end < start:
+        raise argparse.ArgumentTypeError(f'结束日期早于起始日期：{value}')
+    return start, end
+
+
+def new_session(
+    pool_size: int = 4, retries: int = 3, backoff: float = 0.5, cookie: Optional[str] = None
+) -> 'requests.Session':
+    # 所有请求共用一个连接池，失败时按 backoff * 2^n 秒退避重试
+    # 历史弹幕等接口需要登录，cookie为浏览器里复制的Cookie请求头，如'SESSDATA=...'
+    from urllib3.util.retry import Retry
+
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff,
+        status_forcelist=(412, 429, 500, 502, 503, 504),
+        raise_on_status=False,
+    )
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry
+    )
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    if cookie:
+        session.headers['Cookie'] = cookie
+    return session
+
+
 @prefix('av')
 def get_av(av, *args, **kwargs):
     pass
@@ -459,13 +754,14 @@ def get_bv(bv, *args, **kwargs):
 
 @prefix('ss', on=False)
 def get_ss(
-    ss, episode_filter=normal_episode_check, *args, **kwargs
+    ss, episode_filter=normal_episode_check, *args, session=requests, timeout=None, **kwargs
 ) -> List[Tuple[int, Dict[str, Any]]]:
-    ss_json = requests.get(url_cid.format(ss=ss)).json()
+    ss_json = session.get(url_cid.format(ss=ss), timeout=timeout).json()
     episodes = [
         {
             'cid': episode.get('cid'),
             'index': episode.get('index'),
+            'duration': episode.get('duration'),
         }
         for episode in ss_json.get('result', {}).get('episodes', {})
         if episode_filter(episode)
@@ -482,14 +778,248 @@ def get_ss(
     return [(episode['cid'], episode) for episode in episodes]
 
 
+def get_segment(cid, index: int, session=requests, timeout=1) -> bytes:
+    with session.get(url_seg.format(oid=cid, index=index), timeout=timeout) as response:
+        if response.status_code != 200:
+            print(response.status_code, response.content.decode(errors='replace'))
+            response.raise_for_status()
+            return b''
+        return response.content
+
+
+def get_segments(
+    cid, duration=None, session=requests, timeout=1, executor=None, jobs=4
+) -> bytes:
+    # 已知时长（毫秒）时所有分段同时下载，否则每次下载jobs段，直到出现空段
+    # 各段的DmSegMobileReply首尾相接仍是一个合法的DmSegMobileReply，直接拼起来保存
+    own_executor = executor is None
+    if own_executor:
+        executor = ThreadPoolExecutor(max_workers=jobs)
+    fetch = functools.partial(get_segment, cid, session=session, timeout=timeout)
+    try:
+        if duration:
+            segments = list(executor.map(fetch, range(1, -(-duration // segment_duration) + 1)))
+        else:
+            segments = []
+            while not segments or all(segments[-jobs:]):
+                segments.extend(executor.map(fetch, range(len(segments) + 1, len(segments) + jobs + 1)))
+    finally:
+        if own_executor:
+            executor.shutdown()
+    return b''.join(segments)
+
+
+def history_months(start: datetime.date, end: datetime.date) -> List[str]:
+    months = []
+    year, month = start.year, start.month
+    while (year, month) <= (end.year, end.month):
+        months.append(f'{year:04}-{month:02}')
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return months
+
+
+def get_history_dates(
+    cid, start: datetime.date, end: datetime.date, session=requests, timeout=1
+) -> List[datetime.date]:
+    # 按月查询有历史弹幕的日期（需要登录cookie）；查询失败时退回到范围内的每一天
+    dates = []
+    for month in history_months(start, end):
+        index = session.get(url_history_index.format(oid=cid, month=month), timeout=timeout).json()
+        if index.get('code') != 0:
+            days = (end - start).days + 1
+            print(f'无法获取{month}的历史弹幕日期：{index.get("message")}，将逐日下载')
+            if days > history_fallback_days:
+                # 范围很大时逐日下载要发出同样多的请求，只取最近的几天
+                print(f'范围内共{days}天，只下载最近{history_fallback_days}天；请提供cookie以按日期索引下载')
+                days = history_fallback_days
+            return [end - datetime.timedelta(days=i) for i in reversed(range(days))]
+        dates.extend(datetime.date.fromisoformat(date) for date in index.get('data') or [])
+    return sorted(date for date in set(dates) if start <= date <= end)
+
+
+def get_history_day(cid, date: datetime.date, session=requests, timeout=1) -> Optional[bytes]:
+    # 下载失败返回None，这一天不缓存也不合并，下次再下载
+    with session.get(url_history_seg.format(oid=cid, date=date.isoformat()), timeout=timeout) as response:
+        content = response.content
+        if response.status_code != 200:
+            print(f'cid: {cid}, {date}的历史弹幕下载失败', response.status_code, content.decode(errors='replace'))
+            return None
+    # 未登录等错误也可能返回200和一段JSON，只接受空内容（当天没有弹幕）或protobuf
+    if content and not danmaku2ass_module.ProbeProtobufSegment(memoryview(content)):
+        print(f'cid: {cid}, {date}的历史弹幕不是protobuf', content[:200].decode(errors='replace'))
+        return None
+    return content
+
+
+class HistoryCache:
+    '''历史弹幕的本地缓存
+
+    每天的内容以sha1命名存放在objects/下，<cid>.json记录每天对应的sha1，
+    相同内容只存一份。当天及以后的日期还会变化，不缓存。
+    '''
+
+    def __init__(self, root: str) -> None:
+        self.root = root
+        os.makedirs(os.path.join(root, 'objects'), exist_ok=True)
+
+    def index_file(self, cid) -> str:
+        return os.path.join(self.root, f'{cid}.json')
+
+    def object_file(self, digest: str) -> str:
+        return os.path.join(self.root, 'objects', digest)
+
+    def load(self, cid) -> Dict[str, str]:
+        try:
+            with open(self.index_file(cid), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def get(self, index: Dict[str, str], date: datetime.date) -> Optional[bytes]:
+        digest = index.get(date.isoformat())
+        if digest is None:
+            return None
+        try:
+            with open(self.object_file(digest), 'rb') as f:
+                content = f.read()
+        except OSError:
+            return None
+        return content if hashlib.sha1(content).hexdigest() == digest else None
+
+    def put(self, cid, index: Dict[str, str], date: datetime.date, content: bytes) -> None:
+        if date >= datetime.date.today():
+            return
+        digest = hashlib.sha1(content).hexdigest()
+        # 按内容命名，已经有了就不用再写
+        if not os.path.exists(self.object_file(digest)):
+            self.write(self.object_file(digest), content)
+        index[date.isoformat()] = digest
+        self.write(self.index_file(cid), json.dumps(index, sort_keys=True).encode('utf-8'))
+
+    @staticmethod
+    def write(name: str, content: bytes) -> None:
+        # 各集在同一进程的多个线程里下载，临时文件名要区分线程
+        tmpname = f'{name}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmpname, 'wb') as f:
+            f.write(content)
+        os.replace(tmpname, name)
+
+
+def encode_varint(value: int) -> bytes:
+    # 负数按64位补码编码，和protobuf的int64一样
+    value &= (1 << 64) - 1
+    out = bytearray()
+    while value >= 0x80:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def merge_segments(contents: Iterable[bytes]) -> bytes:
+    # 合并多个DmSegMobileReply，按弹幕的row id（DanmakuElem的第1个字段）去重，保留先出现的
+    seen = set()
+    merged = bytearray()
+    for content in contents:
+        for field, wire, elem in danmaku2ass_module.IterProtobufFields(memoryview(content)):
+            if field != 1 or wire != 2:
+                continue
+            rowid = next((value for key, _, value in danmaku2ass_module.IterProtobufFields(elem) if key == 1), None)
+            if rowid is not None:
+                if rowid in seen:
+                    continue
+                seen.add(rowid)
+            merged += b'\x0a' + encode_varint(len(elem)) + elem
+    return bytes(merged)
+
+
+def get_history(
+    cid,
+    start: datetime.date,
+    end: datetime.date,
+    session=requests,
+    timeout=1,
+    executor=None,
+    jobs=4,
+    cache_dir=None,
+) -> List[bytes]:
+    # 下载start到end之间每天的历史弹幕，缓存里已有的日期不再下载
+    dates = get_history_dates(cid, start, end, session=session, timeout=timeout)
+    cache = HistoryCache(cache_dir) if cache_dir else None
+    index = cache.load(cid) if cache else {}
+    contents = {date: cache.get(index, date) for date in dates} if cache else {}
+    missing = [date for date in dates if contents.get(date) is None]
+    print(f'cid: {cid}, 历史弹幕{len(dates)}天，需下载{len(missing)}天')
+    own_executor = executor is None
+    if own_executor:
+        executor = ThreadPoolExecutor(max_workers=jobs)
+    fetch = functools.partial(get_history_day, cid, session=session, timeout=timeout)
+    try:
+        for date, content in zip(missing, executor.map(fetch, missing)):
+            if content is None:
+                continue
+            contents[date] = content
+            if cache:
+                cache.put(cid, index, date, content)
+    finally:
+        if own_executor:
+            executor.shutdown()
+    # 新的在前，去重时保留最新快照里的版本
+    return [contents[date] for date in sorted(dates, reverse=True) if contents.get(date) is not None]
+
+
 @prefix('cid', on=False)
-def get_cid(cid, name=None, mode='xb', *args, **kwargs) -> Tuple[str, str]:
+def get_cid(
+    cid,
+    name=None,
+    mode='xb',
+    *args,
+    session=requests,
+    timeout=1,
+    danmaku_format='xml',
+    duration=None,
+    executor=None,
+    jobs=4,
+    history=None,
+    history_cache=None,
+    **kwargs,
+) -> Tuple[str, str]:
     print(f'cid: {cid}, name: {name}')
+    # history为(起始日期, 结束日期)时，合并当前弹幕池与这段时间每天的历史弹幕，总是保存为protobuf
+    if danmaku_format == 'protobuf' or history:
+        if name == None:
+            name = str(cid)
+        # 和xml一样直接加后缀：集数可能带小数点（如12.5），不能用splitext去掉
+        if not name.endswith('.protobuf'):
+            name = name + '.protobuf'
+        # 先整集下载到内存，避免下载失败时留下半个文件
+        if 'x' in mode and os.path.exists(name):
+            print(FileExistsError(f'{name} already exists'))
+        else:
+            content = get_segments(
+                cid, duration, session=session, timeout=timeout, executor=executor, jobs=jobs
+            )
+            if history:
+                content = merge_segments(
+                    [content]
+                    + get_history(
+                        cid,
+                        *history,
+                        session=session,
+                        timeout=timeout,
+                        executor=executor,
+                        jobs=jobs,
+                        cache_dir=history_cache,
+                    )
+                )
+            with open(name, mode) as file:
+                file.write(content)
+        return name[: -len('.protobuf')], '.protobuf'
     if name == None:
         name = cid + '.xml'
     elif not name.endswith('.xml'):
         name = name + '.xml'
-    with requests.get(url_xml.format(oid=cid), stream=True, timeout=1) as response:
+    with session.get(url_xml.format(oid=cid), stream=True, timeout=timeout) as response:
         if response.status_code != 200:
             print(response.status_code, response.content.decode())
             raise response
@@ -505,8 +1035,8 @@ def get_cid(cid, name=None, mode='xb', *args, **kwargs) -> Tuple[str, str]:
 
 
 @prefix('ep', on=True)
-def get_ep(ep, *args, **kwargs) -> str:
-    page = html.fromstring(requests.get(url_ep.format(ep=ep)).content)
+def get_ep(ep, *args, session=requests, timeout=None, **kwargs) -> str:
+    page = html.fromstring(session.get(url_ep.format(ep=ep), timeout=timeout).content)
     metas = page.xpath('/html/head/meta[@property="og:url"]')
     if len(metas):
         ss = metas[0].get('content')
@@ -517,15 +1047,19 @@ def get_ep(ep, *args, **kwargs) -> str:
 
 
 @prefix('md', on=False)
-def get_md(md, *args, **kwargs) -> str:
-    md_json = requests.get(url_md.format(md=md)).json()
+def get_md(md, *args, session=requests, timeout=None, **kwargs) -> str:
+    md_json = session.get(url_md.format(md=md), timeout=timeout).json()
     ss = md_json['result']['media']['season_id']
     print('season', ss)
     return ss
 
 
-def get_local():
-    ls = os.listdir()
+def get_local(ls: Optional[Iterable[str]] = None):
+    # ls为文件名列表，默认列出当前文件夹
+    # .开头的是bilidown自己的缓存和索引（如resolution_cache_name），其中的.json会被当成弹幕
+    if ls is None:
+        ls = os.listdir()
+    ls = [name for name in ls if not name.startswith('.')]
     classify = fileclassify(ls, video_ext, subtitle_ext, danmaku_ext)
     videos = classify[0]
     subtitles = classify[1]
@@ -542,11 +1076,10 @@ def isitindex(ids: List[int]) -> float:
     return bag.__len__() / l
 
 
-def analysis_pattern_lcs(names, sortmode='default'):
-    # 用最长公共子序列猜测剧集使用的名称模式
-    count_max = 1000
-    if len(names) ** 2 - len(names) > count_max:
-        matching = map(lcs, random.sample(combinations(names, 2), k=count_max))
+def analysis_pattern_lcs(names, sortmode='default', count_max=1000):
+    # 用最长公共子序列猜测剧集使用的名称模式，文件对多于count_max时随机抽count_max对
+    if count_max is not None and len(names) ** 2 - len(names) > count_max:
+        matching = (lcs(v1, v2) for v1, v2 in random.sample(combinations(names, 2), k=count_max))
     else:
         matching = (lcs(v1, v2) for v1 in names for v2 in names if v1 != v2)
     c = Counter(matching)
@@ -609,6 +1142,62 @@ def analysis_pattern_lcs(names, sortmode='default'):
     return names_by_episode
 
 
+def consecutiveness(ids: List[int]) -> float:
+    '''去重排序后相邻两个值正好差1的比例，第二季从13开始编号的集数也能认出来'''
+    ids = sorted(set(ids))
+    if len(ids) < 2:
+        return 0.0
+    return sum(1 for a, b in zip(ids, ids[1:]) if b - a == 1) / (len(ids) - 1)
+
+
+def analysis_pattern_tokens(names: Sequence[str], sortmode: str = 'default') -> Optional[List[str]]:
+    # 按数字字段对齐文件名猜测集数字段，总耗时与文件名总长度成线性
+    # 每个文件名里的连续数字从左数第j个、从右数第j个分别作为一个候选字段，
+    # 这样后面跟着CRC之类变长数字的、前面有标题里数字的都能对齐
+    # 候选字段按 覆盖率*不重复率*像集数的程度 打分，取最高分；所有文件都一样的数字（分辨率、季数、年份）不算
+    if len(names) < 2:
+        return list(names)
+    candidates: Dict[Tuple[str, int], Dict[int, str]] = defaultdict(dict)
+    for k, name in enumerate(names):
+        numbers = re.findall(r'\d+', name)
+        for j, number in enumerate(numbers):
+            candidates['left', j][k] = number
+            candidates['right', len(numbers) - 1 - j][k] = number
+    best = None
+    bestval = 0.0
+    # 与LCS版本一致，同分时取靠后的字段；从右数的候选只在明显更好时才用
+    for key in sorted(candidates, key=lambda x: (x[0] == 'right', x[1] if x[0] == 'left' else -x[1])):
+        values = candidates[key]
+        ids = [int(v) for v in values.values()]
+        distinct = len(set(ids))
+        if distinct < 2:
+            continue
+        val = len(values) / len(names) * distinct / len(ids) * max(isitindex(ids), consecutiveness(ids))
+        if val > bestval or (val == bestval and key[0] == 'left'):
+            best = key
+            bestval = val
+    if best is None or bestval < 0.5:
+        return None
+    print(('从左数' if best[0] == 'left' else '从右数') + f'第{best[1] + 1}个数字为集数字段')
+    sorter = sorters[sortmode]
+    sorted_episode = sorted(
+        ((valstr, names[k]) for k, valstr in candidates[best].items()), key=lambda x: sorter(*x)
+    )
+    names_by_episode = [name for _, name in sorted_episode]
+    print('各集名称：')
+    print('\n'.join(names_by_episode))
+    return names_by_episode
+
+
+def analysis_pattern(names, sortmode='default', method='tokens'):
+    # 默认先按数字字段对齐，认不出来（比如文件名里没有数字）再用最长公共子序列
+    if method == 'tokens':
+        names_by_episode = analysis_pattern_tokens(names, sortmode=sortmode)
+        if names_by_episode is not None:
+            return names_by_episode
+    return analysis_pattern_lcs(names, sortmode=sortmode)
+
+
 route = {
     'av': get_av,
     'bv': get_bv,
@@ -617,7 +1206,7 @@ route = {
     'ep': get_ep,
     'md': get_md,
     'cid': get_cid,
-    'xml': Danmaku2ASS,
+    'xml': danmaku2ass,
 }
 
 
@@ -692,7 +1281,19 @@ def ffmpeg_get_subtitle(file):
         ).stdout.readlines()
 
 
-def get_any_cid(key, maxlen=None, mode='xb', *args, **kwargs):
+def get_any_cid(
+    key,
+    maxlen=None,
+    mode='xb',
+    *args,
+    session=None,
+    jobs=4,
+    timeout=1,
+    retries=3,
+    danmaku_format='xml',
+    cookie=None,
+    **kwargs,
+):
     print(kwargs)
     if key.startswith('ep'):
         state = 'ep'
@@ -710,60 +1311,185 @@ def get_any_cid(key, maxlen=None, mode='xb', *args, **kwargs):
             return None
         for part in parts:
             try:
-                ret = get_any_cid(part, maxlen, mode, *args, **kwargs)
+                ret = get_any_cid(
+                    part,
+                    maxlen,
+                    mode,
+                    *args,
+                    session=session,
+                    jobs=jobs,
+                    timeout=timeout,
+                    retries=retries,
+                    danmaku_format=danmaku_format,
+                    cookie=cookie,
+                    **kwargs,
+                )
                 if ret != None:
                     return ret
             except:
                 pass
         return None
+    if session is None:
+        session = new_session(jobs, retries, cookie=cookie)
     while state in ('av', 'bv', 'BV', 'ep', 'md', 'ss'):
-        key = route[state](key, *args, **kwargs)
+        key = route[state](key, *args, session=session, timeout=timeout, **kwargs)
         state = nextroute[state]
     if state == 'cid':
         if maxlen:
             key = key[:maxlen]
         episode_bias = kwargs.get('episode_bias', '')
-        key = [
-            (
+
+        def download(item):
+            cid, episode = item
+            return (
                 get_cid(
                     cid,
                     name=f'{episode_bias}{episode["index"]:>03}_{cid}',
                     mode=mode,
                     *args,
+                    session=session,
+                    timeout=timeout,
+                    danmaku_format=danmaku_format,
+                    duration=episode.get('duration'),
+                    executor=segment_executor,
+                    jobs=jobs,
                     **kwargs,
                 ),
                 episode,
             )
-            for cid, episode in key
-        ]
+
+        # 各集并发下载，map保证结果仍按集数顺序排列
+        # 分段弹幕的各段交给另一个线程池，各集的线程只等待结果，不会互相占满线程池
+        with ThreadPoolExecutor(max_workers=jobs) as executor, ThreadPoolExecutor(
+            max_workers=jobs
+        ) as segment_executor:
+            key = list(executor.map(download, key))
         return key
 
 
+class EpisodeJob(NamedTuple):
+    '''一集弹幕的转换任务，只包含可以pickle的数据，便于交给子进程执行'''
+
+    index: int
+    danmaku: Optional[str]
+    output: str
+    joined: Any
+    join_name: Optional[str]
+    shift: float
+    args: tuple
+    kwargs: Dict[str, Any]
+    stats: bool = False
+
+
+def convert_episode(job: EpisodeJob) -> Tuple[str, Optional[Dict[str, Any]]]:
+    '''返回输出文件和转换统计（job.stats为假或者只复制了字幕时为None）'''
+    stats = None
+    if job.danmaku is not None:
+        if job.stats:
+            stats = danmaku2ass_module.ConversionStats()
+        danmaku2ass(
+            job.danmaku,
+            'autodetect',
+            job.output,
+            *job.args,
+            joined_ass=job.joined,
+            shift=job.shift,
+            stats=stats,
+            **job.kwargs,
+        )
+    else:
+        shutil.copy(job.join_name, job.output)
+    if stats is None:
+        return job.output, None
+    result = stats.todict()
+    # 合并字幕时弹幕先写到内存里，输出大小以最终文件为准
+    result['output_bytes'] = os.path.getsize(job.output)
+    return job.output, result
+
+
+def print_stats(output: str, stats: Optional[Dict[str, Any]]):
+    '''每集一行JSON，写到stderr，不和进度混在一起'''
+    if stats is not None:
+        print(json.dumps({'episode': output, **stats}, ensure_ascii=False), file=sys.stderr, flush=True)
+
+
 def get_danmaku_joined(
     dmks,
     names: Iterable[str],
     *args,
     joiner: Iterable[Tuple[List[bytes], str]] = None,
     shift=lambda x: 0,
+    jobs: int = 1,
+    stats: Optional[str] = None,
+    executor=None,
+    skip: Optional[Callable[[EpisodeJob], bool]] = None,
+    done_callback: Optional[Callable[[EpisodeJob, Optional[Dict[str, Any]]], None]] = None,
     **kwargs,
-):
+) -> List[str]:
+    '''
+    转换各集弹幕，返回各集输出文件的绝对路径。
+    executor为进程池时用它转换（守护进程一直复用同一个进程池），否则jobs不为1时临时建一个；
+    skip(job)为真的集不转换；每转换完一集调用done_callback(job, 统计)。
+    '''
     try:
         names = list(names)
         if joiner is None:
             joiner = [(None, None) for _ in names]
-        for i, name, (joined, join_name) in zip(range(len(names)), names, joiner):
-            if dmks[i] is not None:
-                danmaku2ass(
-                    dmks[i],
-                    'autodetect',
-                    name + '.ass',
-                    *args,
-                    joined_ass=joined,
-                    shift=shift(i + 1),
-                    **kwargs,
-                )
-            else:
-                shutil.copy(join_name, name + '.ass')
+        # 集数过滤只在下载时使用，而且可能是无法pickle的lambda
+        kwargs.pop('episode_filter', None)
+        # 在主进程里展开映射和延迟，子进程只拿到具体的值；路径都是绝对路径，子进程的工作目录可能不同
+        episode_jobs = [
+            EpisodeJob(
+                i,
+                dmks[i] and os.path.abspath(dmks[i]),
+                os.path.abspath(name + '.ass'),
+                joined,
+                join_name and os.path.abspath(join_name),
+                shift(i + 1),
+                args,
+                kwargs,
+                bool(stats),
+            )
+            for i, name, (joined, join_name) in zip(range(len(names)), names, joiner)
+        ]
+        outputs: List[Optional[str]] = [None] * len(episode_jobs)
+        # 视频多于弹幕时（比如新的一集还没有弹幕）跳过这一集，不让整个转换失败
+        for job in episode_jobs:
+            if job.danmaku is None and job.join_name is None:
+                print(f'没有弹幕：{os.path.relpath(job.output)}')
+        episode_jobs = [job for job in episode_jobs if job.danmaku is not None or job.join_name is not None]
+        if skip is not None:
+            for job in episode_jobs:
+                if skip(job):
+                    outputs[job.index] = job.output
+            episode_jobs = [job for job in episode_jobs if outputs[job.index] is None]
+        if executor is None and jobs == 1:
+            for done, job in enumerate(episode_jobs, 1):
+                outputs[job.index], episode_stats = convert_episode(job)
+                print(f'[{done}/{len(episode_jobs)}] {os.path.relpath(job.output)}')
+                print_stats(job.output, episode_stats)
+                if done_callback is not None:
+                    done_callback(job, episode_stats)
+        else:
+            owned = executor is None
+            if owned:
+                # 导入ProcessPoolExecutor会加载multiprocessing，只在多进程转换时导入
+                from concurrent.futures import ProcessPoolExecutor
+
+                executor = ProcessPoolExecutor(max_workers=jobs or None)
+            try:
+                futures = {executor.submit(convert_episode, job): job for job in episode_jobs}
+                for done, future in enumerate(as_completed(futures), 1):
+                    job = futures[future]
+                    outputs[job.index], episode_stats = future.result()
+                    print(f'[{done}/{len(episode_jobs)}] {os.path.relpath(job.output)}')
+                    print_stats(job.output, episode_stats)
+                    if done_callback is not None:
+                        done_callback(job, episode_stats)
+            finally:
+                if owned:
+                    executor.shutdown()
+        return outputs
     except Exception as e:
         for i in joiner:
             if hasattr(i, 'close'):
@@ -774,6 +1500,680 @@ def get_danmaku_joined(
         raise e
 
 
+def sync_folder(
+    args: argparse.Namespace,
+    cfg: dict,
+    tag: str,
+    remotes: Iterable[str],
+    width: Optional[int] = None,
+    height: Optional[int] = None,
+    files: Optional[Iterable[str]] = None,
+    names_by_episode: Optional[List[str]] = None,
+    **kwargs,
+) -> List[str]:
+    '''
+    在当前文件夹下载remotes的弹幕（空字符串代表本地弹幕文件）并转换，返回各集输出文件。
+    files为已经列出的文件名，names_by_episode为已经推断好的各集视频名（不含扩展名），给出时不再重新列出、推断。
+    cfg不会被修改；kwargs（executor、skip、done_callback）交给get_danmaku_joined。
+    '''
+    cfg = dict(cfg)
+    videos, subtitles, danmakus = get_local(files)
+    if width != None and height != None:
+        cfg.update(
+            {
+                'width': width,
+                'height': height,
+            }
+        )
+    else:
+        resolution = videos_get_resolution(sorted(b + e for b, e in videos))
+        if resolution is None:
+            raise RuntimeError('无法获取视频分辨率，请用 -s 指定')
+        cfg['width'], cfg['height'] = resolution
+    # 附加字幕位置
+    if args.join != None:
+        # 守护进程和媒体库模式共用args，不能把这个文件夹的排序写回去
+        sort_sub = cfg['sort'] if args.sort_sub is None else args.sort_sub
+        pool = matching_sorter(glob(args.join), sorter=sort_sub)
+        print('字幕池：', *pool, sep='\n')
+        cfg['joiner'] = ((ffmpeg_get_subtitle(item), item) for item in pool)
+    danmaku_pool = Pairing(args.mapping)
+    if names_by_episode is None:
+        videos_base = [v for v, _ in videos]
+        names_by_episode = analysis_pattern(videos_base, sortmode=cfg['sort'], method=args.pattern)
+    for remote in remotes:
+        cfg.setdefault('episode_bias', '')
+        if remote != '':
+            if ':' in remote:
+                remote, ep_filter = remote.split(':', 1)
+                # 解析集数过滤
+                if ep_filter[0] == '[':
+                    epids = [int(x) for x in ep_filter[1:-1].strip(',').split(',')]
+                    cfg['episode_filter'] = lambda x: x['index'] in epids
+                elif ep_filter.startswith('lambda x:'):
+                    ep_lambda = ep_filter[9:]
+                    cfg['episode_filter'] = lambda x: eval(ep_lambda, {'x': x})
+                else:
+                    if ep_filter[0] in '"\'':
+                        ep_filter = ep_filter[1:-1]
+                    cfg['episode_filter'] = lambda x: x['index'] == ep_filter
+            else:
+                cfg['episode_filter'] = normal_episode_check
+            dmks = get_any_cid(
+                remote,
+                mode=('xb' if not args.overwrite else 'wb'),
+                jobs=args.download_jobs,
+                timeout=args.timeout,
+                retries=args.retries,
+                danmaku_format=args.danmaku_format,
+                cookie=args.cookie,
+                history=args.history,
+                history_cache=args.history and os.path.abspath(args.history_cache),
+                **cfg,
+            )
+            danmaku_pool.push(base + ext for (base, ext), episode in dmks)
+        else:
+            danmaku_pool.push(base + ext for (base, ext) in sorted(danmakus))
+        cfg['episode_bias'] += '_'
+    for i, j in enumerate(names_by_episode):
+        print(danmaku_pool[i], j)
+    return get_danmaku_joined(
+        danmaku_pool,
+        (name + tag for name in names_by_episode),
+        jobs=args.jobs,
+        stats=args.stats,
+        **kwargs,
+        **cfg,
+    )
+
+
+# 守护进程模式用到的文件，都放在各个视频文件夹下，以.开头，不算作文件夹内容的变化
+index_name = '.bilidown-index.json'
+remote_name = '.bilidown-remote'
+
+
+def library_folders(roots: Iterable[str]) -> List[str]:
+    '''roots及其下所有不以.开头的文件夹'''
+    folders = []
+    stack = list(roots)
+    while stack:
+        folder = stack.pop()
+        folders.append(folder)
+        try:
+            with os.scandir(folder) as it:
+                for entry in it:
+                    if not entry.name.startswith('.') and entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+        except OSError:
+            pass
+    return folders
+
+
+def folder_signature(folder: str) -> List[list]:
+    '''文件夹里各文件的[文件名, mtime, 大小]，以.开头的文件（索引、缓存）除了remote_name都不算'''
+    signature = []
+    try:
+        with os.scandir(folder) as it:
+            for entry in it:
+                if entry.name.startswith('.') and entry.name != remote_name:
+                    continue
+                try:
+                    if entry.is_file():
+                        st = entry.stat()
+                        signature.append([entry.name, st.st_mtime_ns, st.st_size])
+                except OSError:
+                    pass
+    except OSError:
+        pass
+    return sorted(signature)
+
+
+def folder_remotes(folder: str) -> List[str]:
+    '''文件夹下remote_name里每行一个b站ID（和-r一样，#开头的行是注释），没有的话只转换本地弹幕'''
+    try:
+        with open(os.path.join(folder, remote_name), 'r', encoding='utf-8') as f:
+            remotes = [line.strip() for line in f if line.strip() and not line.startswith('#')]
+    except OSError:
+        remotes = []
+    return remotes or ['']
+
+
+def comparable_config(cfg: dict, **extra) -> dict:
+    '''cfg里能存成JSON、能比较的设置加上extra；映射、延迟之类的函数无法比较，不算在内'''
+    config = {k: v for k, v in cfg.items() if v is None or isinstance(v, (str, int, float, bool))}
+    config.update(extra)
+    return config
+
+
+def file_stamp(file: Optional[str]) -> Optional[List[int]]:
+    if file is None:
+        return None
+    try:
+        st = os.stat(file)
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+
+class FolderIndex:
+    '''
+    文件夹里视频→弹幕→ass的对应关系，以JSON保存在文件夹下的index_name里。
+    signature是上次处理完时的folder_signature，config是转换设置，
+    episodes[输出文件名]记录转换时所用弹幕和字幕的文件名、mtime与大小，以及输出文件的mtime与大小。
+    '''
+
+    def __init__(self, folder: str):
+        self.folder = folder
+        self.path = os.path.join(folder, index_name)
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            data = {}
+        self.signature: Optional[List[list]] = data.get('signature')
+        self.config: Optional[dict] = data.get('config')
+        self.episodes: Dict[str, dict] = data.get('episodes', {})
+
+    def entry(self, job: EpisodeJob) -> dict:
+        return {
+            'danmaku': job.danmaku and os.path.relpath(job.danmaku, self.folder),
+            'danmaku_stamp': file_stamp(job.danmaku),
+            'join': job.join_name and os.path.relpath(job.join_name, self.folder),
+            'join_stamp': file_stamp(job.join_name),
+            'output_stamp': file_stamp(job.output),
+        }
+
+    def is_current(self, job: EpisodeJob) -> bool:
+        '''输出文件在，而且弹幕、字幕和输出都和上次转换完时一样'''
+        return self.episodes.get(os.path.basename(job.output)) == self.entry(job)
+
+    def record(self, job: EpisodeJob):
+        self.episodes[os.path.basename(job.output)] = self.entry(job)
+
+    def save(self):
+        # 先写临时文件再替换，中途退出也不会留下半个索引
+        temp = self.path + '.tmp'
+        with open(temp, 'w', encoding='utf-8') as f:
+            json.dump(
+                {'signature': self.signature, 'config': self.config, 'episodes': self.episodes},
+                f,
+                ensure_ascii=False,
+            )
+        os.replace(temp, self.path)
+
+
+class PollingWatcher:
+    '''每interval秒比较一次各文件夹的folder_signature，返回变了的文件夹'''
+
+    def __init__(self, roots: Iterable[str], interval: float = 60):
+        self.roots = list(roots)
+        self.interval = interval
+        self.signatures = {folder: folder_signature(folder) for folder in library_folders(self.roots)}
+        self.next_poll = time.monotonic() + interval
+
+    def wait(self, timeout: float) -> Set[str]:
+        remaining = self.next_poll - time.monotonic()
+        if remaining > timeout:
+            time.sleep(timeout)
+            return set()
+        time.sleep(max(remaining, 0))
+        self.next_poll = time.monotonic() + self.interval
+        signatures = {folder: folder_signature(folder) for folder in library_folders(self.roots)}
+        changed = {folder for folder, signature in signatures.items() if self.signatures.get(folder) != signature}
+        self.signatures = signatures
+        return changed
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    '''
+    用inotify监视各文件夹（只有Linux有），返回有文件写完、移入移出或删除的文件夹；
+    新建或移入的子文件夹会一起监视。不可用时构造时抛出OSError，改用PollingWatcher。
+    '''
+
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ISDIR = 0x40000000
+    mask = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    def __init__(self, roots: Iterable[str]):
+        # ctypes只在守护进程里用到，不在启动时导入
+        import ctypes
+        import ctypes.util
+
+        self.ctypes = ctypes
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise OSError('inotify不可用')
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1')
+        self.folders: Dict[int, str] = {}
+        try:
+            for folder in library_folders(roots):
+                self.add(folder)
+        except OSError:
+            self.close()
+            raise
+
+    def add(self, folder: str):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(folder), self.mask)
+        if wd < 0:
+            errno = self.ctypes.get_errno()
+            raise OSError(errno, f'inotify_add_watch: {os.strerror(errno)}', folder)
+        self.folders[wd] = folder
+
+    def wait(self, timeout: float) -> Set[str]:
+        import select
+
+        changed = set()
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return changed
+        data = b''
+        while True:
+            try:
+                data += os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+        pos = 0
+        while pos < len(data):
+            wd, mask, cookie, length = struct.unpack_from('iIII', data, pos)
+            name = os.fsdecode(data[pos + 16 : pos + 16 + length].rstrip(b'\0'))
+            pos += 16 + length
+            if mask & self.IN_Q_OVERFLOW:
+                # 事件太多，内核丢掉了一部分，所有文件夹都检查一遍
+                changed.update(self.folders.values())
+                continue
+            folder = self.folders.get(wd)
+            if folder is None:
+                continue
+            if mask & self.IN_IGNORED:
+                del self.folders[wd]
+                continue
+            if name.startswith('.') and name != remote_name:
+                continue
+            if mask & self.IN_ISDIR:
+                if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    # 整个文件夹复制或移进来时，里面的子文件夹可能在添加监视之前就有了
+                    for sub in library_folders([os.path.join(folder, name)]):
+                        try:
+                            self.add(sub)
+                        except OSError as e:
+                            print(e)
+                        changed.add(sub)
+                continue
+            changed.add(folder)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+class LibraryDaemon:
+    '''
+    守护进程模式：监视roots下的各个视频文件夹，文件夹的内容变了就等它settle秒内不再变化，
+    再在文件夹里下载、转换弹幕，只转换弹幕、字幕或输出有变化的集数。
+    启动时把所有文件夹和索引比较一遍，所以上次退出后的变化也会处理。
+    文件夹逐个处理（下载和转换都要切换到文件夹里），转换交给一直开着的最多args.jobs个进程的进程池。
+    '''
+
+    def __init__(
+        self,
+        roots: Iterable[str],
+        args: argparse.Namespace,
+        cfg: dict,
+        tag: str,
+        width: Optional[int] = None,
+        height: Optional[int] = None,
+        watch: str = 'inotify',
+        interval: float = 60,
+        settle: float = 5,
+    ):
+        self.roots = [os.path.abspath(root) for root in roots]
+        self.args = args
+        self.cfg = cfg
+        self.tag = tag
+        self.width = width
+        self.height = height
+        self.watch = watch
+        self.interval = interval
+        self.settle = settle
+        # 设置变了的话所有集数重新转换
+        self.config = comparable_config(cfg, tag=tag, width=width, height=height)
+        self.stop = threading.Event()
+        self.executor = None
+        self.converted: List[str] = []
+
+    def new_watcher(self):
+        if self.watch == 'inotify':
+            try:
+                return InotifyWatcher(self.roots)
+            except OSError as e:
+                print(f'无法使用inotify（{e}），改为每{self.interval}秒扫描一次')
+        return PollingWatcher(self.roots, self.interval)
+
+    def process(self, folder: str) -> bool:
+        '''文件夹里有视频而且和索引不一致时同步一次，返回是否同步了'''
+        if not os.path.isdir(folder):
+            return False
+        signature = folder_signature(folder)
+        if not any(os.path.splitext(name)[1].lower() in video_ext for name, *_ in signature):
+            return False
+        index = FolderIndex(folder)
+        if index.signature == signature and index.config == self.config:
+            return False
+        if index.config != self.config:
+            index.config = self.config
+            index.episodes = {}
+        # 失败时不记录signature，下次启动或者文件夹再变化时重试
+        index.signature = None
+
+        def done_callback(job: EpisodeJob, stats):
+            index.record(job)
+            self.converted.append(job.output)
+
+        print(f'同步文件夹：{folder}')
+        cwd = os.getcwd()
+        os.chdir(folder)
+        try:
+            sync_folder(
+                self.args,
+                self.cfg,
+                self.tag,
+                folder_remotes(folder),
+                self.width,
+                self.height,
+                executor=self.executor,
+                skip=index.is_current,
+                done_callback=done_callback,
+            )
+            index.signature = folder_signature(folder)
+        except Exception:
+            traceback.print_exc()
+        finally:
+            os.chdir(cwd)
+            index.save()
+        return True
+
+    def run(self):
+        from concurrent.futures import ProcessPoolExecutor
+
+        self.executor = ProcessPoolExecutor(max_workers=self.args.jobs or None)
+        watcher = self.new_watcher()
+        # 文件夹 -> 最后一次变化的时间
+        pending: Dict[str, float] = {}
+        try:
+            for folder in library_folders(self.roots):
+                if self.stop.is_set():
+                    break
+                self.process(folder)
+            while not self.stop.is_set():
+                now = time.monotonic()
+                timeout = min([1.0] + [changed + self.settle - now for changed in pending.values()])
+                for folder in watcher.wait(max(timeout, 0)):
+                    pending[folder] = time.monotonic()
+                now = time.monotonic()
+                for folder in [f for f, changed in pending.items() if changed + self.settle <= now]:
+                    del pending[folder]
+                    if self.stop.is_set():
+                        break
+                    self.process(folder)
+        finally:
+            watcher.close()
+            self.executor.shutdown()
+            self.executor = None
+
+
+# 媒体库模式的索引，放在媒体库根目录下
+library_index_name = '.bilidown-library.sqlite'
+
+
+class ScannedFolder(NamedTuple):
+    path: str  # 相对于媒体库根目录，根目录本身为'.'
+    mtime_ns: int
+    files: List[str]
+    dirs: List[str]
+    listed: bool  # mtime变了，重新列出了内容
+
+
+def list_folder(folder: str) -> Tuple[int, List[str], List[str]]:
+    '''文件夹的mtime和其中的文件、子文件夹，以.开头的除了remote_name都不算'''
+    # 先取mtime再列出，列出时文件夹又变了的话下次扫描还会再列一次
+    mtime_ns = os.stat(folder).st_mtime_ns
+    files, dirs = [], []
+    with os.scandir(folder) as it:
+        for entry in it:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    if not entry.name.startswith('.'):
+                        dirs.append(entry.name)
+                elif entry.is_file() and (not entry.name.startswith('.') or entry.name == remote_name):
+                    files.append(entry.name)
+            except OSError:
+                pass
+    return mtime_ns, sorted(files), sorted(dirs)
+
+
+def scan_library(
+    root: str, known: Dict[str, Tuple[int, List[str], List[str]]], threads: int = 8
+) -> List[ScannedFolder]:
+    '''
+    用threads个线程同时扫描root下所有不以.开头的文件夹（网络存储上一次次列目录的延迟是扫描的主要耗时）。
+    known[相对路径] = (mtime_ns, 文件, 子文件夹)为上次扫描的结果：文件夹的mtime没变，其中的文件名就没变，
+    只stat一次，不再列出。
+    '''
+
+    def scan(path: str) -> ScannedFolder:
+        folder = os.path.join(root, path)
+        last = known.get(path)
+        if last is not None and os.stat(folder).st_mtime_ns == last[0]:
+            return ScannedFolder(path, *last, False)
+        return ScannedFolder(path, *list_folder(folder), True)
+
+    folders = []
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        pending = {executor.submit(scan, '.')}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    folder = future.result()
+                except OSError as e:
+                    print(f'无法读取文件夹：{e}')
+                    continue
+                folders.append(folder)
+                for name in folder.dirs:
+                    pending.add(executor.submit(scan, os.path.normpath(os.path.join(folder.path, name))))
+    return sorted(folders)
+
+
+def removed_folders(known: Iterable[str], folders: List[ScannedFolder]) -> List[str]:
+    '''
+    known里已经不在媒体库里的文件夹：某一级上级文件夹列出成功，而且其中已经没有通往它的子文件夹。
+    列不出的文件夹（比如网络存储一时出错）和它下面的文件夹都保留，下次扫描时照常沿用。
+    '''
+    scanned = {folder.path: folder for folder in folders}
+
+    @functools.lru_cache(maxsize=None)
+    def removed(path: str) -> bool:
+        if path == '.' or path in scanned:
+            return False
+        parent = os.path.dirname(path) or '.'
+        if parent in scanned:
+            return os.path.basename(path) not in scanned[parent].dirs
+        return removed(parent)
+
+    return [path for path in known if removed(path)]
+
+
+class LibraryIndex:
+    '''
+    媒体库的SQLite索引，每个文件夹一行，以相对于根目录的路径为键。
+    mtime_ns、files、dirs是上次列出文件夹时的结果；synced_ns是上次同步完时文件夹的mtime，
+    config是同步时的设置，videos是当时的视频文件，episodes是推断出的各集视频名（按集数排列）。
+    '''
+
+    def __init__(self, path: str):
+        # sqlite3只在媒体库模式下用到
+        import sqlite3
+
+        self.db = sqlite3.connect(path)
+        # 日志文件一直留着（只截断），不然每次提交都会改变根目录的mtime
+        self.db.execute('PRAGMA journal_mode=TRUNCATE')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS folders ('
+            'path TEXT PRIMARY KEY, mtime_ns INTEGER, files TEXT, dirs TEXT, '
+            'synced_ns INTEGER, config TEXT, videos TEXT, episodes TEXT)'
+        )
+        self.db.commit()
+
+    def load(self) -> Dict[str, dict]:
+        folders = {}
+        for path, mtime_ns, files, dirs, synced_ns, config, videos, episodes in self.db.execute(
+            'SELECT path, mtime_ns, files, dirs, synced_ns, config, videos, episodes FROM folders'
+        ):
+            folders[path] = {
+                'mtime_ns': mtime_ns,
+                'files': json.loads(files),
+                'dirs': json.loads(dirs),
+                'synced_ns': synced_ns,
+                'config': config and json.loads(config),
+                'videos': videos and json.loads(videos),
+                'episodes': episodes and json.loads(episodes),
+            }
+        return folders
+
+    def put(
+        self,
+        folder: ScannedFolder,
+        synced: bool = False,
+        config: Optional[dict] = None,
+        videos: Optional[List[str]] = None,
+        episodes: Optional[List[str]] = None,
+    ):
+        self.db.execute(
+            'INSERT OR REPLACE INTO folders VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (
+                folder.path,
+                folder.mtime_ns,
+                json.dumps(folder.files, ensure_ascii=False),
+                json.dumps(folder.dirs, ensure_ascii=False),
+                folder.mtime_ns if synced else None,
+                config and json.dumps(config, ensure_ascii=False, sort_keys=True),
+                videos and json.dumps(videos, ensure_ascii=False),
+                episodes and json.dumps(episodes, ensure_ascii=False),
+            ),
+        )
+
+    def forget(self, paths: Iterable[str]):
+        self.db.executemany('DELETE FROM folders WHERE path = ?', ((path,) for path in paths))
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+def sync_library(
+    root: str,
+    args: argparse.Namespace,
+    cfg: dict,
+    tag: str,
+    width: Optional[int] = None,
+    height: Optional[int] = None,
+    threads: int = 8,
+) -> List[str]:
+    '''
+    媒体库模式：扫描root下的所有视频文件夹，同步上次同步后变过的文件夹，返回同步了的文件夹（相对路径）。
+    各文件夹的b站ID写在文件夹下的remote_name里，和守护进程模式一样。
+    文件夹的mtime没变的不再列出、推断；变了但视频文件没变的沿用上次推断的各集视频名。
+    --overwrite时所有文件夹都重新同步。
+    '''
+    root = os.path.abspath(root)
+    index = LibraryIndex(os.path.join(root, library_index_name))
+    config = comparable_config(cfg, tag=tag, width=width, height=height, pattern=args.pattern)
+    synced = []
+    executor = None
+    if args.jobs != 1:
+        # 导入ProcessPoolExecutor会加载multiprocessing，只在多进程转换时导入
+        from concurrent.futures import ProcessPoolExecutor
+
+        executor = ProcessPoolExecutor(max_workers=args.jobs or None)
+    cwd = os.getcwd()
+    try:
+        known = index.load()
+        start = time.perf_counter()
+        folders = scan_library(
+            root, {path: (row['mtime_ns'], row['files'], row['dirs']) for path, row in known.items()}, threads
+        )
+        print(
+            f'扫描了{len(folders)}个文件夹，重新列出{sum(folder.listed for folder in folders)}个，'
+            f'用时{time.perf_counter() - start:.2f}秒'
+        )
+        index.forget(removed_folders(known, folders))
+        for folder in folders:
+            row = known.get(folder.path, {})
+            videos = [name for name in folder.files if os.path.splitext(name)[1].lower() in video_ext]
+            if not videos:
+                if folder.listed:
+                    index.put(folder)
+                continue
+            if not args.overwrite and row.get('synced_ns') == folder.mtime_ns and row.get('config') == config:
+                continue
+            print(f'同步文件夹：{folder.path}')
+            path = os.path.join(root, folder.path)
+            os.chdir(path)
+            try:
+                if row.get('config') == config and row.get('videos') == videos:
+                    # 视频文件没变，各集对应关系也不会变
+                    names_by_episode = row['episodes']
+                else:
+                    names_by_episode = analysis_pattern(
+                        [base for base, _ in get_local(folder.files)[0]], sortmode=cfg['sort'], method=args.pattern
+                    )
+                sync_folder(
+                    args,
+                    cfg,
+                    tag,
+                    folder_remotes(path),
+                    width,
+                    height,
+                    files=folder.files,
+                    names_by_episode=names_by_episode,
+                    executor=executor,
+                )
+                # 同步时写入了弹幕和输出，按同步完的样子记录，下次扫描时才不会当成有变化
+                index.put(
+                    ScannedFolder(folder.path, *list_folder(path), True),
+                    synced=True,
+                    config=config,
+                    videos=videos,
+                    episodes=names_by_episode,
+                )
+                synced.append(folder.path)
+            except Exception:
+                # 失败的文件夹不记录synced_ns，下次扫描时重试
+                traceback.print_exc()
+                index.put(folder)
+            finally:
+                os.chdir(cwd)
+            index.commit()
+    finally:
+        index.commit()
+        index.close()
+        if executor is not None:
+            executor.shutdown()
+    return synced
+
+
 if __name__ == '__main__':
     argcfg = {
         'tag': '.danmaku',
@@ -787,7 +2187,17 @@ if __name__ == '__main__':
         'comment_filter': None,
         'comment_filters_file': None,
         'is_reduce_comments': None,
+        'reduce_priority': None,
+        'merge_duplicates': 0,
+        'merge_mark': True,
+        'font_metrics': None,
+        'stream_window': None,
         'reserve_blank': 0,
+        'layout': 'interval',
+        'cache_dir': None,
+        'cache_size': 256 * 1048576,
+        'incremental': False,
+        'incremental_late': 'separate',
     }
     cfg = dict(argcfg)
     cfg.update(loadconfig())
@@ -811,6 +2221,8 @@ if __name__ == '__main__':
                         help='字幕文件与视频匹配方法（default=默认排序, plain=字典序, front=带前后缀的集数在最前面, middle=对应集中间, end=最后面, filename=字典序，但是连续的数字按整数排序）')
     parser.add_argument('--sort-sub', choices=['default', 'plain', 'front', 'middle', 'end', 'filename'],
                         help='字幕文件与视频匹配方法（default=默认排序, plain=字典序, front=带前后缀的集数在最前面, middle=对应集中间, end=最后面）, filename=字典序，但是连续的数字按整数排序')
+    parser.add_argument('--pattern', choices=['tokens', 'lcs'], default='tokens',
+                        help='猜测集数字段的方法（tokens=按文件名中的数字对齐，认不出时退回lcs；lcs=最长公共子序列，文件多时很慢），默认tokens')
     parser.add_argument('--join-encoding', default='utf-8',
                         help='字幕文件编码，默认utf-8')
     parser.add_argument('-m', '--mapping',
@@ -820,6 +2232,41 @@ if __name__ == '__main__':
                              '第四集弹幕映射到第三、四集视频上、'
                              'lambda x:x+1 将每一集弹幕映射到下一集视频上，'
                              '有多季弹幕时使用的是总集数')
+    parser.add_argument('--jobs', metavar='N', type=non_negative_int, default=1,
+                        help='同时转换的集数（进程数），0表示使用全部CPU核心，默认为1')
+    parser.add_argument('--stats', choices=['json'],
+                        help='每集转换后向stderr输出一行各阶段耗时、弹幕数和排版统计（json）')
+    parser.add_argument('--daemon', metavar='LIBRARY', action='append',
+                        help='守护进程模式：一直监视媒体库LIBRARY（可以多次指定）下的视频文件夹，有变化时下载并转换弹幕，'
+                             '只转换有变化的集数。各文件夹的b站ID写在文件夹下的' + remote_name + '里（每行一个，同-r），'
+                             '没有这个文件时只转换本地弹幕')
+    parser.add_argument('--watch', choices=['inotify', 'poll'], default='inotify',
+                        help='守护进程监视文件夹的方式（inotify=有变化马上处理，只有Linux可用，不可用时自动改用poll；'
+                             'poll=定时扫描），默认inotify')
+    parser.add_argument('--poll-interval', metavar='SECONDS', type=float, default=60,
+                        help='poll方式的扫描间隔，以秒计，默认为60')
+    parser.add_argument('--settle', metavar='SECONDS', type=float, default=5,
+                        help='文件夹最后一次变化后等待的时间，以秒计，避免处理还没复制完的文件，默认为5')
+    parser.add_argument('--library', metavar='ROOT', action='append',
+                        help='媒体库模式：扫描ROOT（可以多次指定）下的所有视频文件夹，同步一遍后退出。'
+                             '各文件夹的b站ID同--daemon；扫描结果和推断出的集数对应关系记录在ROOT下的'
+                             + library_index_name + '里，mtime没变的文件夹不再重新扫描、同步')
+    parser.add_argument('--scan-threads', metavar='N', type=positive_int, default=8,
+                        help='媒体库模式同时扫描的文件夹数，默认为8')
+    parser.add_argument('--download-jobs', metavar='N', type=positive_int, default=4,
+                        help='同时下载的弹幕数，默认为4')
+    parser.add_argument('--danmaku-format', choices=['xml', 'protobuf'], default='xml',
+                        help='弹幕下载格式（xml=旧接口list.so，条数有上限；protobuf=分段接口seg.so，每6分钟一段并发下载），默认xml')
+    parser.add_argument('--history', metavar='START[:END]', type=parse_history,
+                        help='同时下载START到END（默认今天）每天的历史弹幕，与当前弹幕合并去重，保存为protobuf；日期格式YYYY-MM-DD，需要--cookie')
+    parser.add_argument('--history-cache', metavar='DIR', default='.bilidown-history',
+                        help='历史弹幕缓存目录，重新运行时只下载缺少的日期，默认为视频文件夹下的.bilidown-history')
+    parser.add_argument('--cookie',
+                        help='请求时附带的Cookie，如"SESSDATA=..."，下载历史弹幕需要登录')
+    parser.add_argument('--timeout', metavar='SECONDS', type=float, default=1,
+                        help='下载超时时间，以秒计，默认为1')
+    parser.add_argument('--retries', metavar='N', type=int, default=3,
+                        help='下载失败时的重试次数，默认为3')
     parser.add_argument('--shift',
                         help='调整各集弹幕相对时间，以秒计，正数会让弹幕延迟出现，如[5,4,3]会让前三集弹幕分别延迟5、4、3秒出现。'
                              '只有与现存字幕合并时才生效（注：当与mapping一同使用是集数指的是视频的集数）')
@@ -844,6 +2291,30 @@ if __name__ == '__main__':
                         help='Reserve blank on the bottom of the stage')
     parser.add_argument('--reduce', action='store_true',
                         help='Reduce the amount of comments if stage is full')
+    parser.add_argument('--reduce-priority', choices=['earliest', 'longest', 'repeated'],
+                        help='With --reduce, cap comments per second to what the stage can show before layout, keeping these first')
+    parser.add_argument('--merge', metavar='SECONDS', type=float,
+                        help='Merge identical comments starting within SECONDS of each other into one')
+    parser.add_argument('--merge-plain', action='store_const', const=False,
+                        help='Do not mark merged comments with a count and a larger font')
+    parser.add_argument('--font-metrics', metavar='MODE',
+                        help='Measure comment widths with the glyph widths of the font face (font), '
+                             'of a TrueType/OpenType file (its path) or by East Asian width (eastasian) [default: count characters]')
+    parser.add_argument('--stream', metavar='SECONDS', nargs='?', const=360.0, type=float,
+                        help='Lay out and write comments while reading them, reordering each file within SECONDS '
+                             'of playback time [default: 360]')
+    parser.add_argument('--layout', choices=['pixel', 'interval', 'numpy'],
+                        help='Row allocation engine [default: {layout}]'.format(**cfg))
+    parser.add_argument('--incremental', action='store_true',
+                        help='Append only comments that are new since the last run to existing .ass files '
+                             '(not used when joining subtitles)')
+    parser.add_argument('--late', choices=['separate', 'drop', 'rebuild'],
+                        help='What to do with new comments before the end of the last run '
+                             '[default: {incremental_late}]'.format(**cfg))
+    parser.add_argument('--cache', metavar='DIR',
+                        help='Cache parsed comments in this directory [default: {cache_dir}]'.format(**cfg))
+    parser.add_argument('--cache-size', metavar='MB', type=float,
+                        help='Maximum size of the comment cache [default: {}]'.format(cfg['cache_size'] / 1048576))
     # end of args from Danmaku2ASS
     # fmt: on
     args = parser.parse_args()
@@ -904,6 +2375,16 @@ if __name__ == '__main__':
             'comment_filters_file': args.filter_file,
             'reserve_blank': args.protect,
             'is_reduce_comments': args.reduce,
+            'reduce_priority': args.reduce_priority,
+            'merge_duplicates': args.merge,
+            'merge_mark': args.merge_plain,
+            'font_metrics': args.font_metrics if args.font_metrics in (None, 'font', 'eastasian') else os.path.abspath(args.font_metrics),
+            'stream_window': args.stream,
+            'layout': args.layout,
+            'cache_dir': args.cache and os.path.abspath(args.cache),
+            'cache_size': args.cache_size and int(args.cache_size * 1048576),
+            'incremental': args.incremental,
+            'incremental_late': args.late,
         }.items()
         if v is not None
     )
@@ -912,6 +2393,31 @@ if __name__ == '__main__':
         saveconfig(cfg)
         exit(0)
     tag = cfg.pop('tag')
+    if args.daemon:
+        import signal
+
+        daemon = LibraryDaemon(
+            args.daemon,
+            args,
+            cfg,
+            tag,
+            width,
+            height,
+            watch=args.watch,
+            interval=args.poll_interval,
+            settle=args.settle,
+        )
+        signal.signal(signal.SIGTERM, lambda signum, frame: daemon.stop.set())
+        try:
+            daemon.run()
+        except KeyboardInterrupt:
+            pass
+        exit(0)
+    if args.library:
+        for root in args.library:
+            synced = sync_library(root, args, cfg, tag, width, height, threads=args.scan_threads)
+            print(f'{root}：同步了{len(synced)}个文件夹')
+        exit(0)
     # 本地视频位置
     if args.local == None:
         args.local = input('请输入本地视频文件夹（默认为当前路径）：')
@@ -922,57 +2428,10 @@ if __name__ == '__main__':
         args.remote = input('请输入b站ID（av/BV/ss/ep/md开头均可，网址也可以）：')
     # if args.tag == None:
     #     args.tag = input('请输入字幕文件标签，用于区分弹幕和一般字幕。默认为空：')
-    videos, subtitles, danmakus = get_local()
-    resolution = [video_get_resolution(b + e) for b, e in videos]
-    resolution = Counter(resolution).most_common(1)[0][0]
-    cfg['width'], cfg['height'] = map(int, resolution)
-    if width != None and height != None:
-        cfg.update(
-            {
-                'width': width,
-                'height': height,
-            }
-        )
-    # 附加字幕位置
-    if args.join != None:
-        if args.sort_sub is None:
-            args.sort_sub = cfg['sort']
-        pool = matching_sorter(glob(args.join), sorter=args.sort_sub)
-        print('字幕池：', *pool, sep='\n')
-        cfg['joiner'] = ((ffmpeg_get_subtitle(item), item) for item in pool)
-    danmaku_pool = Pairing(args.mapping)
-    videos_base = [v for v, _ in videos]
-    names_by_episode = analysis_pattern_lcs(videos_base, sortmode=cfg['sort'])
-    for remote in args.remote:
-        cfg.setdefault('episode_bias', '')
-        if remote != '':
-            if ':' in remote:
-                remote, ep_filter = remote.split(':', 1)
-                # 解析集数过滤
-                if ep_filter[0] == '[':
-                    epids = [int(x) for x in ep_filter[1:-1].strip(',').split(',')]
-                    cfg['episode_filter'] = lambda x: x['index'] in epids
-                elif ep_filter.startswith('lambda x:'):
-                    ep_lambda = ep_filter[9:]
-                    cfg['episode_filter'] = lambda x: eval(ep_lambda, {'x': x})
-                else:
-                    if ep_filter[0] in '"\'':
-                        ep_filter = ep_filter[1:-1]
-                    cfg['episode_filter'] = lambda x: x['index'] == ep_filter
-            else:
-                cfg['episode_filter'] = normal_episode_check
-            dmks = get_any_cid(
-                remote,
-                mode=('xb' if not args.overwrite else 'wb'),
-                **cfg,
-            )
-            danmaku_pool.push(base + ext for (base, ext), episode in dmks)
-        else:
-            danmaku_pool.push(base + ext for (base, ext) in sorted(danmakus))
-        cfg['episode_bias'] += '_'
-        print(cfg)
-    for i, j in enumerate(names_by_episode):
-        print(danmaku_pool[i], j)
-    get_danmaku_joined(danmaku_pool, (name + tag for name in names_by_episode), **cfg)
+    try:
+        sync_folder(args, cfg, tag, args.remote, width, height)
+    except RuntimeError as e:
+        print(e)
+        exit(1)
     if os.isatty(0):
         input('完成，按任意键关闭')
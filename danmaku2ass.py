@@ -14,18 +14,36 @@
 # modified by reserveword
 
 import argparse
+import array
+import bisect
 import calendar
+import collections
+import collections.abc
+import contextlib
+import functools
 import gettext
+import hashlib
+import heapq
 import io
+import itertools
 import json
 import logging
 import math
+import mmap
 import os
 import random
 import re
+import struct
 import sys
 import time
+import unicodedata
 import xml.dom.minidom
+import xml.etree.ElementTree
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 if sys.version_info < (3,):
@@ -101,6 +119,7 @@ def ProbeCommentFormat(f):
 # Input:
 #     f:         Input file
 #     fontsize:  Default font size
+#     measure:   Width of a text in ems, CalculateLength or FontMetrics.measure
 #
 # Output:
 #     yield a tuple:
@@ -119,14 +138,17 @@ def ProbeCommentFormat(f):
 #     height:    The estimated height in pixels
 #                i.e. (comment.count('\n')+1)*size
 #     width:     The estimated width in pixels
-#                i.e. CalculateLength(comment)*size
+#                i.e. measure(comment)*size
 #
 # After implementing ReadComments****, make sure to update ProbeCommentFormat
 # and CommentFormatMap.
 #
 
+def CalculateLength(s):
+    return max(map(len, s.split('\n')))  # May not be accurate
 
-def ReadCommentsNiconico(f, fontsize):
+
+def ReadCommentsNiconico(f, fontsize, measure=CalculateLength):
     NiconicoColorMap = {'red': 0xff0000, 'pink': 0xff8080, 'orange': 0xffcc00, 'yellow': 0xffff00, 'green': 0x00ff00, 'cyan': 0x00ffff, 'blue': 0x0000ff, 'purple': 0xc000ff, 'black': 0x000000, 'niconicowhite': 0xcccc99, 'white2': 0xcccc99, 'truered': 0xcc0033, 'red2': 0xcc0033, 'passionorange': 0xff6600, 'orange2': 0xff6600, 'madyellow': 0x999900, 'yellow2': 0x999900, 'elementalgreen': 0x00cc66, 'green2': 0x00cc66, 'marineblue': 0x33ffcc, 'blue2': 0x33ffcc, 'nobleviolet': 0x6633cc, 'purple2': 0x6633cc}
     dom = xml.dom.minidom.parse(f)
     comment_element = dom.getElementsByTagName('chat')
@@ -149,13 +171,13 @@ def ReadCommentsNiconico(f, fontsize):
                     size = fontsize * 0.64
                 elif mailstyle in NiconicoColorMap:
                     color = NiconicoColorMap[mailstyle]
-            yield (max(int(comment.getAttribute('vpos')), 0) * 0.01, int(comment.getAttribute('date')), int(comment.getAttribute('no')), c, pos, color, size, (c.count('\n') + 1) * size, CalculateLength(c) * size)
+            yield (max(int(comment.getAttribute('vpos')), 0) * 0.01, int(comment.getAttribute('date')), int(comment.getAttribute('no')), c, pos, color, size, (c.count('\n') + 1) * size, measure(c) * size)
         except (AssertionError, AttributeError, IndexError, TypeError, ValueError):
             logging.warning(_('Invalid comment: %s') % comment.toxml())
             continue
 
 
-def ReadCommentsAcfun(f, fontsize):
+def ReadCommentsAcfun(f, fontsize, measure=CalculateLength):
     #comment_element = json.load(f)
     # after load acfun comment json file as python list, flatten the list
     #comment_element = [c for sublist in comment_element for c in sublist]
@@ -169,7 +191,7 @@ def ReadCommentsAcfun(f, fontsize):
             size = int(p[3]) * fontsize / 25.0
             if p[2] != '7':
                 c = str(comment['m']).replace('\\r', '\n').replace('\r', '\n')
-                yield (float(p[0]), int(p[5]), i, c, {'1': 0, '2': 0, '4': 2, '5': 1}[p[2]], int(p[1]), size, (c.count('\n') + 1) * size, CalculateLength(c) * size)
+                yield (float(p[0]), int(p[5]), i, c, {'1': 0, '2': 0, '4': 2, '5': 1}[p[2]], int(p[1]), size, (c.count('\n') + 1) * size, measure(c) * size)
             else:
                 c = dict(json.loads(comment['m']))
                 yield (float(p[0]), int(p[5]), i, c, 'acfunpos', int(p[1]), size, 0, 0)
@@ -178,54 +200,127 @@ def ReadCommentsAcfun(f, fontsize):
             continue
 
 
-def ReadCommentsBilibili(f, fontsize):
-    dom = xml.dom.minidom.parse(f)
-    comment_element = dom.getElementsByTagName('d')
-    for i, comment in enumerate(comment_element):
+def IterCommentElements(f, tag):
+    # Stream elements with iterparse and drop each one once it has been
+    # consumed, so memory does not grow with the size of the file
+    if isinstance(f, (mmap.mmap, bytes, bytearray, memoryview)):
+        yield from IterMappedCommentElements(f, tag)
+        return
+    root = None
+    for event, element in xml.etree.ElementTree.iterparse(f, events=('start', 'end')):
+        if root is None:
+            root = element
+        elif event == 'end' and element.tag == tag:
+            yield element
+            root.clear()
+
+
+#
+# Memory-mapped input
+#
+# Formats read with IterCommentElements (see MappedCommentFormats) are parsed
+# from the raw bytes of the memory-mapped file: expat is fed the mapping one
+# slice at a time, without decoding or copying the file.  Expat rejects
+# control characters that are not allowed in XML before any handler sees
+# them, so a slice containing one is copied with them replaced; they are
+# ASCII and never part of a longer UTF-8 sequence.  Expat also rejects
+# invalid UTF-8, which the text path replaces with U+FFFD, so a slice that
+# does not decode is copied decoded with errors='replace'.  Slices are cut
+# between characters for that, and each is released as soon as it has been
+# fed, so no view of the mapping outlives a parse error and the mapping can
+# still be closed.
+#
+
+MappedChunkSize = 1 << 16
+MappedBadChars = re.compile(rb'[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+
+def IterMappedChunkBounds(view):
+    start = 0
+    while start < len(view):
+        end = min(start + MappedChunkSize, len(view))
+        # Cut before the character that straddles the end; a UTF-8 character
+        # has at most three continuation bytes
+        for cut in range(end, max(end - 4, start), -1):
+            if cut == len(view) or not 0x80 <= view[cut] < 0xc0:
+                end = cut
+                break
+        yield start, end
+        start = end
+
+
+def FeedMappedChunk(parser, chunk):
+    try:
+        str(chunk, 'utf-8')
+    except UnicodeDecodeError:
+        chunk = str(chunk, 'utf-8', 'replace').encode('utf-8')
+    if MappedBadChars.search(chunk):
+        chunk = MappedBadChars.sub('\ufffd'.encode('utf-8'), chunk)
+    parser.feed(chunk)
+
+
+def IterMappedCommentElements(data, tag):
+    parser = xml.etree.ElementTree.XMLPullParser(events=('start', 'end'))
+    root = None
+    with memoryview(data) as view:
+        for start, end in itertools.chain(IterMappedChunkBounds(view), [(None, None)]):
+            if start is None:
+                parser.close()
+            else:
+                with view[start:end] as chunk:
+                    FeedMappedChunk(parser, chunk)
+            for event, element in parser.read_events():
+                if root is None:
+                    root = element
+                elif event == 'end' and element.tag == tag:
+                    yield element
+                    root.clear()
+
+
+def ReadCommentsBilibili(f, fontsize, measure=CalculateLength):
+    for i, comment in enumerate(IterCommentElements(f, 'd')):
         try:
-            p = str(comment.getAttribute('p')).split(',')
+            p = str(comment.get('p', '')).split(',')
             assert len(p) >= 5
             assert p[1] in ('1', '4', '5', '6', '7', '8')
-            if comment.childNodes.length > 0:
+            if comment.text is not None:
                 if p[1] in ('1', '4', '5', '6'):
-                    c = str(comment.childNodes[0].wholeText).replace('/n', '\n')
+                    c = str(comment.text).replace('/n', '\n')
                     size = int(p[2]) * fontsize / 25.0
-                    yield (float(p[0]), int(p[4]), i, c, {'1': 0, '4': 2, '5': 1, '6': 3}[p[1]], int(p[3]), size, (c.count('\n') + 1) * size, CalculateLength(c) * size)
+                    yield (float(p[0]), int(p[4]), i, c, {'1': 0, '4': 2, '5': 1, '6': 3}[p[1]], int(p[3]), size, (c.count('\n') + 1) * size, measure(c) * size)
                 elif p[1] == '7':  # positioned comment
-                    c = str(comment.childNodes[0].wholeText)
+                    c = str(comment.text)
                     yield (float(p[0]), int(p[4]), i, c, 'bilipos', int(p[3]), int(p[2]), 0, 0)
                 elif p[1] == '8':
                     pass  # ignore scripted comment
         except (AssertionError, AttributeError, IndexError, TypeError, ValueError):
-            logging.warning(_('Invalid comment: %s') % comment.toxml())
+            logging.warning(_('Invalid comment: %s') % xml.etree.ElementTree.tostring(comment, encoding='unicode'))
             continue
 
 
-def ReadCommentsBilibili2(f, fontsize):
-    dom = xml.dom.minidom.parse(f)
-    comment_element = dom.getElementsByTagName('d')
-    for i, comment in enumerate(comment_element):
+def ReadCommentsBilibili2(f, fontsize, measure=CalculateLength):
+    for i, comment in enumerate(IterCommentElements(f, 'd')):
         try:
-            p = str(comment.getAttribute('p')).split(',')
+            p = str(comment.get('p', '')).split(',')
             assert len(p) >= 7
             assert p[3] in ('1', '4', '5', '6', '7', '8')
-            if comment.childNodes.length > 0:
+            if comment.text is not None:
                 time = float(p[2]) / 1000.0
                 if p[3] in ('1', '4', '5', '6'):
-                    c = str(comment.childNodes[0].wholeText).replace('/n', '\n')
+                    c = str(comment.text).replace('/n', '\n')
                     size = int(p[4]) * fontsize / 25.0
-                    yield (time, int(p[6]), i, c, {'1': 0, '4': 2, '5': 1, '6': 3}[p[3]], int(p[5]), size, (c.count('\n') + 1) * size, CalculateLength(c) * size)
+                    yield (time, int(p[6]), i, c, {'1': 0, '4': 2, '5': 1, '6': 3}[p[3]], int(p[5]), size, (c.count('\n') + 1) * size, measure(c) * size)
                 elif p[3] == '7':  # positioned comment
-                    c = str(comment.childNodes[0].wholeText)
+                    c = str(comment.text)
                     yield (time, int(p[6]), i, c, 'bilipos', int(p[5]), int(p[4]), 0, 0)
                 elif p[3] == '8':
                     pass  # ignore scripted comment
         except (AssertionError, AttributeError, IndexError, TypeError, ValueError):
-            logging.warning(_('Invalid comment: %s') % comment.toxml())
+            logging.warning(_('Invalid comment: %s') % xml.etree.ElementTree.tostring(comment, encoding='unicode'))
             continue
 
 
-def ReadCommentsTudou(f, fontsize):
+def ReadCommentsTudou(f, fontsize, measure=CalculateLength):
     comment_element = json.load(f)
     for i, comment in enumerate(comment_element['comment_list']):
         try:
@@ -233,13 +328,13 @@ def ReadCommentsTudou(f, fontsize):
             c = str(comment['data'])
             assert comment['size'] in (0, 1, 2)
             size = {0: 0.64, 1: 1, 2: 1.44}[comment['size']] * fontsize
-            yield (int(comment['replay_time'] * 0.001), int(comment['commit_time']), i, c, {3: 0, 4: 2, 6: 1}[comment['pos']], int(comment['color']), size, (c.count('\n') + 1) * size, CalculateLength(c) * size)
+            yield (int(comment['replay_time'] * 0.001), int(comment['commit_time']), i, c, {3: 0, 4: 2, 6: 1}[comment['pos']], int(comment['color']), size, (c.count('\n') + 1) * size, measure(c) * size)
         except (AssertionError, AttributeError, IndexError, TypeError, ValueError):
             logging.warning(_('Invalid comment: %r') % comment)
             continue
 
 
-def ReadCommentsTudou2(f, fontsize):
+def ReadCommentsTudou2(f, fontsize, measure=CalculateLength):
     comment_element = json.load(f)
     for i, comment in enumerate(comment_element['result']):
         try:
@@ -253,13 +348,13 @@ def ReadCommentsTudou2(f, fontsize):
             yield (
                 int(comment['playat'] * 0.001), int(comment['createtime'] * 0.001), i, c,
                 {0: 0, 3: 0, 4: 2, 6: 1}[pos],
-                int(prop.get('color', 0xffffff)), size, (c.count('\n') + 1) * size, CalculateLength(c) * size)
+                int(prop.get('color', 0xffffff)), size, (c.count('\n') + 1) * size, measure(c) * size)
         except (AssertionError, AttributeError, IndexError, TypeError, ValueError):
             logging.warning(_('Invalid comment: %r') % comment)
             continue
 
 
-def ReadCommentsMioMio(f, fontsize):
+def ReadCommentsMioMio(f, fontsize, measure=CalculateLength):
     NiconicoColorMap = {'red': 0xff0000, 'pink': 0xff8080, 'orange': 0xffc000, 'yellow': 0xffff00, 'green': 0x00ff00, 'cyan': 0x00ffff, 'blue': 0x0000ff, 'purple': 0xc000ff, 'black': 0x000000}
     dom = xml.dom.minidom.parse(f)
     comment_element = dom.getElementsByTagName('data')
@@ -269,13 +364,234 @@ def ReadCommentsMioMio(f, fontsize):
             c = str(message.childNodes[0].wholeText)
             pos = 0
             size = int(message.getAttribute('fontsize')) * fontsize / 25.0
-            yield (float(comment.getElementsByTagName('playTime')[0].childNodes[0].wholeText), int(calendar.timegm(time.strptime(comment.getElementsByTagName('times')[0].childNodes[0].wholeText, '%Y-%m-%d %H:%M:%S'))) - 28800, i, c, {'1': 0, '4': 2, '5': 1}[message.getAttribute('mode')], int(message.getAttribute('color')), size, (c.count('\n') + 1) * size, CalculateLength(c) * size)
+            yield (float(comment.getElementsByTagName('playTime')[0].childNodes[0].wholeText), int(calendar.timegm(time.strptime(comment.getElementsByTagName('times')[0].childNodes[0].wholeText, '%Y-%m-%d %H:%M:%S'))) - 28800, i, c, {'1': 0, '4': 2, '5': 1}[message.getAttribute('mode')], int(message.getAttribute('color')), size, (c.count('\n') + 1) * size, measure(c) * size)
         except (AssertionError, AttributeError, IndexError, TypeError, ValueError):
             logging.warning(_('Invalid comment: %s') % comment.toxml())
             continue
 
 
-CommentFormatMap = {'Niconico': ReadCommentsNiconico, 'Acfun': ReadCommentsAcfun, 'Bilibili': ReadCommentsBilibili, 'Bilibili2': ReadCommentsBilibili2, 'Tudou': ReadCommentsTudou, 'Tudou2': ReadCommentsTudou2, 'MioMio': ReadCommentsMioMio}
+#
+# Bilibili protobuf segments (seg.so)
+#
+# A DmSegMobileReply holds its comments as repeated field 1, each one a
+# DanmakuElem with these fields:
+#     1: id        2: progress (ms)  3: mode     4: fontsize  5: color
+#     6: midHash   7: content        8: ctime    9: weight    11: pool
+# Replies are decoded with a small varint reader instead of a compiled schema.
+# Concatenated replies are still one valid reply, so a file may hold all the
+# segments of a video one after another.  The file has to be opened in binary
+# mode, see BinaryCommentFormats.
+#
+
+# Wire types of the DanmakuElem fields that are checked when probing
+DanmakuElemWireTypes = {1: 0, 2: 0, 3: 0, 4: 0, 5: 0, 6: 2, 7: 2, 8: 0, 9: 0, 10: 2, 11: 0, 12: 2, 13: 0}
+
+
+def ReadProtobufVarint(data, pos):
+    result = 0
+    shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+        if shift >= 64:
+            raise ValueError(_('Malformed varint at byte %d') % pos)
+
+
+# Yields (field number, wire type, value); value is an int, or a memoryview of
+# the payload for length-delimited fields
+def IterProtobufFields(data, pos=0, end=None):
+    if end is None:
+        end = len(data)
+    while pos < end:
+        key, pos = ReadProtobufVarint(data, pos)
+        field, wire = key >> 3, key & 7
+        if wire == 0:
+            value, pos = ReadProtobufVarint(data, pos)
+        elif wire == 2:
+            length, pos = ReadProtobufVarint(data, pos)
+            if pos + length > end:
+                raise ValueError(_('Truncated protobuf field %d') % field)
+            value = data[pos:pos + length]
+            pos += length
+        elif wire == 5:
+            value = int.from_bytes(data[pos:pos + 4], 'little')
+            pos += 4
+        elif wire == 1:
+            value = int.from_bytes(data[pos:pos + 8], 'little')
+            pos += 8
+        else:
+            raise ValueError(_('Unsupported protobuf wire type %d') % wire)
+        yield field, wire, value
+
+
+def ToInt32(value):
+    value &= 0xffffffff
+    return value - 0x100000000 if value & 0x80000000 else value
+
+
+def ReadCommentsBilibiliProtobuf(f, fontsize, measure=CalculateLength):
+    data = memoryview(f.read())
+    i = 0
+    for field, wire, elem in IterProtobufFields(data):
+        if field != 1 or wire != 2:
+            continue
+        try:
+            values = {}
+            for key, _wire, value in IterProtobufFields(elem):
+                values[key] = value
+            mode = ToInt32(values.get(3, 0))
+            assert mode in (1, 4, 5, 6, 7, 8)
+            c = bytes(values.get(7, b'')).decode('utf-8', 'replace')
+            progress = ToInt32(values.get(2, 0)) / 1000
+            ctime = values.get(8, 0)
+            if mode in (1, 4, 5, 6):
+                c = FilterBadChars.BadChars.sub('\ufffd', c.replace('/n', '\n'))
+                size = ToInt32(values.get(4, 0)) * fontsize / 25.0
+                yield (progress, ctime, i, c, {1: 0, 4: 2, 5: 1, 6: 3}[mode], values.get(5, 0), size, (c.count('\n') + 1) * size, measure(c) * size)
+            elif mode == 7:  # positioned comment
+                yield (progress, ctime, i, c, 'bilipos', values.get(5, 0), ToInt32(values.get(4, 0)), 0, 0)
+        except (AssertionError, IndexError, TypeError, ValueError):
+            logging.warning(_('Invalid comment: %r') % bytes(elem))
+        i += 1
+
+
+# Result: True if data starts like a DmSegMobileReply, which text formats
+# cannot: a length-delimited field 1 whose whole payload decodes as a
+# DanmakuElem with a mode and a content
+def ProbeProtobufSegment(data):
+    try:
+        key, pos = ReadProtobufVarint(data, 0)
+        if key != 0x0a:
+            return False
+        length, pos = ReadProtobufVarint(data, pos)
+        fields = set()
+        for field, wire, value in IterProtobufFields(data, pos, pos + length):
+            if DanmakuElemWireTypes.get(field, wire) != wire:
+                return False
+            fields.add(field)
+        return pos + length <= len(data) and {3, 7} <= fields
+    except (IndexError, ValueError):
+        return False
+
+
+class CommentBatch(collections.abc.Sequence):
+    # Column-oriented storage of the tuples described in the ReadComments****
+    # protocol: one array per field, with comment texts interned in a single
+    # string table.  Tuples are only built when a comment is accessed.
+
+    Magic = b'D2AC\x01'
+    Types = 'dqqIbqdddB'  # timeline, timestamp, no, comment, pos, color, size, height, width, flags
+    Pos = (0, 1, 2, 3, 'bilipos', 'acfunpos')
+
+    def __init__(self, comments=()):
+        self.columns = [array.array(i) for i in self.Types]
+        self.strings = []
+        self.string_ids = {}
+        self.extend(comments)
+
+    def __len__(self):
+        return len(self.columns[0])
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        return self.unpack(*(i[index] for i in self.columns))
+
+    def __iter__(self):
+        return map(self.unpack, *self.columns)
+
+    def unpack(self, timeline, timestamp, no, text, pos, color, size, height, width, flags):
+        text = self.strings[text]
+        return (
+            int(timeline) if flags & 1 else timeline, timestamp, no,
+            json.loads(text) if flags & 16 else text, self.Pos[pos], color,
+            int(size) if flags & 2 else size, int(height) if flags & 4 else height, int(width) if flags & 8 else width)
+
+    def intern(self, text):
+        try:
+            return self.string_ids[text]
+        except KeyError:
+            self.strings.append(text)
+            self.string_ids[text] = len(self.strings) - 1
+            return len(self.strings) - 1
+
+    def append(self, c):
+        text = json.dumps(c[3]) if isinstance(c[3], dict) else c[3]
+        flags = isinstance(c[0], int) | isinstance(c[6], int) << 1 | isinstance(c[7], int) << 2 | isinstance(c[8], int) << 3 | isinstance(c[3], dict) << 4
+        row = (c[0], c[1], c[2], self.intern(text), self.Pos.index(c[4]), c[5], c[6], c[7], c[8], flags)
+        for i, (column, value) in enumerate(zip(self.columns, row)):
+            try:
+                column.append(value)
+            except OverflowError:
+                for column in self.columns[:i]:
+                    column.pop()
+                logging.warning(_('Invalid comment: %r') % (c,))
+                return
+
+    def extend(self, comments):
+        if isinstance(comments, CommentBatch):
+            ids = [self.intern(i) for i in comments.strings]
+            for i, (column, other) in enumerate(zip(self.columns, comments.columns)):
+                column.extend(array.array(column.typecode, map(ids.__getitem__, other)) if i == 3 else other)
+        else:
+            for c in comments:
+                self.append(c)
+
+    def sort(self):
+        # Order by timeline first and only build whole tuples to break ties,
+        # which gives the same order as sorting the tuples themselves
+        timeline = self.columns[0]
+        order = sorted(range(len(self)), key=timeline.__getitem__)
+        head = 0
+        for i in range(1, len(order) + 1):
+            if i == len(order) or timeline[order[i]] != timeline[order[head]]:
+                if i - head > 1:
+                    order[head:i] = sorted(order[head:i], key=self.__getitem__)
+                head = i
+        self.columns = [array.array(i.typecode, map(i.__getitem__, order)) for i in self.columns]
+
+    def tobytes(self):
+        strings = [i.encode('utf-8', 'surrogatepass') for i in self.strings]
+        chunks = [i.tobytes() for i in self.columns]
+        chunks.append(array.array('I', map(len, strings)).tobytes())
+        chunks.append(b''.join(strings))
+        return self.Magic + b''.join(struct.pack('<Q', len(i)) + i for i in chunks)
+
+    @classmethod
+    def frombytes(cls, data):
+        if not data.startswith(cls.Magic):
+            raise ValueError('not a comment batch')
+        offset = len(cls.Magic)
+        chunks = []
+        for i in range(len(cls.Types) + 2):
+            length, = struct.unpack_from('<Q', data, offset)
+            offset += 8
+            chunks.append(data[offset:offset + length])
+            offset += length
+        self = cls()
+        self.columns = [array.array(i, chunk) for i, chunk in zip(cls.Types, chunks)]
+        offset = 0
+        blob = chunks[-1]
+        for length in array.array('I', chunks[-2]):
+            self.strings.append(blob[offset:offset + length].decode('utf-8', 'surrogatepass'))
+            offset += length
+        self.string_ids = {text: i for i, text in enumerate(self.strings)}
+        if any(len(i) != len(self) for i in self.columns):
+            raise ValueError('truncated comment batch')
+        return self
+
+
+CommentFormatMap = {'Niconico': ReadCommentsNiconico, 'Acfun': ReadCommentsAcfun, 'Bilibili': ReadCommentsBilibili, 'Bilibili2': ReadCommentsBilibili2, 'Bilibili_protobuf': ReadCommentsBilibiliProtobuf, 'Tudou': ReadCommentsTudou, 'Tudou2': ReadCommentsTudou2, 'MioMio': ReadCommentsMioMio}
+
+# Formats whose files are opened in binary mode and are not run through FilterBadChars
+BinaryCommentFormats = {'Bilibili_protobuf'}
+
+# Formats that are read from memory-mapped files, see IterMappedCommentElements
+MappedCommentFormats = {'Bilibili', 'Bilibili2'}
 
 
 def WriteCommentBilibiliPositioned(f, c, width, height, styleid):
@@ -543,44 +859,222 @@ def ConvertFlashRotation(rotY, rotZ, X, Y, width, height):
     return (trX, trY, WrapAngle(outX), WrapAngle(outY), WrapAngle(outZ), scaleXY * 100, scaleXY * 100)
 
 
-def ProcessComments(comments, f, width, height, bottomReserved, fontface, fontsize, alpha, duration_marquee, duration_still, filters_regex, reduced, progress_callback):
-    styleid = 'Danmaku2ASS_%04x' % random.randint(0, 0xffff)
-    WriteASSHead(f, width, height, fontface, fontsize, alpha, styleid)
-    rows = [[None] * (height - bottomReserved + 1) for i in range(4)]
-    for idx, i in enumerate(comments):
-        if progress_callback and idx % 1000 == 0:
-            progress_callback(idx, len(comments))
-        if isinstance(i[4], int):
-            skip = False
-            for filter_regex in filters_regex:
-                if filter_regex and filter_regex.search(i[3]):
-                    skip = True
-                    break
-            if skip:
-                continue
-            row = 0
-            rowmax = height - bottomReserved - i[7]
-            while row <= rowmax:
-                freerows = TestFreeRows(rows, i, row, width, height, bottomReserved, duration_marquee, duration_still)
-                if freerows >= i[7]:
-                    MarkCommentRow(rows, i, row)
-                    WriteComment(f, i, row, width, height, bottomReserved, fontsize, duration_marquee, duration_still, styleid)
-                    break
+# Returns (styleid, rows), which can be passed back as resume to lay out more
+# comments after the current ones without writing another ASS head
+def ProcessComments(comments, f, width, height, bottomReserved, fontface, fontsize, alpha, duration_marquee, duration_still, filters_regex, reduced, progress_callback, layout='interval', resume=None, stats=None):
+    engine = LayoutEngineMap.get(layout)
+    if not engine:
+        raise ValueError(_('Unknown layout engine: %s') % layout)
+    if resume:
+        styleid, rows = resume
+    else:
+        styleid = 'Danmaku2ASS_%04x' % random.randint(0, 0xffff)
+        with TimeStage(stats, 'write'):
+            WriteASSHead(f, width, height, fontface, fontsize, alpha, styleid)
+        rows = engine.NewRows(height, bottomReserved)
+    placed = []
+    total = len(comments) if isinstance(comments, collections.abc.Sized) else None
+    idx = -1
+    with TimeStage(stats, 'layout'):
+        for idx, i in enumerate(comments):
+            if progress_callback and total is not None and idx % 1000 == 0:
+                progress_callback(idx, total)
+            if isinstance(i[4], int):
+                skip = False
+                for filter_regex in filters_regex:
+                    if filter_regex and filter_regex.search(i[3]):
+                        skip = True
+                        break
+                if skip:
+                    continue
+                row = engine.FindFreeRow(rows, i, width, height, bottomReserved, duration_marquee, duration_still, stats)
+                if row is not None:
+                    engine.MarkCommentRow(rows, i, row)
+                    placed.append((i, row))
+                    outcome = 'placed'
                 else:
-                    row += freerows or 1
+                    if not reduced:
+                        row = engine.FindAlternativeRow(rows, i, height, bottomReserved)
+                        engine.MarkCommentRow(rows, i, row)
+                        placed.append((i, row))
+                        outcome = 'alternative_rows'
+                    else:
+                        outcome = 'dropped_by_layout'
+            elif i[4] in ('bilipos', 'acfunpos'):
+                placed.append((i, None))
+                outcome = 'positioned'
             else:
-                if not reduced:
-                    row = FindAlternativeRow(rows, i, height, bottomReserved)
-                    MarkCommentRow(rows, i, row)
-                    WriteComment(f, i, row, width, height, bottomReserved, fontsize, duration_marquee, duration_still, styleid)
-        elif i[4] == 'bilipos':
-            WriteCommentBilibiliPositioned(f, i, width, height, styleid)
-        elif i[4] == 'acfunpos':
-            WriteCommentAcfunPositioned(f, i, width, height, styleid)
-        else:
-            logging.warning(_('Invalid comment: %r') % i[3])
+                logging.warning(_('Invalid comment: %r') % i[3])
+                outcome = 'invalid'
+            if stats is not None:
+                stats.counters[outcome] += 1
+            if len(placed) >= WriteChunkSize:
+                with TimeStage(stats, 'write', len(placed)):
+                    WriteComments(f, placed, width, height, bottomReserved, fontsize, duration_marquee, duration_still, styleid)
+                placed = []
+        with TimeStage(stats, 'write', len(placed)):
+            WriteComments(f, placed, width, height, bottomReserved, fontsize, duration_marquee, duration_still, styleid)
+    if stats is not None:
+        stats.counts['layout'] += idx + 1
     if progress_callback:
-        progress_callback(len(comments), len(comments))
+        progress_callback(idx + 1, idx + 1)
+    return styleid, rows
+
+
+#
+# Duplicate merging
+#
+# Comments in the same lane whose normalized text is equal (NFKC, case and
+# whitespace folded, runs of one character shortened to two, so "2333" and
+# "233333" match) are merged when they start within window seconds of the
+# first one.  A group is emitted as its first comment, marked with a "×N" suffix
+# and a font growing by DuplicateFontGrowth per doubling of N up to
+# DuplicateFontMax times, unless mark is false.  Open groups are kept in a hash
+# index and a queue ordered by start, so the sorted input is processed in one
+# pass and the output stays sorted.
+#
+
+DuplicateFontGrowth = 0.25
+DuplicateFontMax = 2.0
+
+
+def NormalizeCommentText(s):
+    s = ''.join(unicodedata.normalize('NFKC', s).casefold().split())
+    return re.sub(r'(.)\1{2,}', r'\1\1', s)
+
+
+def MarkDuplicateComment(c, count, measure=CalculateLength):
+    text = '%s×%d' % (c[3], count)
+    size = c[6] * min(1 + DuplicateFontGrowth * math.log2(count), DuplicateFontMax)
+    return (c[0], c[1], c[2], text, c[4], c[5], size, (text.count('\n') + 1) * size, measure(text) * size)
+
+
+def MergeDuplicateComments(comments, window, mark=True, measure=CalculateLength):
+    groups = {}
+    pending = collections.deque()
+    for c in comments:
+        while pending and pending[0][0][0] < c[0] - window:
+            yield FlushDuplicateGroup(groups, pending.popleft(), mark, measure)
+        if not isinstance(c[4], int):
+            pending.append([c, 1, None])
+            continue
+        key = (c[4], NormalizeCommentText(c[3]))
+        group = groups.get(key)
+        if group:
+            group[1] += 1
+        else:
+            group = groups[key] = [c, 1, key]
+            pending.append(group)
+    while pending:
+        yield FlushDuplicateGroup(groups, pending.popleft(), mark, measure)
+
+
+def FlushDuplicateGroup(groups, group, mark, measure):
+    c, count, key = group
+    if key is not None and groups.get(key) is group:
+        del groups[key]
+    if count > 1 and mark:
+        return MarkDuplicateComment(c, count, measure)
+    return c
+
+
+#
+# Density reduction
+#
+# With reduce_priority set, comments are capped per window of ReduceWindow
+# seconds and per lane before layout, so ProcessComments does not search every
+# row for comments it would drop anyway.  The cap is what the stage can show in
+# a window: (height-bottomReserved)/comment height rows, each taking a new
+# scrolling comment every duration_marquee*w/(w+width) seconds (the gap
+# TestFreeRows requires) or a new still comment every duration_still seconds.
+# Which comments of a full window are kept depends on the priority:
+#     earliest:  the first ones
+#     longest:   the ones with the longest text
+#     repeated:  the ones whose text is repeated most often in the window
+# Kept comments stay in their original order; positioned comments are never
+# dropped.
+#
+
+ReduceWindow = 1.0
+
+ReducePriorities = {
+    'earliest': lambda c, counts: 0,
+    'longest': lambda c, counts: -len(c[3]),
+    'repeated': lambda c, counts: -counts[c[3]],
+}
+
+
+def GetLaneCapacity(lane, window, width, height, bottomReserved, duration_marquee, duration_still):
+    commentHeight = sum(c[7] for c in lane) / len(lane)
+    if commentHeight <= 0:
+        return len(lane)
+    rows = (height - bottomReserved) // commentHeight
+    if lane[0][4] in (1, 2):
+        return math.ceil(rows * window / duration_still) if duration_still > 0 else len(lane)
+    commentWidth = sum(c[8] for c in lane) / len(lane)
+    if commentWidth <= 0 or duration_marquee <= 0:
+        return len(lane)
+    return math.ceil(rows * window * (commentWidth + width) / (duration_marquee * commentWidth))
+
+
+def ReduceCommentWindow(bucket, priority, width, height, bottomReserved, duration_marquee, duration_still, window, stats=None):
+    lanes = [[] for i in range(4)]
+    for idx, c in enumerate(bucket):
+        if isinstance(c[4], int):
+            lanes[c[4]].append((idx, c))
+    dropped = set()
+    for lane in lanes:
+        if not lane:
+            continue
+        capacity = GetLaneCapacity([c for idx, c in lane], window, width, height, bottomReserved, duration_marquee, duration_still)
+        if len(lane) <= capacity:
+            continue
+        counts = collections.Counter(c[3] for idx, c in lane)
+        ranked = sorted(lane, key=lambda x: (priority(x[1], counts), x[0]))
+        dropped.update(idx for idx, c in ranked[capacity:])
+    if stats is not None:
+        stats.counters['dropped_by_reduce'] += len(dropped)
+    return [c for idx, c in enumerate(bucket) if idx not in dropped]
+
+
+def ReduceComments(comments, width, height, bottomReserved, duration_marquee, duration_still, priority='earliest', window=ReduceWindow, stats=None):
+    result = CommentBatch(TimeComments(stats, 'reduce', IterReducedComments(comments, width, height, bottomReserved, duration_marquee, duration_still, priority, window, stats)))
+    if len(result) < len(comments):
+        logging.info(_('Reduced %d comments to %d before layout') % (len(comments), len(result)))
+    return result
+
+
+def IterReducedComments(comments, width, height, bottomReserved, duration_marquee, duration_still, priority='earliest', window=ReduceWindow, stats=None):
+    priority_key = ReducePriorities.get(priority)
+    if not priority_key:
+        raise ValueError(_('Unknown reduce priority: %s') % priority)
+    bucket = []
+    bucket_index = None
+    for c in comments:
+        index = math.floor(c[0] / window)
+        if index != bucket_index and bucket:
+            yield from ReduceCommentWindow(bucket, priority_key, width, height, bottomReserved, duration_marquee, duration_still, window, stats)
+            bucket = []
+        bucket_index = index
+        bucket.append(c)
+    if bucket:
+        yield from ReduceCommentWindow(bucket, priority_key, width, height, bottomReserved, duration_marquee, duration_still, window, stats)
+
+
+def FindFreeRow(rows, c, width, height, bottomReserved, duration_marquee, duration_still, stats=None):
+    row = 0
+    rowmax = height - bottomReserved - c[7]
+    while row <= rowmax:
+        freerows = TestFreeRows(rows, c, row, width, height, bottomReserved, duration_marquee, duration_still)
+        if freerows >= c[7]:
+            if stats is not None:
+                stats.counters['rows_scanned'] += row + freerows
+            return row
+        else:
+            row += freerows or 1
+    if stats is not None:
+        stats.counters['rows_scanned'] += row
+    return None
 
 
 def TestFreeRows(rows, c, row, width, height, bottomReserved, duration_marquee, duration_still):
@@ -631,6 +1125,342 @@ def MarkCommentRow(rows, c, row):
         pass
 
 
+def NewRows(height, bottomReserved):
+    return [[None] * (height - bottomReserved + 1) for i in range(4)]
+
+
+# Occupied rows as [(start, end, comment), ...] for each lane
+def ExportRows(rows, height, bottomReserved):
+    spans = []
+    for lane in rows:
+        spans.append([])
+        for row, owner in enumerate(lane[:max(height - bottomReserved, 0)]):
+            if owner is None:
+                continue
+            if spans[-1] and spans[-1][-1][1] == row and spans[-1][-1][2] is owner:
+                spans[-1][-1][1] = row + 1
+            else:
+                spans[-1].append([row, row + 1, owner])
+    return spans
+
+
+def ImportRows(spans, height, bottomReserved):
+    rows = NewRows(height, bottomReserved)
+    for lane, lane_spans in zip(rows, spans):
+        for start, end, owner in lane_spans:
+            lane[start:end] = [owner] * (end - start)
+    return rows
+
+
+#
+# Interval layout engine
+#
+# Each of the four lanes is stored as a pair of parallel lists (starts, owners):
+# pixel rows starts[k] .. starts[k+1]-1 are all occupied by owners[k] (None for
+# free rows), and the last span extends to the bottom of the usable stage.
+# Queries visit one span per distinct occupant instead of one pixel row, and
+# produce exactly the same placement as the per-pixel functions above.
+#
+
+
+def NewRowsInterval(height, bottomReserved):
+    return [([0], [None]) for i in range(4)]
+
+
+def IsRowBlocked(target, c, thresholdTime, width, duration_marquee, duration_still):
+    if not target:
+        return False
+    if c[4] in (1, 2):
+        return target[0] + duration_still > c[0]
+    try:
+        return target[0] > thresholdTime or target[0] + target[8] * duration_marquee / (target[8] + width) > c[0]
+    except ZeroDivisionError:
+        return False
+
+
+def FindFreeRowInterval(rows, c, width, height, bottomReserved, duration_marquee, duration_still, stats=None):
+    rowmax = height - bottomReserved
+    if rowmax - c[7] < 0:
+        return None
+    need = math.ceil(c[7])
+    if need <= 0:
+        return 0
+    starts, owners = rows[c[4]]
+    try:
+        thresholdTime = c[0] - duration_marquee * (1 - width / (c[8] + width))
+    except ZeroDivisionError:
+        thresholdTime = c[0] - duration_marquee
+    row = 0
+    # Pixel rows from the top the search got down to, as FindFreeRow counts them
+    scanned = rowmax
+    for span in range(len(starts)):
+        end = min(starts[span + 1], rowmax) if span + 1 < len(starts) else rowmax
+        if IsRowBlocked(owners[span], c, thresholdTime, width, duration_marquee, duration_still):
+            row = end
+            if row + need > rowmax:
+                scanned = end
+                row = None
+                break
+        elif end - row >= need:
+            scanned = row + need
+            break
+    else:
+        row = None
+    if stats is not None:
+        stats.counters['rows_scanned'] += scanned
+    return row
+
+
+def FindAlternativeRowInterval(rows, c, height, bottomReserved):
+    starts, owners = rows[c[4]]
+    limit = height - bottomReserved - math.ceil(c[7])
+    res = 0
+    best = owners[0]
+    for span in range(len(starts)):
+        if starts[span] >= limit:
+            break
+        if not owners[span]:
+            return starts[span]
+        elif owners[span][0] < best[0]:
+            res, best = starts[span], owners[span]
+    return res
+
+
+def MarkCommentRowInterval(rows, c, row):
+    starts, owners = rows[c[4]]
+    end = row + math.ceil(c[7])
+    if end <= row:
+        return
+    lo = bisect.bisect_right(starts, row) - 1
+    hi = bisect.bisect_right(starts, end)
+    new_starts = [row]
+    new_owners = [c]
+    if starts[lo] < row:
+        new_starts.insert(0, starts[lo])
+        new_owners.insert(0, owners[lo])
+    new_starts.append(end)
+    new_owners.append(owners[hi - 1])
+    starts[lo:hi] = new_starts
+    owners[lo:hi] = new_owners
+
+
+def ExportRowsInterval(rows, height, bottomReserved):
+    rowmax = height - bottomReserved
+    spans = []
+    for starts, owners in rows:
+        spans.append([])
+        for span, owner in enumerate(owners):
+            end = min(starts[span + 1], rowmax) if span + 1 < len(starts) else rowmax
+            if owner is not None and starts[span] < end:
+                spans[-1].append([starts[span], end, owner])
+    return spans
+
+
+def ImportRowsInterval(spans, height, bottomReserved):
+    rows = NewRowsInterval(height, bottomReserved)
+    for (starts, owners), lane_spans in zip(rows, spans):
+        for start, end, owner in lane_spans:
+            if starts[-1] == start:
+                owners[-1] = owner
+            else:
+                starts.append(start)
+                owners.append(owner)
+            starts.append(end)
+            owners.append(None)
+    return rows
+
+
+#
+# NumPy layout engine
+#
+# Rows are [timeline, widths, owner_ids, owners]: three 4 x (height-bottomReserved+1)
+# arrays holding, for every pixel row of every lane, the timeline and the width
+# of the comment occupying it (NaN timeline for free rows) and its index in the
+# owners list.  A query tests a whole lane against the comment at once and
+# searches the free runs between blocked rows, so comments are placed exactly
+# like the per-pixel functions above.  Without NumPy, the 'numpy' engine falls
+# back to the interval engine.
+#
+
+
+def NewRowsNumpy(height, bottomReserved):
+    size = max(height - bottomReserved + 1, 0)
+    return [numpy.full((4, size), numpy.nan), numpy.zeros((4, size)), numpy.full((4, size), -1, dtype=numpy.int64), []]
+
+
+def FindFreeRowNumpy(rows, c, width, height, bottomReserved, duration_marquee, duration_still, stats=None):
+    rowmax = height - bottomReserved
+    if rowmax - c[7] < 0:
+        return None
+    need = math.ceil(c[7])
+    if need <= 0:
+        return 0
+    if stats is not None:
+        stats.counters['rows_scanned'] += rowmax
+    timeline = rows[0][c[4], :rowmax]
+    if c[4] in (1, 2):
+        blocked = timeline + duration_still > c[0]
+    else:
+        try:
+            thresholdTime = c[0] - duration_marquee * (1 - width / (c[8] + width))
+        except ZeroDivisionError:
+            thresholdTime = c[0] - duration_marquee
+        widths = rows[1][c[4], :rowmax]
+        # 0/0 gives NaN, which never blocks, like the ZeroDivisionError in TestFreeRows
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            blocked = (timeline > thresholdTime) | (timeline + widths * duration_marquee / (widths + width) > c[0])
+    blocked = numpy.flatnonzero(blocked)
+    if not len(blocked):
+        return 0
+    starts = numpy.concatenate(([0], blocked + 1))
+    fits = numpy.flatnonzero(numpy.append(blocked, rowmax) - starts >= need)
+    return int(starts[fits[0]]) if len(fits) else None
+
+
+def FindAlternativeRowNumpy(rows, c, height, bottomReserved):
+    limit = height - bottomReserved - math.ceil(c[7])
+    if limit <= 0:
+        return 0
+    timeline = rows[0][c[4], :limit]
+    free = numpy.flatnonzero(numpy.isnan(timeline))
+    if len(free):
+        return int(free[0])
+    return int(numpy.argmin(timeline))
+
+
+def MarkCommentRowNumpy(rows, c, row):
+    timeline, widths, owner_ids, owners = rows
+    end = row + math.ceil(c[7])
+    if end <= row:
+        return
+    timeline[c[4], row:end] = c[0]
+    widths[c[4], row:end] = c[8]
+    owner_ids[c[4], row:end] = len(owners)
+    owners.append(c)
+    if len(owners) > 2 * owner_ids.size:
+        CompactOwnersNumpy(rows)
+
+
+# Drop owners that no longer occupy any row, so owners stays bounded by the
+# stage size instead of growing with the number of comments
+def CompactOwnersNumpy(rows):
+    owner_ids, owners = rows[2], rows[3]
+    occupied = owner_ids >= 0
+    used = numpy.unique(owner_ids[occupied])
+    owner_ids[occupied] = numpy.searchsorted(used, owner_ids[occupied])
+    owners[:] = [owners[i] for i in used.tolist()]
+
+
+def ExportRowsNumpy(rows, height, bottomReserved):
+    owners = rows[3]
+    spans = []
+    for lane in rows[2][:, :max(height - bottomReserved, 0)]:
+        bounds = [0] + (numpy.flatnonzero(numpy.diff(lane)) + 1).tolist() + [len(lane)]
+        ids = lane.tolist()
+        spans.append([[start, end, owners[ids[start]]] for start, end in zip(bounds, bounds[1:]) if start < end and ids[start] >= 0])
+    return spans
+
+
+def ImportRowsNumpy(spans, height, bottomReserved):
+    rows = NewRowsNumpy(height, bottomReserved)
+    timeline, widths, owner_ids, owners = rows
+    for lane, lane_spans in enumerate(spans):
+        for start, end, owner in lane_spans:
+            timeline[lane, start:end] = owner[0]
+            widths[lane, start:end] = owner[8]
+            owner_ids[lane, start:end] = len(owners)
+            owners.append(owner)
+    return rows
+
+
+LayoutEngine = collections.namedtuple('LayoutEngine', ('NewRows', 'FindFreeRow', 'MarkCommentRow', 'FindAlternativeRow', 'ExportRows', 'ImportRows'))
+
+LayoutEngineMap = {
+    'pixel': LayoutEngine(NewRows, FindFreeRow, MarkCommentRow, FindAlternativeRow, ExportRows, ImportRows),
+    'interval': LayoutEngine(NewRowsInterval, FindFreeRowInterval, MarkCommentRowInterval, FindAlternativeRowInterval, ExportRowsInterval, ImportRowsInterval),
+}
+if numpy is not None:
+    LayoutEngineMap['numpy'] = LayoutEngine(NewRowsNumpy, FindFreeRowNumpy, MarkCommentRowNumpy, FindAlternativeRowNumpy, ExportRowsNumpy, ImportRowsNumpy)
+else:
+    LayoutEngineMap['numpy'] = LayoutEngineMap['interval']
+
+
+#
+# Incremental layout state
+#
+# Saved next to the output as <output>.d2astate, it holds the layout
+# parameters, the style name, the timeline of the last laid out comment
+# (frontier), the occupied rows of every lane and the ids of every comment the
+# output was built from.  A later run with the same parameters appends only
+# unseen comments to the existing output, continuing from the saved rows.
+# Unseen comments before the frontier ("late" comments) cannot be laid out
+# against the saved rows, which only describe the end of the timeline, so
+# they are handled by the late policy:
+#     separate:  lay them out on their own empty rows, so they do not collide
+#                with each other but may overlap earlier output
+#     drop:      leave them out
+#     rebuild:   convert everything again from scratch
+#
+
+LayoutStateMagic = b'D2AS\x01'
+LatePolicies = ('separate', 'drop', 'rebuild')
+
+
+def GetCommentId(c):
+    # Comment tuples do not carry the row id of the source, so the send
+    # timestamp together with the content identifies a comment
+    key = repr((c[0], c[1], c[3], c[4], c[5], c[6])).encode('utf-8', 'surrogatepass')
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'little')
+
+
+def SaveLayoutState(state_file, params, styleid, frontier, rows, seen, layout):
+    engine = LayoutEngineMap[layout]
+    owners = CommentBatch()
+    owner_ids = {}
+    lanes = []
+    for lane_spans in engine.ExportRows(rows, params['height'], params['bottomReserved']):
+        lanes.append([])
+        for start, end, owner in lane_spans:
+            if id(owner) not in owner_ids:
+                owner_ids[id(owner)] = len(owners)
+                owners.append(owner)
+            lanes[-1].append((start, end, owner_ids[id(owner)]))
+    header = json.dumps({'params': params, 'styleid': styleid, 'frontier': frontier, 'lanes': lanes}).encode('utf-8')
+    chunks = (header, owners.tobytes(), array.array('Q', sorted(seen)).tobytes())
+    WriteCacheFile(state_file, LayoutStateMagic + b''.join(struct.pack('<Q', len(i)) + i for i in chunks))
+
+
+# Result: (styleid, frontier, rows, seen) or None if there is no usable state
+def LoadLayoutState(state_file, params, layout):
+    try:
+        with open(state_file, 'rb') as f:
+            data = f.read()
+        if not data.startswith(LayoutStateMagic):
+            return None
+        offset = len(LayoutStateMagic)
+        chunks = []
+        for i in range(3):
+            length, = struct.unpack_from('<Q', data, offset)
+            offset += 8
+            chunks.append(data[offset:offset + length])
+            offset += length
+        header = json.loads(chunks[0].decode('utf-8'))
+        if header['params'] != params:
+            return None
+        owners = CommentBatch.frombytes(chunks[1])
+        owners = [owners[i] for i in range(len(owners))]
+        spans = [[(start, end, owners[owner]) for start, end, owner in lane] for lane in header['lanes']]
+        rows = LayoutEngineMap[layout].ImportRows(spans, params['height'], params['bottomReserved'])
+        return header['styleid'], header['frontier'], rows, array.array('Q', chunks[2])
+    except (OSError, ValueError, KeyError, IndexError, TypeError, struct.error):
+        return None
+
+
+def IsCommentSeen(seen, comment_id):
+    i = bisect.bisect_left(seen, comment_id)
+    return i < len(seen) and seen[i] == comment_id
+
+
 def WriteASSHead(f, width, height, fontface, fontsize, alpha, styleid):
     f.write(
         '''[Script Info]
@@ -680,6 +1510,52 @@ def WriteComment(f, c, row, width, height, bottomReserved, fontsize, duration_ma
     f.write('Dialogue: 2,%(start)s,%(end)s,%(styleid)s,,0000,0000,0000,,{%(styles)s}%(text)s\n' % {'start': ConvertTimestamp(c[0]), 'end': ConvertTimestamp(c[0] + duration), 'styles': ''.join(styles), 'text': text, 'styleid': styleid})
 
 
+# Number of laid out comments that are serialized and written at once
+WriteChunkSize = 4096
+
+
+# Same output as calling WriteComment (or WriteComment*Positioned for
+# positioned comments, whose row is None) for each (comment, row) in order,
+# but timestamps and coordinates are converted for the whole chunk at once
+# and the chunk is handed to f in a single write
+def WriteComments(f, placed, width, height, bottomReserved, fontsize, duration_marquee, duration_still, styleid):
+    if not placed:
+        return
+    regular = [(c, row) for c, row in placed if row is not None]
+    durations = [duration_still if c[4] in (1, 2) else duration_marquee for c, row in regular]
+    starts = ConvertTimestamps([c[0] for c, row in regular])
+    ends = ConvertTimestamps([c[0] + duration for (c, row), duration in zip(regular, durations)])
+    neglens = NegativeCeil([c[8] for c, row in regular])
+    halfwidth = '%d' % (width / 2)
+    buf = io.StringIO()
+    k = 0
+    for c, row in placed:
+        if row is None:
+            if c[4] == 'bilipos':
+                WriteCommentBilibiliPositioned(buf, c, width, height, styleid)
+            else:
+                WriteCommentAcfunPositioned(buf, c, width, height, styleid)
+            continue
+        if c[4] == 1:
+            styles = '\\an8\\pos(%s, %d)' % (halfwidth, row)
+        elif c[4] == 2:
+            styles = '\\an2\\pos(%s, %d)' % (halfwidth, ConvertType2(row, height, bottomReserved))
+        elif c[4] == 3:
+            styles = '\\move(%d, %d, %d, %d)' % (neglens[k], row, width, row)
+        else:
+            styles = '\\move(%d, %d, %d, %d)' % (width, row, neglens[k], row)
+        if not (-1 < c[6] - fontsize < 1):
+            styles += '\\fs%.0f' % c[6]
+        if c[5] != 0xffffff:
+            styles += '\\c&H%s&' % ConvertColor(c[5])
+            if c[5] == 0x000000:
+                styles += '\\3c&HFFFFFF&'
+        buf.write('Dialogue: 2,%s,%s,%s,,0000,0000,0000,,{%s}%s\n' % (starts[k], ends[k], styleid, styles, ASSEscape(c[3])))
+        k += 1
+    f.write(buf.getvalue())
+
+
+@functools.lru_cache(maxsize=65536)
 def ASSEscape(s):
     def ReplaceLeadingSpace(s):
         sstrip = s.strip(' ')
@@ -693,8 +1569,270 @@ def ASSEscape(s):
     return '\\N'.join((ReplaceLeadingSpace(i) or ' ' for i in str(s).replace('\\', '\\\\').replace('{', '\\{').replace('}', '\\}').split('\n')))
 
 
-def CalculateLength(s):
-    return max(map(len, s.split('\n')))  # May not be accurate
+#
+# Font metrics
+#
+# CalculateLength counts characters, so a line of Latin letters is taken to
+# be as wide as as many CJK characters.  FontMetrics maps characters to their
+# advance in ems, read from the cmap and hmtx tables of a TrueType or OpenType
+# font (in a collection, the face named like the font face), and its measure
+# replaces CalculateLength when reading comments.  Characters the font does
+# not map, or all characters when there is no font, are measured by their
+# East Asian width: wide and ambiguous ones as 1 em, combining and format
+# characters as nothing, others as FontNarrowAdvance.  The table of a font is
+# cached as
+#     <cache_dir>/<sha1 of option and font face>.fnt
+# and read again when the font file changes.
+#
+
+FontNarrowAdvance = 0.55
+FontFileExtensions = ('.ttf', '.otf', '.ttc', '.otc')
+FontMetricsMagic = b'D2AFNT\x00\x01'
+
+
+class FontMetrics(dict):
+
+    def __init__(self, advances=(), key='eastasian'):
+        super().__init__(advances)
+        self.key = key
+
+    def __missing__(self, ch):
+        advance = self[ch] = GetEastAsianAdvance(ch)
+        return advance
+
+    def measure(self, s):
+        return max(sum(map(self.__getitem__, line)) for line in s.split('\n'))
+
+
+def GetEastAsianAdvance(ch):
+    if unicodedata.combining(ch) or unicodedata.category(ch) in ('Mn', 'Me', 'Cf'):
+        return 0.0
+    if unicodedata.east_asian_width(ch) in ('W', 'F', 'A'):
+        return 1.0
+    return FontNarrowAdvance
+
+
+def GetFontDirectories():
+    if sys.platform == 'win32':
+        return [os.path.join(os.environ.get('WINDIR', 'C:\\Windows'), 'Fonts'), os.path.join(os.environ.get('LOCALAPPDATA', ''), 'Microsoft', 'Windows', 'Fonts')]
+    elif sys.platform == 'darwin':
+        return ['/System/Library/Fonts', '/Library/Fonts', os.path.expanduser('~/Library/Fonts')]
+    else:
+        return [os.path.join(os.environ.get('XDG_DATA_HOME') or os.path.expanduser('~/.local/share'), 'fonts'), os.path.expanduser('~/.fonts'), '/usr/local/share/fonts', '/usr/share/fonts']
+
+
+# Result: offsets of the faces in a font file, [0] unless it is a collection
+def ReadFontFaces(f):
+    f.seek(0)
+    header = f.read(12)
+    if header[:4] == b'ttcf':
+        count, = struct.unpack_from('>I', header, 8)
+        return list(struct.unpack('>%dI' % count, f.read(4 * count)))
+    return [0]
+
+
+# Result: {tag: (offset, length)} of the tables of the face at offset
+def ReadFontTables(f, offset):
+    f.seek(offset)
+    version, count = struct.unpack('>4sH', f.read(6))
+    if version not in (b'\x00\x01\x00\x00', b'OTTO', b'true'):
+        raise ValueError(_('Not a TrueType or OpenType font'))
+    f.seek(offset + 12)
+    tables = {}
+    for i in range(count):
+        tag, checksum, table_offset, length = struct.unpack('>4sIII', f.read(16))
+        tables[tag] = (table_offset, length)
+    return tables
+
+
+def ReadFontTable(f, tables, tag):
+    if tag not in tables:
+        raise ValueError(_('Font has no %s table') % tag.decode('ascii'))
+    offset, length = tables[tag]
+    f.seek(offset)
+    data = f.read(length)
+    if len(data) != length:
+        raise ValueError(_('Font %s table is truncated') % tag.decode('ascii'))
+    return data
+
+
+# Result: {name id: casefolded names in every language} of a face for the
+# family (1, 16), style (2, 17) and full (4) names
+def ReadFontNames(f, tables):
+    data = ReadFontTable(f, tables, b'name')
+    count, string_offset = struct.unpack_from('>HH', data, 2)
+    names = collections.defaultdict(set)
+    for i in range(count):
+        platform, encoding, language, name_id, length, offset = struct.unpack_from('>6H', data, 6 + 12 * i)
+        if name_id not in (1, 2, 4, 16, 17):
+            continue
+        name = data[string_offset + offset:string_offset + offset + length]
+        if platform in (0, 3):
+            names[name_id].add(name.decode('utf-16-be', 'replace').casefold())
+        elif platform == 1 and encoding == 0:
+            names[name_id].add(name.decode('mac_roman', 'replace').casefold())
+    return names
+
+
+# Result: (score, offset) of the face of a font file that best matches
+# font_face: 3 for its full name, 2 for its family in a regular style, 1 for
+# its family in another style, 0 for none
+def MatchFontFace(f, font_face):
+    name = font_face.casefold()
+    best = (0, 0)
+    for offset in ReadFontFaces(f):
+        names = ReadFontNames(f, ReadFontTables(f, offset))
+        if name in names[4]:
+            return 3, offset
+        if name in names[1] | names[16]:
+            best = max(best, (2 if (names[17] or names[2]) & {'regular', 'normal', 'book', 'roman'} else 1, -offset))
+    return best[0], -best[1]
+
+
+# Result: {code point: glyph} from the first Unicode subtable of cmap in a
+# format that maps whole ranges (4 for the BMP, 12 for all planes)
+def ReadFontCharacterMap(data):
+    count, = struct.unpack_from('>H', data, 2)
+    subtables = {}
+    for i in range(count):
+        platform, encoding, offset = struct.unpack_from('>HHI', data, 4 + 8 * i)
+        subtables.setdefault((platform, encoding), offset)
+    for key in ((3, 10), (0, 6), (0, 4), (3, 1), (0, 3), (0, 2), (0, 1), (0, 0)):
+        offset = subtables.get(key)
+        if offset is None:
+            continue
+        subtable_format, = struct.unpack_from('>H', data, offset)
+        mapping = {}
+        if subtable_format == 12:
+            groups, = struct.unpack_from('>I', data, offset + 12)
+            for i in range(groups):
+                start, end, glyph = struct.unpack_from('>III', data, offset + 16 + 12 * i)
+                for code in range(start, min(end, 0x10ffff) + 1):
+                    mapping[code] = glyph + code - start
+            return mapping
+        elif subtable_format == 4:
+            segments = struct.unpack_from('>H', data, offset + 6)[0] // 2
+            ends = struct.unpack_from('>%dH' % segments, data, offset + 14)
+            starts = struct.unpack_from('>%dH' % segments, data, offset + 16 + 2 * segments)
+            deltas = struct.unpack_from('>%dH' % segments, data, offset + 16 + 4 * segments)
+            range_offsets_at = offset + 16 + 6 * segments
+            range_offsets = struct.unpack_from('>%dH' % segments, data, range_offsets_at)
+            for i in range(segments):
+                for code in range(starts[i], min(ends[i], 0xfffe) + 1):
+                    if range_offsets[i]:
+                        glyph, = struct.unpack_from('>H', data, range_offsets_at + 2 * i + range_offsets[i] + 2 * (code - starts[i]))
+                        glyph = glyph and (glyph + deltas[i]) & 0xffff
+                    else:
+                        glyph = (code + deltas[i]) & 0xffff
+                    if glyph:
+                        mapping[code] = glyph
+            return mapping
+    raise ValueError(_('Font has no Unicode character map'))
+
+
+# Result: ({character: advance in font units}, units per em) of a font file,
+# from its face named font_face or else its first one
+def ReadFontAdvances(filename, font_face=None):
+    with open(filename, 'rb') as f:
+        offset = ReadFontFaces(f)[0]
+        if font_face and offset:
+            offset = MatchFontFace(f, font_face)[1] or offset
+        tables = ReadFontTables(f, offset)
+        units_per_em, = struct.unpack_from('>H', ReadFontTable(f, tables, b'head'), 18)
+        metric_count, = struct.unpack_from('>H', ReadFontTable(f, tables, b'hhea'), 34)
+        hmtx = ReadFontTable(f, tables, b'hmtx')
+        cmap = ReadFontTable(f, tables, b'cmap')
+    if not units_per_em or not metric_count:
+        raise ValueError(_('Font has no horizontal metrics'))
+    advances = struct.unpack_from('>' + 'Hh' * metric_count, hmtx)[0::2]
+    return {chr(code): advances[min(glyph, metric_count - 1)] for code, glyph in ReadFontCharacterMap(cmap).items()}, units_per_em
+
+
+# Result: path of the font file with the face that best matches font_face, or
+# None
+def FindFontFile(font_face):
+    best = (0, None)
+    for directory in GetFontDirectories():
+        for root, dirs, files in os.walk(directory):
+            dirs.sort()
+            for filename in sorted(files):
+                if not filename.lower().endswith(FontFileExtensions):
+                    continue
+                path = os.path.join(root, filename)
+                try:
+                    with open(path, 'rb') as f:
+                        score = MatchFontFace(f, font_face)[0]
+                except (OSError, ValueError, struct.error):
+                    continue
+                if score == 3:
+                    return path
+                if score > best[0]:
+                    best = (score, path)
+    return best[1]
+
+
+# Result: FontMetrics for the font_metrics option, which is 'eastasian', 'font'
+# for the font file of font_face, or the path of a font file
+def GetFontMetrics(font_metrics, font_face, cache_dir=None):
+    if font_metrics == 'eastasian':
+        return FontMetrics()
+    cache_file = None
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        cache_file = os.path.join(cache_dir, hashlib.sha1(('%s\0%s' % (font_metrics, font_face)).encode('utf-8', 'surrogateescape')).hexdigest() + '.fnt')
+        metrics = ReadFontMetricsCache(cache_file)
+        if metrics is not None:
+            return metrics
+    filename = FindFontFile(font_face) if font_metrics == 'font' else font_metrics
+    if filename is None:
+        logging.warning(_('Font not found: %s, measuring comments by East Asian width') % font_face)
+        return FontMetrics()
+    try:
+        advances, units_per_em = ReadFontAdvances(filename, font_face)
+        st = os.stat(filename)
+    except (OSError, ValueError, struct.error) as e:
+        logging.warning(_('Failed to read font %s: %s, measuring comments by East Asian width') % (filename, e))
+        return FontMetrics()
+    source = {'filename': os.path.abspath(filename), 'mtime': st.st_mtime_ns, 'size': st.st_size, 'units_per_em': units_per_em}
+    if cache_file:
+        WriteFontMetricsCache(cache_file, source, advances)
+    return MakeFontMetrics(source, advances)
+
+
+def MakeFontMetrics(source, advances):
+    key = hashlib.sha1(json.dumps(source, sort_keys=True).encode('utf-8', 'surrogateescape')).hexdigest()[:16]
+    units_per_em = source['units_per_em']
+    return FontMetrics(((ch, advance / units_per_em) for ch, advance in advances.items()), key)
+
+
+def ReadFontMetricsCache(cache_file):
+    try:
+        with open(cache_file, 'rb') as f:
+            data = f.read()
+        if not data.startswith(FontMetricsMagic):
+            return None
+        length, = struct.unpack_from('<Q', data, len(FontMetricsMagic))
+        offset = len(FontMetricsMagic) + 8
+        source = json.loads(data[offset:offset + length].decode('utf-8', 'surrogateescape'))
+        st = os.stat(source['filename'])
+        if (st.st_mtime_ns, st.st_size) != (source['mtime'], source['size']):
+            return None
+        table = array.array('I', data[offset + length:])
+        if sys.byteorder != 'little':
+            table.byteswap()
+        count = len(table) // 2
+        return MakeFontMetrics(source, dict(zip(map(chr, table[:count]), table[count:])))
+    except (OSError, ValueError, KeyError, TypeError, struct.error):
+        return None
+
+
+def WriteFontMetricsCache(cache_file, source, advances):
+    header = json.dumps(source).encode('utf-8', 'surrogateescape')
+    table = array.array('I', map(ord, advances))
+    table.extend(advances.values())
+    if sys.byteorder != 'little':
+        table.byteswap()
+    WriteCacheFile(cache_file, FontMetricsMagic + struct.pack('<Q', len(header)) + header + table.tobytes())
 
 
 def ConvertTimestamp(timestamp):
@@ -705,6 +1843,23 @@ def ConvertTimestamp(timestamp):
     return '%d:%02d:%02d.%02d' % (int(hour), int(minute), int(second), int(centsecond))
 
 
+def ConvertTimestamps(timestamps):
+    if numpy is None or not timestamps:
+        return [ConvertTimestamp(i) for i in timestamps]
+    timestamp = numpy.rint(numpy.array(timestamps, dtype=numpy.float64) * 100.0).astype(numpy.int64)
+    hour, minute = numpy.divmod(timestamp, 360000)
+    minute, second = numpy.divmod(minute, 6000)
+    second, centsecond = numpy.divmod(second, 100)
+    return ['%d:%02d:%02d.%02d' % i for i in zip(hour.tolist(), minute.tolist(), second.tolist(), centsecond.tolist())]
+
+
+def NegativeCeil(values):
+    if numpy is None or not values:
+        return [-math.ceil(i) for i in values]
+    return (-numpy.ceil(numpy.array(values, dtype=numpy.float64))).astype(numpy.int64).tolist()
+
+
+@functools.lru_cache(maxsize=4096)
 def ConvertColor(RGB, width=1280, height=576):
     if RGB == 0x000000:
         return '000000'
@@ -737,10 +1892,195 @@ def ConvertToFile(filename_or_file, *args, **kwargs):
         return filename_or_file
 
 
-def FilterBadChars(f):
-    s = f.read()
-    s = re.sub('[\\x00-\\x08\\x0b\\x0c\\x0e-\\x1f]', '\ufffd', s)
-    return io.StringIO(s)
+class FilterBadChars(object):
+    # Replace control characters that are not allowed in XML while reading,
+    # one chunk at a time instead of copying the whole file
+
+    BadChars = re.compile('[\\x00-\\x08\\x0b\\x0c\\x0e-\\x1f]')
+
+    def __init__(self, f):
+        self.f = f
+
+    def read(self, size=-1):
+        return self.BadChars.sub('\ufffd', self.f.read(size))
+
+
+#
+# Comment filters
+#
+# A filter list is usually a long blocklist of plain words with a few real
+# regular expressions.  CommentFilter puts every pattern without regex
+# metacharacters into one Aho-Corasick automaton and joins the others into a
+# single alternation, so a comment is scanned about twice whatever the length
+# of the list.  Patterns that cannot be joined (global inline flags, named
+# groups, backreferences) are still searched one by one.  A comment matches when any pattern is found
+# in its text, as with re.search, and only non-positioned comments are
+# filtered.
+#
+
+class AhoCorasick(object):
+
+    def __init__(self, words):
+        self.goto = [{}]
+        self.fail = [0]
+        self.final = [False]
+        for word in words:
+            node = 0
+            for ch in word:
+                child = self.goto[node].get(ch)
+                if child is None:
+                    child = len(self.goto)
+                    self.goto[node][ch] = child
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.final.append(False)
+                node = child
+            self.final[node] = True
+        queue = collections.deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, child in self.goto[node].items():
+                queue.append(child)
+                fail = self.fail[node]
+                while fail and ch not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[child] = self.goto[fail].get(ch, 0)
+                self.final[child] = self.final[child] or self.final[self.fail[child]]
+
+    def search(self, s):
+        goto, fail, final = self.goto, self.fail, self.final
+        node = 0
+        for ch in s:
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            if final[node]:
+                return True
+        return False
+
+
+class CommentFilter(object):
+
+    RegexChars = frozenset('.^$*+?{}[]\\|()')
+    Unjoinable = re.compile(r'\(\?[aiLmsux]+\)|\(\?P[<=]|\(\?\(|\\[1-9]')
+
+    def __init__(self, patterns):
+        self.patterns = [i for i in patterns if i]
+        literals = []
+        regexes = []
+        self.separate = []
+        for pattern in self.patterns:
+            if self.RegexChars.isdisjoint(pattern):
+                literals.append(pattern)
+                continue
+            try:
+                regex = re.compile(pattern)
+            except re.error:
+                raise ValueError(_('Invalid regular expression: %s') % pattern)
+            if self.Unjoinable.search(pattern):
+                self.separate.append(regex)
+            else:
+                regexes.append(pattern)
+        self.literals = AhoCorasick(literals) if literals else None
+        self.regex = None
+        if regexes:
+            try:
+                self.regex = re.compile('|'.join('(?:%s)' % i for i in regexes))
+            except re.error:
+                self.separate.extend(map(re.compile, regexes))
+
+    def __bool__(self):
+        return bool(self.patterns)
+
+    def search(self, s):
+        if self.literals and self.literals.search(s):
+            return True
+        if self.regex and self.regex.search(s):
+            return True
+        return any(regex.search(s) for regex in self.separate)
+
+    def __call__(self, c):
+        return isinstance(c[4], int) and self.search(c[3])
+
+
+#
+# Comment cache
+#
+# The sorted comments of one input file are kept in
+#     <cache_dir>/<sha1 of content>-<format>-<font size>[-<font metrics>].cmt
+# as the bytes of a CommentBatch.  A small
+#     <cache_dir>/<sha1 of path, mtime and size>.ref
+# remembers the content hash, so an unchanged file is not even re-hashed while
+# touching the file (new mtime or size) makes it miss.  Files are evicted in
+# least-recently-used order once the directory grows over cache_size bytes.
+#
+
+def GetCommentCacheFile(cache_dir, filename, input_format, font_size, font_metrics=None):
+    st = os.stat(filename)
+    ref = '%s\0%d\0%d' % (os.path.abspath(filename), st.st_mtime_ns, st.st_size)
+    ref = os.path.join(cache_dir, hashlib.sha1(ref.encode('utf-8', 'surrogateescape')).hexdigest() + '.ref')
+    try:
+        with open(ref, 'r') as f:
+            digest = f.read().strip()
+        os.utime(ref)
+    except OSError:
+        digest = None
+    if not digest:
+        digest = hashlib.sha1()
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(1048576), b''):
+                digest.update(chunk)
+        digest = digest.hexdigest()
+        WriteCacheFile(ref, digest.encode('ascii'))
+    if font_metrics is not None:
+        return os.path.join(cache_dir, '%s-%s-%r-%s.cmt' % (digest, input_format, float(font_size), font_metrics.key))
+    return os.path.join(cache_dir, '%s-%s-%r.cmt' % (digest, input_format, float(font_size)))
+
+
+def ReadCommentCache(cache_file):
+    try:
+        with open(cache_file, 'rb') as f:
+            comments = CommentBatch.frombytes(f.read())
+        os.utime(cache_file)
+        return comments
+    except (OSError, ValueError, IndexError, struct.error):
+        return None
+
+
+def WriteCommentCache(cache_file, comments, cache_size):
+    try:
+        WriteCacheFile(cache_file, comments.tobytes())
+    except (OverflowError, TypeError, ValueError) as e:
+        logging.warning(_('Failed to cache comments: %s') % e)
+        return
+    EvictCache(os.path.dirname(cache_file), cache_size)
+
+
+def WriteCacheFile(filename, data):
+    tmpname = '%s.%d.tmp' % (filename, os.getpid())
+    try:
+        with open(tmpname, 'wb') as f:
+            f.write(data)
+        os.replace(tmpname, filename)
+    except OSError as e:
+        logging.warning(_('Failed to write cache: %s') % e)
+
+
+def EvictCache(cache_dir, cache_size):
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith(('.cmt', '.ref')) and entry.is_file():
+            st = entry.stat()
+            entries.append((st.st_mtime, st.st_size, entry.path))
+    total = sum(i[1] for i in entries)
+    for mtime, size, path in sorted(entries):
+        if total <= cache_size:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
 
 
 class safe_list(list):
@@ -762,66 +2102,375 @@ def export(func):
 
 
 @export
-def Danmaku2ASS(input_files, input_format, output_file, stage_width, stage_height, reserve_blank=0, font_face=_('(FONT) sans-serif')[7:], font_size=25.0, text_opacity=1.0, duration_marquee=5.0, duration_still=5.0, comment_filter=None, comment_filters_file=None, is_reduce_comments=False, progress_callback=None, *args, **kwargs):
+def Danmaku2ASS(input_files, input_format, output_file, stage_width, stage_height, reserve_blank=0, font_face=_('(FONT) sans-serif')[7:], font_size=25.0, text_opacity=1.0, duration_marquee=5.0, duration_still=5.0, comment_filter=None, comment_filters_file=None, is_reduce_comments=False, progress_callback=None, layout='interval', cache_dir=None, cache_size=268435456, incremental=False, incremental_late='separate', reduce_priority=None, merge_duplicates=0, merge_mark=True, font_metrics=None, stream_window=None, stats=None, *args, **kwargs):
+    started = time.perf_counter()
     comment_filters = [comment_filter]
     if comment_filters_file:
         with open(comment_filters_file, 'r') as f:
             d = f.readlines()
             comment_filters.extend([i.strip() for i in d])
-    filters_regex = []
-    for comment_filter in comment_filters:
-        try:
-            if comment_filter:
-                filters_regex.append(re.compile(comment_filter))
-        except:
-            raise ValueError(_('Invalid regular expression: %s') % comment_filter)
+    comment_filter = CommentFilter(comment_filters)
+    if incremental_late not in LatePolicies:
+        raise ValueError(_('Unknown late comment policy: %s') % incremental_late)
+    if reduce_priority and reduce_priority not in ReducePriorities:
+        raise ValueError(_('Unknown reduce priority: %s') % reduce_priority)
+    streaming = stream_window is not None
+    if streaming and incremental:
+        raise ValueError(_('Streaming cannot be combined with incremental output'))
     fo = None
-    comments = ReadComments(input_files, input_format, font_size)
+    font_metrics = GetFontMetrics(font_metrics, font_face, cache_dir) if font_metrics else None
+    measure = font_metrics.measure if font_metrics is not None else CalculateLength
+    state_file = None
+    resume = None
+    late = []
+    if streaming:
+        comments = StreamComments(input_files, input_format, font_size, stream_window, late, comment_filter or None, font_metrics, stats)
+    else:
+        comments = ReadComments(input_files, input_format, font_size, cache_dir=cache_dir, cache_size=cache_size, comment_filter=comment_filter or None, font_metrics=font_metrics, stats=stats)
+    if incremental and isinstance(output_file, str):
+        state_file = output_file + '.d2astate'
+        params = {'width': stage_width, 'height': stage_height, 'bottomReserved': reserve_blank, 'fontface': font_face, 'fontsize': font_size, 'alpha': text_opacity, 'duration_marquee': duration_marquee, 'duration_still': duration_still, 'filters': comment_filter.patterns, 'reduced': bool(is_reduce_comments), 'reduce_priority': reduce_priority, 'merge_duplicates': merge_duplicates, 'merge_mark': bool(merge_mark), 'layout': layout}
+        if font_metrics is not None:
+            params['font_metrics'] = font_metrics.key
+        if os.path.isfile(output_file):
+            resume = LoadLayoutState(state_file, params, layout)
+    if resume:
+        styleid, frontier, rows, seen = resume
+        seen_ids = set(seen)
+        new_comments = []
+        for c in comments:
+            comment_id = GetCommentId(c)
+            if not IsCommentSeen(seen, comment_id):
+                seen_ids.add(comment_id)
+                (new_comments if c[0] >= frontier else late).append(c)
+        if late and incremental_late == 'rebuild':
+            logging.info(_('%d late comments, converting everything again') % len(late))
+            resume = None
+            late = []
+        else:
+            comments = new_comments
+            if late and incremental_late == 'drop':
+                logging.info(_('Dropped %d late comments') % len(late))
+                late = []
+    if not resume and state_file:
+        seen_ids = set(map(GetCommentId, comments))
+        frontier = float('-inf')
+    # Filled while streaming, so only tested after the comments are laid out
+    late_comments = late
+    # Late comments are kept in the order they arrived in, the stages below
+    # take them in playback order
+    late = IterSortedComments(late) if streaming else sorted(late)
+    if merge_duplicates:
+        comments = TimeComments(stats, 'merge', MergeDuplicateComments(comments, merge_duplicates, merge_mark, measure))
+        late = TimeComments(stats, 'merge', MergeDuplicateComments(late, merge_duplicates, merge_mark, measure))
+        if not streaming:
+            comments = CommentBatch(comments)
+            late = CommentBatch(late)
+    if is_reduce_comments and reduce_priority:
+        if streaming:
+            comments = TimeComments(stats, 'reduce', IterReducedComments(comments, stage_width, stage_height, reserve_blank, duration_marquee, duration_still, reduce_priority, stats=stats))
+            late = TimeComments(stats, 'reduce', IterReducedComments(late, stage_width, stage_height, reserve_blank, duration_marquee, duration_still, reduce_priority, stats=stats))
+        else:
+            comments = ReduceComments(comments, stage_width, stage_height, reserve_blank, duration_marquee, duration_still, reduce_priority, stats=stats)
+            late = ReduceComments(late, stage_width, stage_height, reserve_blank, duration_marquee, duration_still, reduce_priority, stats=stats)
+    output_size = os.path.getsize(output_file) if resume else 0
     try:
-        if output_file:
+        if resume:
+            fo = ConvertToFile(output_file, 'a', encoding='utf-8-sig', errors='replace', newline='\r\n')
+            resume = styleid, rows
+        elif output_file:
             fo = ConvertToFile(output_file, 'w', encoding='utf-8-sig', errors='replace', newline='\r\n')
         else:
             fo = sys.stdout
-        ProcessComments(comments, fo, stage_width, stage_height, reserve_blank, font_face, font_size, text_opacity, duration_marquee, duration_still, filters_regex, is_reduce_comments, progress_callback)
+        styleid, rows = ProcessComments(comments, fo, stage_width, stage_height, reserve_blank, font_face, font_size, text_opacity, duration_marquee, duration_still, [], is_reduce_comments, progress_callback, layout, resume, stats)
+        if late_comments:
+            ProcessComments(late, fo, stage_width, stage_height, reserve_blank, font_face, font_size, text_opacity, duration_marquee, duration_still, [], is_reduce_comments, None, layout, (styleid, LayoutEngineMap[layout].NewRows(stage_height, reserve_blank)), stats)
     finally:
         if output_file and fo != output_file:
             fo.close()
-
-
+    if stats is not None:
+        stats.counters['late'] += len(late_comments)
+        if isinstance(output_file, str):
+            stats.output_bytes = (stats.output_bytes or 0) + os.path.getsize(output_file) - output_size
+    if state_file:
+        if len(comments):
+            frontier = max(frontier, comments[-1][0])
+        SaveLayoutState(state_file, params, styleid, frontier, rows, seen_ids, layout)
+    if stats is not None:
+        stats.wall += time.perf_counter() - started
+
+
+# Comments for which comment_filter returns true are left out as they are read;
+# cached files hold the unfiltered comments
 @export
-def ReadComments(input_files, input_format, font_size=25.0, progress_callback=None):
-    if isinstance(input_files, bytes):
-        input_files = str(bytes(input_files).decode('utf-8', 'replace'))
-    if isinstance(input_files, str):
-        input_files = [input_files]
-    else:
-        input_files = list(input_files)
-    comments = []
+def ReadComments(input_files, input_format, font_size=25.0, progress_callback=None, cache_dir=None, cache_size=268435456, comment_filter=None, font_metrics=None, stats=None):
+    input_files = ListInputFiles(input_files)
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+    comments = CommentBatch()
     for idx, i in enumerate(input_files):
         if progress_callback:
             progress_callback(idx, len(input_files))
-        with ConvertToFile(i, 'r', encoding='utf-8', errors='replace') as f:
-            s = f.read()
-            str_io = io.StringIO(s)
-            if input_format == 'autodetect':
-                CommentProcessor = GetCommentProcessor(str_io)
-                if not CommentProcessor:
-                    raise ValueError(
-                        _('Failed to detect comment file format: %s') % i
-                    )
-            else:
-                CommentProcessor = CommentFormatMap.get(input_format)
-                if not CommentProcessor:
-                    raise ValueError(
-                        _('Unknown comment file format: %s') % input_format
-                    )
-            comments.extend(CommentProcessor(FilterBadChars(str_io), font_size))
+        cache_file = None
+        if cache_dir and isinstance(i, str):
+            cache_file = GetCommentCacheFile(cache_dir, i, input_format, font_size, font_metrics)
+            with TimeStage(stats, 'cache'):
+                cached = ReadCommentCache(cache_file)
+            if cached is not None:
+                if stats is not None:
+                    stats.counts['cache'] += len(cached)
+                comments.extend(TimeComments(stats, 'filter', FilterComments(cached, comment_filter)))
+                continue
+        file_comments = ReadCommentFile(i, input_format, font_size, font_metrics.measure if font_metrics is not None else CalculateLength, stats)
+        if not cache_file:
+            comments.extend(TimeComments(stats, 'filter', FilterComments(file_comments, comment_filter)))
+        else:
+            file_comments = CommentBatch(file_comments)
+            with TimeStage(stats, 'sort'):
+                file_comments.sort()
+            with TimeStage(stats, 'cache'):
+                WriteCommentCache(cache_file, file_comments, cache_size)
+            comments.extend(TimeComments(stats, 'filter', FilterComments(file_comments, comment_filter)))
     if progress_callback:
         progress_callback(len(input_files), len(input_files))
-    comments.sort()
+    with TimeStage(stats, 'sort', len(comments)):
+        comments.sort()
     return comments
 
 
+# Yields the comments of one input file.  Files of MappedCommentFormats are
+# memory-mapped and parsed from bytes, others are read as text through
+# FilterBadChars, or in binary mode for BinaryCommentFormats
+def ReadCommentFile(filename_or_file, input_format, font_size, measure=CalculateLength, stats=None):
+    file_format = input_format
+    if input_format == 'autodetect':
+        with TimeStage(stats, 'probe'):
+            file_format = ProbeBinaryCommentFormat(filename_or_file) or input_format
+    if file_format in BinaryCommentFormats:
+        with ConvertToFile(filename_or_file, 'rb') as f:
+            yield from TimeComments(stats, 'parse', CommentFormatMap[file_format](f, font_size, measure))
+        return
+    if isinstance(filename_or_file, (str, bytes)) and (file_format == 'autodetect' or file_format in MappedCommentFormats):
+        with ConvertToFile(filename_or_file, 'rb') as f:
+            try:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):  # empty files cannot be mapped
+                data = None
+            if data is not None:
+                with data:
+                    if file_format == 'autodetect':
+                        with TimeStage(stats, 'probe'):
+                            file_format = ProbeCommentFormat(io.StringIO(data[:256].decode('utf-8', 'replace')))
+                    if file_format in MappedCommentFormats:
+                        yield from TimeComments(stats, 'parse', CommentFormatMap[file_format](data, font_size, measure))
+                        return
+    with ConvertToFile(filename_or_file, 'r', encoding='utf-8', errors='replace') as f:
+        if not f.seekable():
+            f = io.StringIO(f.read())
+        if input_format == 'autodetect':
+            with TimeStage(stats, 'probe'):
+                CommentProcessor = GetCommentProcessor(f)
+            if not CommentProcessor:
+                raise ValueError(
+                    _('Failed to detect comment file format: %s') % filename_or_file
+                )
+        else:
+            CommentProcessor = CommentFormatMap.get(input_format)
+            if not CommentProcessor:
+                raise ValueError(
+                    _('Unknown comment file format: %s') % input_format
+                )
+        yield from TimeComments(stats, 'parse', CommentProcessor(FilterBadChars(f), font_size, measure))
+
+
+def ListInputFiles(input_files):
+    if isinstance(input_files, bytes):
+        input_files = str(bytes(input_files).decode('utf-8', 'replace'))
+    if isinstance(input_files, str):
+        return [input_files]
+    return list(input_files)
+
+
+def FilterComments(comments, comment_filter):
+    if not comment_filter:
+        return comments
+    return (c for c in comments if not comment_filter(c))
+
+
+#
+# Streaming
+#
+# With a stream window, Danmaku2ASS lays comments out while they are read
+# instead of reading every file first.  The comments of each file are put in
+# playback order by a heap holding the last window seconds of them, the files
+# are merged with heapq.merge, and merging, reduction and layout take one
+# comment at a time while WriteComments flushes Dialogue lines every
+# WriteChunkSize comments.  Memory then follows the window and the comments on
+# the stage, not the size of the files.  Tuples are ordered like
+# CommentBatch.sort, so the output is the same as without streaming when no
+# comment is more than window seconds out of order.  One that is goes to late,
+# and is laid out after all others on fresh rows, like a late comment of an
+# incremental run.  The default window is the length of a Bilibili danmaku
+# segment, whose comments are in order segment by segment.
+#
+
+StreamWindow = 360.0
+
+
+def SortCommentWindow(comments, window, late):
+    heap = []
+    newest = float('-inf')
+    last = None
+    for c in comments:
+        if last is not None and c < last:
+            late.append(c)
+            continue
+        heapq.heappush(heap, c)
+        newest = max(newest, c[0])
+        while heap[0][0] < newest - window:
+            last = heapq.heappop(heap)
+            yield last
+    while heap:
+        yield heapq.heappop(heap)
+
+
+# Sorts comments only when first iterated, for a list of late comments that
+# is still being filled when the stages after it are set up
+def IterSortedComments(comments):
+    yield from sorted(comments)
+
+
+# Yields the comments of all input files in playback order, appending those
+# more than window seconds out of order to late instead
+@export
+def StreamComments(input_files, input_format, font_size=25.0, window=StreamWindow, late=None, comment_filter=None, font_metrics=None, stats=None):
+    if late is None:
+        late = []
+    measure = font_metrics.measure if font_metrics is not None else CalculateLength
+    streams = [SortCommentWindow(TimeComments(stats, 'filter', FilterComments(ReadCommentFile(i, input_format, font_size, measure, stats), comment_filter)), window, late) for i in ListInputFiles(input_files)]
+    return TimeComments(stats, 'sort', heapq.merge(*streams))
+
+
+#
+# Conversion statistics
+#
+# A ConversionStats passed as stats to Danmaku2ASS records the wall time of
+# each stage of the conversion and how many comments came out of it, and
+# counts what happened to the comments on the way:
+#     rows_scanned:       pixel rows a search for a free row went through,
+#                         from the top of the stage down to the free row or
+#                         to the bottom; the interval engine goes a span of
+#                         rows at a time and counts the rows the spans cover,
+#                         the numpy engine tests every row of the lane at
+#                         once and counts them all, so the figures of the
+#                         engines can be compared
+#     placed:             comments laid out on a free row
+#     alternative_rows:   comments laid out over others by FindAlternativeRow
+#     dropped_by_layout:  comments left out by reduce because no row was free
+#     dropped_by_reduce:  comments left out by reduce_priority before layout
+#     late:               comments laid out after the others, see StreamComments
+#                         and the late policies of incremental runs
+#     positioned, invalid
+# Stage times are exclusive: while a stage pulls comments from another one
+# (when streaming, every stage pulls from the one before), the time is charged
+# to the stage producing them, so the stages add up to the wall time but for
+# what Danmaku2ASS spends outside of them (other_seconds).
+#
+
+ConversionStages = ('probe', 'cache', 'parse', 'filter', 'sort', 'merge', 'reduce', 'layout', 'write')
+
+
+@export
+class ConversionStats(object):
+
+    def __init__(self):
+        self.seconds = dict.fromkeys(ConversionStages, 0.0)
+        self.counts = dict.fromkeys(ConversionStages, 0)
+        self.counters = collections.Counter()
+        self.wall = 0.0
+        self.output_bytes = None
+        self.running = []
+        self.since = 0.0
+
+    def enter(self, stage):
+        now = time.perf_counter()
+        if self.running:
+            self.seconds[self.running[-1]] += now - self.since
+        self.running.append(stage)
+        self.since = now
+
+    def leave(self):
+        now = time.perf_counter()
+        self.seconds[self.running.pop()] += now - self.since
+        self.since = now
+
+    @contextlib.contextmanager
+    def stage(self, stage, count=0):
+        self.enter(stage)
+        try:
+            yield
+        finally:
+            self.leave()
+        self.counts[stage] += count
+
+    # Yields the comments of iterable, timing the work to produce each one as
+    # stage
+    def iterate(self, stage, iterable):
+        iterator = iter(iterable)
+        while True:
+            self.enter(stage)
+            try:
+                c = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.leave()
+            self.counts[stage] += 1
+            yield c
+
+    def todict(self):
+        searches = self.counters['placed'] + self.counters['alternative_rows'] + self.counters['dropped_by_layout']
+        result = {
+            'wall_seconds': self.wall,
+            'other_seconds': max(self.wall - sum(self.seconds.values()), 0.0),
+            'stages': {i: {'seconds': self.seconds[i], 'comments': self.counts[i]} for i in ConversionStages if self.seconds[i] or self.counts[i]},
+            'rows_scanned_per_comment': self.counters['rows_scanned'] / searches if searches else 0.0,
+            'output_bytes': self.output_bytes,
+        }
+        for i in ('rows_scanned', 'placed', 'alternative_rows', 'dropped_by_layout', 'dropped_by_reduce', 'positioned', 'invalid', 'late'):
+            result[i] = self.counters[i]
+        return result
+
+
+def TimeStage(stats, stage, count=0):
+    return stats.stage(stage, count) if stats is not None else contextlib.nullcontext()
+
+
+def TimeComments(stats, stage, comments):
+    return stats.iterate(stage, comments) if stats is not None else comments
+
+
+# Result: the binary format of a file name or binary file object, or None
+def ProbeBinaryCommentFormat(filename_or_file):
+    if isinstance(filename_or_file, (str, bytes)):
+        with ConvertToFile(filename_or_file, 'rb') as f:
+            head = f.read(4096)
+            if not head and f.name.endswith('.protobuf'):
+                return 'Bilibili_protobuf'  # an empty segment
+    else:
+        f = filename_or_file
+        if isinstance(f, io.TextIOBase) or not f.seekable():
+            return None
+        pos = f.tell()
+        head = f.read(4096)
+        f.seek(pos)
+        if not isinstance(head, bytes):
+            return None
+    if ProbeProtobufSegment(head):
+        return 'Bilibili_protobuf'
+    return None
+
+
 @export
 def GetCommentProcessor(input_file):
     return CommentFormatMap.get(ProbeCommentFormat(input_file))
@@ -844,6 +2493,17 @@ def main():
     parser.add_argument('-flf', '--filter-file', help=_('Regular expressions from file (one line one regex) to filter comments'))
     parser.add_argument('-p', '--protect', metavar=_('HEIGHT'), help=_('Reserve blank on the bottom of the stage'), type=int, default=0)
     parser.add_argument('-r', '--reduce', action='store_true', help=_('Reduce the amount of comments if stage is full'))
+    parser.add_argument('--reduce-priority', choices=list(ReducePriorities), help=_('With --reduce, cap comments per second to what the stage can show before layout, keeping these first (earliest|longest|repeated)'))
+    parser.add_argument('--merge', metavar=_('SECONDS'), help=_('Merge identical comments starting within SECONDS of each other into one'), type=float, default=0)
+    parser.add_argument('--merge-plain', action='store_true', help=_('Do not mark merged comments with a count and a larger font'))
+    parser.add_argument('--font-metrics', metavar=_('MODE'), help=_('Measure comment widths with the glyph widths of the font face (font), of a TrueType/OpenType file (its path) or by East Asian width (eastasian) [default: count characters]'))
+    parser.add_argument('--layout', choices=list(LayoutEngineMap), help=_('Row allocation engine [default: %s]') % 'interval', default='interval')
+    parser.add_argument('--incremental', action='store_true', help=_('Append only comments that are new since the last run to OUTPUT'))
+    parser.add_argument('--late', choices=LatePolicies, help=_('What to do with new comments before the end of the last run (separate|drop|rebuild) [default: %s]') % 'separate', default='separate')
+    parser.add_argument('--stream', metavar=_('SECONDS'), nargs='?', const=StreamWindow, type=float, help=_('Lay out and write comments while reading them, reordering each file within SECONDS of playback time [default: %s]') % StreamWindow)
+    parser.add_argument('--cache', metavar=_('DIR'), help=_('Cache parsed comments in this directory'))
+    parser.add_argument('--cache-size', metavar=_('MB'), help=_('Maximum size of the comment cache [default: %s]') % 256, type=float, default=256.0)
+    parser.add_argument('--stats', choices=['json'], help=_('Print the time and comment count of each conversion stage and layout statistics to stderr (json)'))
     parser.add_argument('file', metavar=_('FILE'), nargs='+', help=_('Comment file to be processed'))
     args = parser.parse_args()
     try:
@@ -852,7 +2512,11 @@ def main():
         height = int(height)
     except ValueError:
         raise ValueError(_('Invalid stage size: %r') % args.size)
-    Danmaku2ASS(args.file, args.format, args.output, width, height, args.protect, args.font, args.fontsize, args.alpha, args.duration_marquee, args.duration_still, args.filter, args.filter_file, args.reduce)
+    stats = ConversionStats() if args.stats else None
+    Danmaku2ASS(args.file, args.format, args.output, width, height, args.protect, args.font, args.fontsize, args.alpha, args.duration_marquee, args.duration_still, args.filter, args.filter_file, args.reduce, layout=args.layout, cache_dir=args.cache, cache_size=int(args.cache_size * 1048576), incremental=args.incremental, incremental_late=args.late, reduce_priority=args.reduce_priority, merge_duplicates=args.merge, merge_mark=not args.merge_plain, font_metrics=args.font_metrics, stream_window=args.stream, stats=stats)
+    if stats is not None:
+        json.dump(stats.todict(), sys.stderr)
+        sys.stderr.write('\n')
 
 
 if __name__ == '__main__':